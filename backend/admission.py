@@ -0,0 +1,225 @@
+# admission.py
+"""
+Admission control for the LLM-backed endpoints.
+
+Each request to /ask, /summarize, /generate-quiz or /flashcards/generate needs
+a slot before it does any work. At most ``ADMISSION_MAX_ACTIVE`` requests hold
+a slot at once. The rest wait in a bounded priority queue, where chat
+(interactive) goes ahead of quiz, summary and flashcard generation (bulk).
+
+Requests are turned away early instead of timing out later:
+
+- 429 if the user already has too many requests in progress, or has used up
+  their token bucket,
+- 503 if the queue is full, or the expected wait is longer than
+  ``ADMISSION_QUEUE_TIMEOUT_SECONDS``, or the request waited that long anyway.
+
+Both responses carry a Retry-After header. Anonymous callers are keyed by
+client IP.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request
+
+from . import auth, observability
+from .llm_gateway import TokenBucket
+
+INTERACTIVE, BULK = 0, 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", 16))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 100))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 15))
+# 0 disables the per-user limits.
+USER_CONCURRENCY = int(os.getenv("ADMISSION_USER_CONCURRENCY", 3))
+USER_RATE_PER_MINUTE = float(os.getenv("ADMISSION_USER_RATE_PER_MINUTE", 20))
+USER_BURST = float(os.getenv("ADMISSION_USER_BURST", 10))
+MAX_TRACKED_USERS = 10000
+
+QUEUE_DEPTH = observability.gauge("studybuddy_admission_queue_depth", "Requests waiting for an admission slot.")
+ACTIVE = observability.gauge("studybuddy_admission_active", "Requests holding an admission slot.")
+REJECTIONS = observability.counter("studybuddy_admission_rejections_total", "Requests turned away by admission control.")
+QUEUE_WAIT = observability.histogram("studybuddy_admission_queue_wait_seconds", "Time spent waiting for an admission slot.")
+
+
+class Ticket:
+    __slots__ = ("key", "priority", "admitted_at", "released")
+
+    def __init__(self, key: str, priority: int):
+        self.key = key
+        self.priority = priority
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+
+class AdmissionController:
+    """Global slot pool plus per-user limits. All methods run on the event loop thread."""
+
+    def __init__(
+        self,
+        max_active: int = MAX_ACTIVE,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT_SECONDS,
+        user_concurrency: int = USER_CONCURRENCY,
+        user_rate_per_minute: float = USER_RATE_PER_MINUTE,
+        user_burst: float = USER_BURST,
+    ):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_concurrency = user_concurrency
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = user_burst
+        self.active = 0
+        # Heap of (priority, sequence, user key, future); FIFO within a priority.
+        self._queue = []
+        self._sequence = itertools.count()
+        # Requests per user that are admitted or queued.
+        self._user_requests = defaultdict(int)
+        self._user_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # Moving average of how long a request holds its slot, used to estimate waits.
+        self._service_seconds = 2.0
+
+    # --- Per-user limits ---
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._user_buckets.get(key)
+        if bucket is None:
+            bucket = self._user_buckets[key] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._user_buckets) > MAX_TRACKED_USERS:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(key)
+        return bucket
+
+    def _user_done(self, key: str):
+        self._user_requests[key] -= 1
+        if self._user_requests[key] <= 0:
+            del self._user_requests[key]
+
+    # --- Queue bookkeeping ---
+    def _publish(self):
+        depth = defaultdict(int)
+        for priority, _, _, future in self._queue:
+            if not future.done():
+                depth[priority] += 1
+        for priority, name in PRIORITY_NAMES.items():
+            QUEUE_DEPTH.set(depth[priority], priority=name)
+        ACTIVE.set(self.active)
+
+    def _discard(self, entry):
+        try:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        except ValueError:
+            pass
+
+    def _reject(self, status: int, reason: str, priority: int, retry_after: float, detail: str):
+        REJECTIONS.inc(reason=reason, priority=PRIORITY_NAMES[priority])
+        raise HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def estimated_wait(self, priority: int) -> float:
+        ahead = sum(1 for p, _, _, future in self._queue if p <= priority and not future.done())
+        return (ahead + 1) * self._service_seconds / self.max_active
+
+    # --- Acquire / release ---
+    async def acquire(self, key: str, priority: int) -> Ticket:
+        if self.user_concurrency and self._user_requests[key] >= self.user_concurrency:
+            self._reject(429, "user_concurrency", priority, self._service_seconds,
+                         "Too many requests in progress. Please wait for them to finish.")
+        if self.user_rate:
+            wait = self._bucket(key).take()
+            if wait:
+                self._reject(429, "user_rate", priority, wait, "Rate limit exceeded. Please slow down.")
+
+        if self.active < self.max_active and not self._queue:
+            self.active += 1
+            self._user_requests[key] += 1
+            self._publish()
+            return Ticket(key, priority)
+
+        if len(self._queue) >= self.max_queue:
+            self._reject(503, "queue_full", priority, self.estimated_wait(priority),
+                         "The server is busy. Please try again shortly.")
+        expected = self.estimated_wait(priority)
+        if expected > self.queue_timeout:
+            self._reject(503, "deadline", priority, expected, "The server is busy. Please try again shortly.")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), key, future)
+        heapq.heappush(self._queue, entry)
+        self._user_requests[key] += 1
+        self._publish()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # release() handed the slot over just as the timeout fired; give it back.
+                self.release(Ticket(key, priority))
+            else:
+                self._discard(entry)
+                self._user_done(key)
+                self._publish()
+            self._reject(503, "queue_timeout", priority, self.estimated_wait(priority),
+                         "The server is busy. Please try again shortly.")
+        except asyncio.CancelledError:
+            # The client went away. If a slot was already handed over, give it back.
+            if future.done() and not future.cancelled():
+                self.release(Ticket(key, priority))
+            else:
+                self._discard(entry)
+                self._user_done(key)
+                self._publish()
+            raise
+        QUEUE_WAIT.observe(time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+        return Ticket(key, priority)
+
+    def release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        held = time.monotonic() - ticket.admitted_at
+        self._service_seconds = 0.8 * self._service_seconds + 0.2 * held
+        self._user_done(ticket.key)
+        # Hand the slot straight to the next live waiter, so `active` is unchanged.
+        while self._queue:
+            _, _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                break
+        else:
+            self.active -= 1
+        self._publish()
+
+    @asynccontextmanager
+    async def slot(self, key: str, priority: int):
+        ticket = await self.acquire(key, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+
+controller = AdmissionController()
+
+
+def client_key(request: Request, current_user: Optional[dict]) -> str:
+    if current_user:
+        return current_user["email"]
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def admit(priority: int):
+    """Route dependency that holds an admission slot while the handler runs."""
+    async def dependency(request: Request, current_user: Optional[dict] = Depends(auth.get_current_user)):
+        async with controller.slot(client_key(request, current_user), priority):
+            yield
+    return dependency
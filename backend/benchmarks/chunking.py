@@ -0,0 +1,204 @@
+# benchmarks/chunking.py
+"""
+Compares chunking strategies (chunk size / overlap) on retrieval quality and
+index size.
+
+Each sample store is turned back into document text by stitching its chunks
+in index order (the overlap between neighbours is removed), then re-chunked
+with every strategy, embedded and indexed in memory. Texts persisted by
+ingestion (text_store.py) can be included with --text-store; those are used
+as stored.
+
+Queries are short spans of the document text, the same for every strategy. A
+retrieved chunk is relevant if it contains the whole span, so an answer split
+across a chunk boundary counts as a miss. "phrase" queries are the span
+itself, "keyword" queries its three rarest terms. Context cost is the
+estimated prompt tokens of the top-k chunks.
+
+Usage (from the project root):
+    python -m backend.benchmarks.chunking --stores vector_stores --strategies 500:50,1000:200,1500:300
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+import faiss
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import FAISS
+
+from .. import context, ingestion, lexical, text_store
+from .retrieval import _summarise
+
+SPAN_WORDS = 12
+
+
+def _normalise(text):
+    return " ".join(text.split())
+
+
+def pages_from_store(path, embeddings):
+    """Rebuilds (page, text) pages of a sample store from its chunks."""
+    store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    pages, current_page, text = [], None, ""
+    for key in store.index_to_docstore_id.values():
+        chunk = store.docstore.search(key)
+        page = chunk.metadata.get("page")
+        if text and page != current_page:
+            pages.append((current_page, text))
+            text = ""
+        current_page = page
+        text += chunk.page_content[context._overlap(text, chunk.page_content):] if text else chunk.page_content
+    if text:
+        pages.append((current_page, text))
+    return pages
+
+
+def chunk_pages(pages, chunk_size, chunk_overlap):
+    chunker = ingestion.IncrementalChunker(chunk_size, chunk_overlap)
+    chunks = []
+    for page_number, text in pages:
+        chunks.extend(chunker.add_page(page_number, text))
+    chunks.extend(chunker.finish())
+    return [text for text, _ in chunks]
+
+
+def make_queries(pages, rng, count):
+    words = " ".join(text for _, text in pages).split()
+    if len(words) < SPAN_WORDS * 2:
+        return []
+    doc_freq = {}
+    for term in lexical.tokenize(" ".join(words)):
+        doc_freq[term] = doc_freq.get(term, 0) + 1
+    queries = []
+    for _ in range(count):
+        start = rng.randrange(0, len(words) - SPAN_WORDS)
+        span = " ".join(words[start:start + SPAN_WORDS])
+        terms = [t for t in lexical.tokenize(span) if len(t) > 2]
+        if len(terms) < 4:
+            continue
+        rare = sorted(set(terms), key=lambda t: (doc_freq.get(t, 0), t))[:3]
+        queries.append(("keyword", " ".join(rare), span))
+        queries.append(("phrase", span, span))
+    return queries
+
+
+def benchmark_strategy(pages, queries, embeddings, chunk_size, chunk_overlap, k, fetch_k):
+    texts = chunk_pages(pages, chunk_size, chunk_overlap)
+    if not texts:
+        return None
+    started = time.perf_counter()
+    vectors = embeddings.embed_documents(texts)
+    embed_seconds = time.perf_counter() - started
+    # Chunks are identified by position, so dense and BM25 results compare directly.
+    store = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=[{"chunk": i} for i in range(len(texts))])
+    index = lexical.BM25Index()
+    index.add_many(zip(store.index_to_docstore_id.values(), texts))
+    normalised = [_normalise(text) for text in texts]
+
+    def dense(query):
+        return store.similarity_search(query, k=fetch_k)
+
+    def hybrid(query):
+        return lexical.reciprocal_rank_fusion(
+            [dense(query), [store.docstore.search(key) for key, _ in index.search(query, fetch_k)]],
+            [lexical.DENSE_WEIGHT, lexical.LEXICAL_WEIGHT], fetch_k,
+        )
+
+    results = {}
+    for kind in ("keyword", "phrase"):
+        subset = [q for q in queries if q[0] == kind]
+        results[kind] = {}
+        for name, search in {"dense": dense, "hybrid": hybrid}.items():
+            ranks, latencies, context_tokens = [], [], []
+            for _, query, span in subset:
+                started = time.perf_counter()
+                ranked = [doc.metadata["chunk"] for doc in search(query)]
+                latencies.append(time.perf_counter() - started)
+                target = _normalise(span)
+                ranks.append(next((rank for rank, i in enumerate(ranked, start=1) if target in normalised[i]), None))
+                context_tokens.append(sum(context.estimate_tokens(texts[i]) for i in ranked[:k]))
+            results[kind][name] = {
+                **_summarise(ranks, latencies, k),
+                "context_tokens_mean": round(statistics.mean(context_tokens), 1) if context_tokens else None,
+            }
+    return {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "chunks": len(texts),
+        "vector_bytes": len(faiss.serialize_index(store.index)),
+        "text_bytes": sum(len(text.encode("utf-8")) for text in texts),
+        "embed_seconds": round(embed_seconds, 3),
+        "results": results,
+    }
+
+
+def _parse_strategies(value):
+    strategies = []
+    for item in value.split(","):
+        size, overlap = item.split(":")
+        strategies.append((int(size), int(overlap)))
+    return strategies
+
+
+def _sources(args, embeddings):
+    for name in sorted(os.listdir(args.stores)):
+        path = os.path.join(args.stores, name)
+        if os.path.exists(os.path.join(path, "index.faiss")):
+            yield name, pages_from_store(path, embeddings)
+    if args.text_store:
+        for root, _, files in os.walk(text_store.TEXT_STORE_DIRECTORY):
+            for filename in sorted(files):
+                if filename.endswith(".txt.gz"):
+                    content_hash = filename[:-len(".txt.gz")]
+                    yield f"text_store:{content_hash[:12]}", list(text_store.iter_pages(content_hash))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stores", default="vector_stores")
+    parser.add_argument("--text-store", action="store_true", help="also benchmark texts persisted by ingestion")
+    parser.add_argument("--strategies", type=_parse_strategies, default=_parse_strategies("500:50,1000:200,1500:300,2000:200"),
+                        help="comma-separated chunk_size:chunk_overlap pairs")
+    parser.add_argument("--queries", type=int, default=50, help="spans sampled per document")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--fake-embeddings", action="store_true", help="use the offline hashing embedder from fakes.py")
+    parser.add_argument("--output", default="bench_chunking.json")
+    args = parser.parse_args()
+
+    if args.fake_embeddings:
+        from .fakes import FakeEmbeddings
+        embeddings = FakeEmbeddings()
+    else:
+        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    rng = random.Random(args.seed)
+    report = {}
+    for name, pages in _sources(args, embeddings):
+        queries = make_queries(pages, rng, args.queries)
+        if not queries:
+            continue
+        report[name] = {
+            "characters": sum(len(text) for _, text in pages),
+            "queries": len(queries),
+            "strategies": [
+                result for size, overlap in args.strategies
+                if (result := benchmark_strategy(pages, queries, embeddings, size, overlap, args.k, args.fetch_k))
+            ],
+        }
+        for result in report[name]["strategies"]:
+            phrase = result["results"]["phrase"]["hybrid"]
+            print(f"{name} {result['chunk_size']}:{result['chunk_overlap']} chunks={result['chunks']} "
+                  f"bytes={result['vector_bytes'] + result['text_bytes']} hit@{args.k}={phrase[f'hit@{args.k}']} "
+                  f"tokens={phrase['context_tokens_mean']}")
+
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
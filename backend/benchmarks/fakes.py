@@ -0,0 +1,87 @@
+# benchmarks/fakes.py
+"""
+Deterministic stand-ins for Gemini and the sentence-transformer embedder, so
+the API can be load-tested offline. Both accept the constructor arguments crud.py
+passes to the real classes.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from pydantic import Field
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class FakeEmbeddings(Embeddings):
+    """Feature-hashed bag of words: fast, deterministic and lexically meaningful."""
+
+    def __init__(self, model_name: str = "fake", dimension: int = 384, **kwargs: Any):
+        self.model_name = model_name
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in _WORD_RE.findall(text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeLLM(LLM):
+    """Returns valid quiz / flashcard JSON (or plain text) after `delay` seconds."""
+
+    model: str = "fake"
+    temperature: float = 0.0
+    max_retries: int = 0
+    delay: float = Field(default_factory=lambda: float(os.getenv("FAKE_LLM_DELAY", 0.5)))
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _respond(self, prompt: str) -> str:
+        seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        if "quiz generation assistant" in prompt:
+            questions = []
+            for i in range(5):
+                options = [f"Option {seed % 97}-{i}-{j}" for j in range(4)]
+                questions.append({
+                    "question": f"Synthetic question {seed}-{i}?",
+                    "options": options,
+                    "correct_answer": options[(seed + i) % 4],
+                    "explanation": "Generated by the benchmark fake LLM.",
+                })
+            return json.dumps({"questions": questions})
+        if "flashcards" in prompt:
+            count = int(m.group(1)) if (m := re.search(r"Generate a set of (\d+)", prompt)) else 10
+            cards = [{"term": f"Term {seed}-{i}", "definition": f"Definition of term {seed}-{i}."} for i in range(count)]
+            return json.dumps({"flashcards": cards})
+        if "reformulate" in prompt:
+            return prompt.rsplit("Human:", 1)[-1].strip()
+        if "SUMMARY:" in prompt:
+            return "A synthetic three paragraph summary.\n\nSecond paragraph.\n\nThird paragraph."
+        return "## Answer\n\nA synthetic answer produced by the benchmark fake LLM.\n\n- point one\n- point two"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        time.sleep(self.delay)
+        return self._respond(prompt)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        await asyncio.sleep(self.delay)
+        return self._respond(prompt)
@@ -0,0 +1,257 @@
+# benchmarks/loadtest.py
+"""
+Offline load test for the API.
+
+Runs the FastAPI app in-process against a throwaway SQLite database, with the
+fake LLM and embedder from fakes.py, seeds synthetic users, documents and
+history, then drives concurrent scenarios and reports p50/p95/p99 latency and
+throughput per endpoint. Results are written as JSON so runs from different
+commits can be compared.
+
+Usage (from the project root):
+    python -m backend.benchmarks.loadtest --users 5 --concurrency 20 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from . import fakes
+
+
+def _configure_environment(workdir: str, llm_delay: float):
+    """Must run before anything under backend/ is imported."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("DATABASE_ECHO", "false")
+    os.environ.setdefault("GOOGLE_API_KEY", "unused")
+    # Keep the post-upload bank warm-up short so uploads measure ingestion.
+    os.environ.setdefault("QUESTION_BANK_TARGET", "10")
+    # A handful of synthetic users drive all the traffic, so only the global admission limits apply.
+    os.environ.setdefault("ADMISSION_USER_CONCURRENCY", "0")
+    os.environ.setdefault("ADMISSION_USER_RATE_PER_MINUTE", "0")
+    os.makedirs(os.path.join(workdir, "uploads"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "vector_stores"), exist_ok=True)
+    os.chdir(workdir)
+
+    import langchain_community.embeddings
+    import langchain_google_genai
+
+    os.environ["FAKE_LLM_DELAY"] = str(llm_delay)
+    langchain_community.embeddings.HuggingFaceEmbeddings = fakes.FakeEmbeddings
+    langchain_google_genai.GoogleGenerativeAI = fakes.FakeLLM
+
+
+def _synthetic_pdf(pages: int, seed: int) -> bytes:
+    import fitz
+
+    rng = random.Random(seed)
+    vocabulary = [f"concept{n}" for n in range(500)] + ["CMPE-272", "entropy", "gradient", "theorem", "lemma"]
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        text = " ".join(rng.choice(vocabulary) for _ in range(350))
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), text, fontsize=9)
+    return doc.tobytes()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def call(self, client, method, url, name, **kwargs):
+        started = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.samples[name].append(time.perf_counter() - started)
+        self.statuses[name][response.status_code] += 1
+        return response
+
+    @staticmethod
+    def _percentile(ordered, pct):
+        if not ordered:
+            return None
+        index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+        return round(ordered[index] * 1000, 2)
+
+    def report(self, wall_seconds: float):
+        out = {}
+        for name, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            out[name] = {
+                "requests": len(samples),
+                "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else None,
+                "p50_ms": self._percentile(ordered, 50),
+                "p95_ms": self._percentile(ordered, 95),
+                "p99_ms": self._percentile(ordered, 99),
+                "status_codes": dict(self.statuses[name]),
+            }
+        return out
+
+
+async def _seed(client, args):
+    """Registers users, uploads their documents and inserts synthetic history."""
+    from backend import models
+    from backend.database import SessionLocal
+
+    users = []
+    for u in range(args.users):
+        response = await client.post("/register/", json={"name": f"user{u}", "email": f"user{u}@bench.local", "password": "pw"})
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        doc_ids = []
+        for d in range(args.documents):
+            pdf = _synthetic_pdf(args.pages, seed=u * 1000 + d)
+            response = await client.post(
+                "/documents/upload", headers=headers,
+                files={"file": (f"notes_{u}_{d}.pdf", pdf, "application/pdf")},
+            )
+            doc_ids.append(response.json()["id"])
+        users.append({"headers": headers, "documents": doc_ids, "email": f"user{u}@bench.local"})
+
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        for user in users:
+            db_user = db.query(models.User).filter(models.User.email == user["email"]).first()
+            for doc_id in user["documents"]:
+                for i in range(args.history):
+                    stamp = now - timedelta(minutes=args.history - i)
+                    db.add(models.ChatHistory(document_id=doc_id, user_id=db_user.id, role="human", content=f"Question {i}?", timestamp=stamp))
+                    db.add(models.ChatHistory(document_id=doc_id, user_id=db_user.id, role="ai", content="## Answer\n\n" + "Long markdown answer. " * 40, timestamp=stamp))
+                for i in range(args.history // 5):
+                    db.add(models.QuizAttempt(document_id=doc_id, user_id=db_user.id, score=random.uniform(0, 100), timestamp=now - timedelta(days=i)))
+        db.commit()
+    finally:
+        db.close()
+    return users
+
+
+async def _run_workers(count, worker):
+    await asyncio.gather(*(worker(i) for i in range(count)))
+
+
+async def scenario_ask_storm(client, users, recorder, args):
+    async def worker(i):
+        rng = random.Random(i)
+        for _ in range(args.requests):
+            user = rng.choice(users)
+            body = {"question": f"Explain concept{rng.randrange(500)} in detail", "document_ids": [rng.choice(user["documents"])], "chat_history": []}
+            await recorder.call(client, "POST", "/ask", "POST /ask", json=body, headers=user["headers"])
+    await _run_workers(args.concurrency, worker)
+
+
+async def scenario_upload_burst(client, users, recorder, args):
+    pdf = _synthetic_pdf(args.pages, seed=42)
+
+    async def worker(i):
+        user = users[i % len(users)]
+        await recorder.call(
+            client, "POST", "/documents/upload", "POST /documents/upload",
+            headers=user["headers"], files={"file": ("burst.pdf", pdf, "application/pdf")},
+        )
+    await _run_workers(args.concurrency, worker)
+
+
+async def scenario_dashboard_polling(client, users, recorder, args):
+    async def worker(i):
+        rng = random.Random(i)
+        for _ in range(args.requests):
+            user = rng.choice(users)
+            doc_id = rng.choice(user["documents"])
+            headers = user["headers"]
+            await recorder.call(client, "GET", "/documents/", "GET /documents/", headers=headers)
+            await recorder.call(client, "GET", f"/documents/{doc_id}/history", "GET /documents/{id}/history", headers=headers)
+            await recorder.call(client, "GET", f"/documents/{doc_id}/quiz-history", "GET /documents/{id}/quiz-history", headers=headers)
+            await recorder.call(client, "GET", f"/flashcards/document/{doc_id}", "GET /flashcards/document/{id}", headers=headers)
+            await recorder.call(client, "GET", f"/documents/{doc_id}/progress-report", "GET /documents/{id}/progress-report", headers=headers)
+    await _run_workers(args.concurrency, worker)
+
+
+async def scenario_generation(client, users, recorder, args):
+    async def worker(i):
+        rng = random.Random(i)
+        for _ in range(max(1, args.requests // 4)):
+            user = rng.choice(users)
+            body = {"document_id": rng.choice(user["documents"])}
+            await recorder.call(client, "POST", "/generate-quiz", "POST /generate-quiz", json=body, headers=user["headers"])
+            await recorder.call(client, "POST", "/summarize", "POST /summarize", json=body, headers=user["headers"])
+            await recorder.call(client, "POST", "/flashcards/generate", "POST /flashcards/generate", json=body, headers=user["headers"])
+    await _run_workers(args.concurrency, worker)
+
+
+SCENARIOS = {
+    "ask_storm": scenario_ask_storm,
+    "upload_burst": scenario_upload_burst,
+    "dashboard_polling": scenario_dashboard_polling,
+    "generation": scenario_generation,
+}
+
+
+async def run(args):
+    import httpx
+    from backend.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        seed_started = time.perf_counter()
+        users = await _seed(client, args)
+        report = {"seed_seconds": round(time.perf_counter() - seed_started, 2), "scenarios": {}}
+
+        for name in args.scenarios:
+            recorder = Recorder()
+            started = time.perf_counter()
+            await SCENARIOS[name](client, users, recorder, args)
+            wall = time.perf_counter() - started
+            report["scenarios"][name] = {"wall_seconds": round(wall, 3), "endpoints": recorder.report(wall)}
+            print(f"{name}: {json.dumps(report['scenarios'][name], indent=2)}")
+    return report
+
+
+def _git_commit(repo_dir: str):
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--documents", type=int, default=2, help="documents per user")
+    parser.add_argument("--pages", type=int, default=10, help="pages per synthetic PDF")
+    parser.add_argument("--history", type=int, default=50, help="chat turns per document")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=10, help="requests per worker")
+    parser.add_argument("--llm-delay", type=float, default=0.5, help="seconds per fake LLM call")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--workdir", default=None, help="defaults to a temporary directory")
+    parser.add_argument("--output", default="loadtest_results.json")
+    args = parser.parse_args()
+
+    repo_dir = os.getcwd()
+    output = os.path.abspath(args.output)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="studybuddy-bench-")
+    _configure_environment(workdir, args.llm_delay)
+    sys.path.insert(0, repo_dir)
+
+    report = asyncio.run(run(args))
+    report["meta"] = {
+        "commit": _git_commit(repo_dir),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+    }
+    with open(output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# benchmarks/retrieval.py
+"""
+Offline retrieval quality and latency benchmark over the sample vector stores.
+
+Queries are synthesised from the stores themselves: a chunk is picked at
+random and turned into either a "keyword" query (its rarest terms, which is
+what course codes and formula names look like) or a "phrase" query (a short
+span of its text). The chunk it came from is the single relevant answer.
+
+Usage (from the project root):
+    python -m backend.benchmarks.retrieval --stores vector_stores --queries 50
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import FAISS
+
+from .. import lexical
+
+
+def _make_queries(chunks, index, rng, count):
+    queries = []
+    doc_freq = {term: len(plist) for term, plist in index.postings.items()}
+    for docstore_id, text in rng.sample(chunks, min(count, len(chunks))):
+        terms = [t for t in lexical.tokenize(text) if len(t) > 2]
+        if len(terms) < 8:
+            continue
+        rare = sorted(set(terms), key=lambda t: (doc_freq.get(t, 0), t))[:3]
+        queries.append(("keyword", " ".join(rare), docstore_id))
+        start = rng.randrange(0, len(terms) - 7)
+        queries.append(("phrase", " ".join(terms[start:start + 8]), docstore_id))
+    return queries
+
+
+def _rank_of(docs, target_text):
+    for rank, doc in enumerate(docs, start=1):
+        if doc.page_content == target_text:
+            return rank
+    return None
+
+
+def _summarise(ranks, latencies, k):
+    hits = [r for r in ranks if r is not None and r <= k]
+    ordered = sorted(latencies)
+    return {
+        f"hit@{k}": round(len(hits) / len(ranks), 4) if ranks else None,
+        "mrr": round(sum(1 / r for r in hits) / len(ranks), 4) if ranks else None,
+        "latency_ms_p50": round(statistics.median(ordered) * 1000, 3) if ordered else None,
+        "latency_ms_p95": round(ordered[int(len(ordered) * 0.95) - 1] * 1000, 3) if ordered else None,
+    }
+
+
+def benchmark_store(path, embeddings, rng, num_queries, k, fetch_k):
+    store = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    chunks = [(key, store.docstore.search(key).page_content) for key in store.index_to_docstore_id.values()]
+    index = lexical.BM25Index()
+    index.add_many(chunks)
+    texts = dict(chunks)
+
+    def dense(query):
+        return store.similarity_search(query, k=fetch_k)
+
+    def bm25(query):
+        return [store.docstore.search(key) for key, _ in index.search(query, fetch_k)]
+
+    def hybrid(query):
+        return lexical.reciprocal_rank_fusion(
+            [dense(query), bm25(query)], [lexical.DENSE_WEIGHT, lexical.LEXICAL_WEIGHT], fetch_k
+        )
+
+    methods = {"dense": dense, "bm25": bm25, "hybrid": hybrid}
+    results = {}
+    queries = _make_queries(chunks, index, rng, num_queries)
+    for kind in ("keyword", "phrase"):
+        subset = [q for q in queries if q[0] == kind]
+        results[kind] = {}
+        for name, search in methods.items():
+            ranks, latencies = [], []
+            for _, query, target in subset:
+                started = time.perf_counter()
+                docs = search(query)
+                latencies.append(time.perf_counter() - started)
+                ranks.append(_rank_of(docs, texts[target]))
+            results[kind][name] = _summarise(ranks, latencies, k)
+    return {"chunks": len(chunks), "queries": len(queries), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stores", default="vector_stores")
+    parser.add_argument("--queries", type=int, default=50, help="chunks sampled per store")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    rng = random.Random(args.seed)
+    report = {}
+    for name in sorted(os.listdir(args.stores)):
+        path = os.path.join(args.stores, name)
+        if not os.path.exists(os.path.join(path, "index.faiss")):
+            continue
+        report[name] = benchmark_store(path, embeddings, rng, args.queries, args.k, args.fetch_k)
+        print(name, json.dumps(report[name]["results"], indent=2))
+
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+# cache.py
+"""
+Read-through cache for the serialized JSON of the listing endpoints.
+
+Entries are stored as ready-to-send bytes, so a hit skips the query and the
+Pydantic ``from_attributes`` round trip entirely. Each key embeds the current
+generation of every scope it depends on, e.g. ``("doc", 12)`` and
+``("quiz", 3, 12)``. The crud write paths call ``invalidate()`` with the scope
+they changed, which bumps its generation. Older entries are then never read
+again and age out of the LRU or TTL, so nothing has to be scanned or deleted.
+
+Backends:
+- ``memory`` (default): per-process LRU bounded by ``RESPONSE_CACHE_MAX_BYTES``,
+- ``redis``: shared by all workers (``REDIS_URL``; needs the ``redis`` package),
+- ``fake``: in-process stand-in with the Redis calls used here, for tests,
+- ``off``: no caching.
+
+Routes call ``json_response()`` after ``http_cache.not_modified()``, and the
+ETag it set (a version stamp read from the database on every request) becomes
+part of the key. A write handled by another worker therefore changes the key
+even when that worker's invalidations never reach this one's memory backend.
+"""
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+from .observability import logger, record_cache
+
+try:
+    import redis
+except ImportError:  # optional dependency
+    redis = None
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 300))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+# --- Backends ---
+class MemoryBackend:
+    """
+    LRU by total bytes with per-entry expiry. Generation counters are entries
+    too, so they count against max_bytes and expire after counter_ttl; a lost
+    counter restarts at a clock value (see ResponseCache._generation).
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, counter_ttl: int = RESPONSE_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.counter_ttl = counter_ttl
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Optional[Tuple[bytes, float]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            self._pop(key)
+            return None
+        return entry
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _pop(self, key: str):
+        value, _ = self._entries.pop(key)
+        self.size -= len(value)
+
+    def _put(self, key: str, value: bytes, expires_at: float):
+        if key in self._entries:
+            self._pop(key)
+        self._entries[key] = (value, expires_at)
+        self.size += len(value)
+        while self.size > self.max_bytes and self._entries:
+            self._pop(next(iter(self._entries)))
+
+    def set(self, key: str, value: bytes, ttl: int):
+        with self._lock:
+            self._put(key, value, time.monotonic() + ttl)
+
+    def add(self, key: str, value: int):
+        with self._lock:
+            if self._live(key) is None:
+                self._put(key, str(value).encode(), time.monotonic() + self.counter_ttl)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                value, expires_at = time.time_ns(), time.monotonic() + self.counter_ttl
+            else:
+                value, expires_at = int(entry[0]) + 1, entry[1]
+            self._put(key, str(value).encode(), expires_at)
+            return value
+
+
+class FakeRedis:
+    """In-process stand-in for the subset of the redis-py client that RedisBackend uses."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value, expires_at = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key: str, value, ex: Optional[int] = None, nx: bool = False):
+        with self._lock:
+            if nx and key in self._data:
+                return None
+            value = value if isinstance(value, bytes) else str(value).encode()
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+            return True
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value, expires_at = self._data.get(key, (b"0", None))
+            value = int(value) + 1
+            self._data[key] = (str(value).encode(), expires_at)
+            return value
+
+
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self.client.set(key, value, ex=ttl)
+
+    def add(self, key: str, value: int):
+        self.client.set(key, value, nx=True)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(key)
+
+
+# --- Cache ---
+Scope = Tuple[Any, ...]
+
+
+@lru_cache(maxsize=None)
+def _adapter(response_type) -> TypeAdapter:
+    return TypeAdapter(response_type)
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl: int = RESPONSE_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        # One lock per key being rendered, so a burst of misses renders once (stampede guard).
+        self._render_locks = weakref.WeakValueDictionary()
+        self._guard = threading.Lock()
+
+    @staticmethod
+    def _scope_key(scope: Scope) -> str:
+        return "gen:" + ":".join(str(part) for part in scope)
+
+    def _generation(self, scope: Scope) -> str:
+        if self.backend is None:
+            return "0"
+        key = self._scope_key(scope)
+        value = self.backend.get(key)
+        if value is None:
+            # Start at a clock value rather than 0, so a counter that was lost
+            # (e.g. evicted from Redis) cannot come back to an old generation.
+            self.backend.add(key, time.time_ns())
+            value = self.backend.get(key)
+        return value.decode() if isinstance(value, bytes) else str(value)
+
+    def invalidate(self, *scope):
+        if self.backend is not None:
+            key = self._scope_key(scope)
+            # A counter that expired or was evicted must not restart at 1, a generation it may have had before.
+            self.backend.add(key, time.time_ns())
+            self.backend.incr(key)
+
+    def _render_lock(self, key: str) -> threading.Lock:
+        with self._guard:
+            lock = self._render_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._render_locks[key] = lock
+            return lock
+
+    def get_or_render(self, name: str, scopes: Iterable[Scope], render: Callable[[], bytes]) -> bytes:
+        if self.backend is None:
+            return render()
+        resource = name.split(":", 1)[0]
+        generations = ".".join(self._generation(scope) for scope in scopes)
+        key = f"resp:{name}:{generations}"
+        body = self.backend.get(key)
+        if body is None:
+            with self._render_lock(key):
+                body = self.backend.get(key)
+                if body is None:
+                    record_cache(f"response:{resource}", False)
+                    body = render()
+                    self.backend.set(key, body, self.ttl)
+                    return body
+        record_cache(f"response:{resource}", True)
+        return body
+
+    def json_response(self, response: Response, name: str, scopes: Iterable[Scope], response_type, load: Callable[[], Any]) -> Response:
+        """Cached JSON for `load()` serialized as `response_type`; keeps headers set on `response` (e.g. ETag)."""
+        adapter = _adapter(response_type)
+
+        def render() -> bytes:
+            return adapter.dump_json(adapter.validate_python(load(), from_attributes=True))
+
+        if "etag" in response.headers:
+            name = f"{name}:{response.headers['etag']}"
+        body = self.get_or_render(name, scopes, render)
+        return Response(content=body, media_type="application/json", headers=dict(response.headers))
+
+
+def _make_backend():
+    if RESPONSE_CACHE_BACKEND == "off":
+        return None
+    if RESPONSE_CACHE_BACKEND == "fake":
+        return RedisBackend(FakeRedis())
+    if RESPONSE_CACHE_BACKEND == "redis":
+        if redis is None:
+            logger.warning("RESPONSE_CACHE_BACKEND=redis but the redis package is not installed; using the memory cache.")
+            return MemoryBackend()
+        return RedisBackend(redis.Redis.from_url(REDIS_URL))
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(_make_backend())
@@ -0,0 +1,122 @@
+# chat_archive.py
+"""
+Hot/cold tiering for chat history.
+
+The newest CHAT_HOT_WINDOW messages of each document stay in ``chat_history``.
+Older ones (and only those past CHAT_ARCHIVE_MIN_AGE_DAYS) are moved in bulk
+into ``chat_history_archive``: one zlib-compressed JSON blob per document and
+calendar month per archiving run. Reads page backwards by message id across
+both tiers, so callers do not need to know where a message lives.
+
+Archiving runs offline: ``python -m backend.maintenance archive-chat``.
+"""
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models
+
+CHAT_HOT_WINDOW = int(os.getenv("CHAT_HOT_WINDOW", 200))
+CHAT_ARCHIVE_MIN_AGE_DAYS = int(os.getenv("CHAT_ARCHIVE_MIN_AGE_DAYS", 30))
+_DELETE_BATCH = 1000
+
+
+def _encode(messages: List[models.ChatHistory]) -> bytes:
+    rows = [
+        {"id": m.id, "user_id": m.user_id, "role": m.role, "content": m.content, "timestamp": m.timestamp.isoformat()}
+        for m in messages
+    ]
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def decode_segment(segment: models.ChatHistoryArchive) -> List[dict]:
+    rows = json.loads(zlib.decompress(segment.payload))
+    for row in rows:
+        row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return rows
+
+
+def archive_document(db: Session, document_id: int, hot_window: int = CHAT_HOT_WINDOW,
+                     min_age_days: int = CHAT_ARCHIVE_MIN_AGE_DAYS, dry_run: bool = False) -> dict:
+    """Moves one document's cold messages into archive segments; commits once."""
+    # Everything below the hot window's oldest id is a candidate.
+    boundary = (
+        db.query(models.ChatHistory.id)
+        .filter(models.ChatHistory.document_id == document_id)
+        .order_by(models.ChatHistory.id.desc())
+        .offset(hot_window)
+        .limit(1)
+        .scalar()
+    )
+    stats = {"document_id": document_id, "messages": 0, "segments": 0, "raw_bytes": 0, "compressed_bytes": 0}
+    if boundary is None:
+        return stats
+
+    cutoff = datetime.utcnow() - timedelta(days=min_age_days)
+    cold = (
+        db.query(models.ChatHistory)
+        .filter(
+            models.ChatHistory.document_id == document_id,
+            models.ChatHistory.id <= boundary,
+            models.ChatHistory.timestamp < cutoff,
+        )
+        .order_by(models.ChatHistory.id)
+        .all()
+    )
+    for month, group in groupby(cold, key=lambda m: m.timestamp.strftime("%Y-%m")):
+        messages = list(group)
+        payload = _encode(messages)
+        stats["messages"] += len(messages)
+        stats["segments"] += 1
+        stats["raw_bytes"] += sum(len(m.content.encode("utf-8")) for m in messages)
+        stats["compressed_bytes"] += len(payload)
+        if not dry_run:
+            db.add(models.ChatHistoryArchive(
+                document_id=document_id,
+                month=month,
+                first_id=messages[0].id,
+                last_id=messages[-1].id,
+                message_count=len(messages),
+                payload=payload,
+            ))
+
+    if dry_run or not cold:
+        return stats
+    ids = [m.id for m in cold]
+    for start in range(0, len(ids), _DELETE_BATCH):
+        db.query(models.ChatHistory).filter(models.ChatHistory.id.in_(ids[start:start + _DELETE_BATCH])).delete(synchronize_session=False)
+    db.commit()
+    return stats
+
+
+def archive_all(db: Session, hot_window: int = CHAT_HOT_WINDOW, min_age_days: int = CHAT_ARCHIVE_MIN_AGE_DAYS,
+                dry_run: bool = False) -> List[dict]:
+    """Archives every document that has more than `hot_window` messages."""
+    rows = (
+        db.query(models.ChatHistory.document_id)
+        .group_by(models.ChatHistory.document_id)
+        .having(func.count(models.ChatHistory.id) > hot_window)
+        .all()
+    )
+    document_ids = [row[0] for row in rows]
+    return [archive_document(db, document_id, hot_window, min_age_days, dry_run) for document_id in document_ids]
+
+
+def archived_messages(db: Session, document_id: int, before_id: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
+    """The newest archived messages with id < before_id (up to `limit`), oldest first."""
+    query = db.query(models.ChatHistoryArchive).filter(models.ChatHistoryArchive.document_id == document_id)
+    if before_id is not None:
+        query = query.filter(models.ChatHistoryArchive.first_id < before_id)
+    collected: List[dict] = []
+    for segment in query.order_by(models.ChatHistoryArchive.last_id.desc()).yield_per(8):
+        rows = [row for row in decode_segment(segment) if before_id is None or row["id"] < before_id]
+        collected = rows + collected
+        if limit is not None and len(collected) >= limit:
+            return collected[-limit:]
+    return collected
@@ -0,0 +1,148 @@
+# chat_sessions.py
+"""
+WebSocket chat sessions.
+
+A session authenticates once, when it connects. It then keeps, for the life
+of the connection:
+
+- the document's retriever (FAISS store and BM25 index),
+- the recent conversation, seeded from the stored history,
+- the caller's user id.
+
+Each message therefore costs only retrieval and generation. Answer tokens are
+sent as they are generated. Both turns are written to `chat_history` by a
+background task, so saving them never delays the next question.
+
+Sessions are bounded per node: at most CHAT_WS_MAX_CONNECTIONS are open at
+once, and a session with no message for CHAT_WS_IDLE_SECONDS is closed. A
+session keeps the document version it opened with; reconnect to chat about
+replaced contents.
+"""
+import asyncio
+import os
+import time
+from typing import AsyncIterator, List, Optional
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from . import crud, models, observability
+from .database import SessionLocal
+from .cache import response_cache
+
+CHAT_WS_MAX_CONNECTIONS = int(os.getenv("CHAT_WS_MAX_CONNECTIONS", 200))
+CHAT_WS_IDLE_SECONDS = float(os.getenv("CHAT_WS_IDLE_SECONDS", 300))
+# Messages of conversation kept in memory and sent with each question.
+CHAT_WS_HISTORY_MESSAGES = int(os.getenv("CHAT_WS_HISTORY_MESSAGES", 20))
+
+OPEN_SESSIONS = observability.gauge("studybuddy_chat_sessions", "Open WebSocket chat sessions on this node.")
+SESSION_REJECTIONS = observability.counter("studybuddy_chat_session_rejections_total", "WebSocket chat connections refused.")
+
+_open = 0
+
+
+class SessionLimitReached(Exception):
+    """Raised when this node already holds CHAT_WS_MAX_CONNECTIONS sessions."""
+
+
+def _as_message(row):
+    role, content = (row["role"], row["content"]) if isinstance(row, dict) else (row.role, row.content)
+    return HumanMessage(content=content) if role == "human" else AIMessage(content=content)
+
+
+def _save_turn(document_id: int, user_id: Optional[int], question: str, answer: str):
+    db = SessionLocal()
+    try:
+        db.add_all([
+            models.ChatHistory(document_id=document_id, user_id=user_id, role="human", content=question),
+            models.ChatHistory(document_id=document_id, user_id=user_id, role="ai", content=answer),
+        ])
+        db.commit()
+    finally:
+        db.close()
+    response_cache.invalidate("chat", document_id)
+
+
+class ChatSession:
+    def __init__(self, document: models.Document, user_id: int, retriever, history: List):
+        self.document_id = document.id
+        self.user_id = user_id
+        self.retriever = retriever
+        self.history = history
+        self._writes: asyncio.Queue = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write_history())
+
+    @classmethod
+    async def open(cls, db, document: models.Document, user_id: int) -> "ChatSession":
+        """Claims a session slot and loads the retriever and recent history; call close() when done."""
+        global _open
+        if _open >= CHAT_WS_MAX_CONNECTIONS:
+            SESSION_REJECTIONS.inc(reason="capacity")
+            raise SessionLimitReached()
+        _open += 1
+        OPEN_SESSIONS.set(_open)
+        try:
+            # Loading reads the FAISS and BM25 files (and may build BM25), so it runs off the event loop.
+            retriever, rows = await asyncio.to_thread(cls._load, db, document)
+            return cls(document, user_id, retriever, [_as_message(row) for row in rows])
+        except BaseException:
+            _open -= 1
+            OPEN_SESSIONS.set(_open)
+            raise
+
+    @staticmethod
+    def _load(db, document: models.Document):
+        retriever = crud.load_chat_retriever([document])
+        rows = crud.get_chat_history(db, document.id, limit=CHAT_WS_HISTORY_MESSAGES) if CHAT_WS_HISTORY_MESSAGES else []
+        return retriever, rows
+
+    async def answer(self, question: str) -> AsyncIterator[str]:
+        """Streams the answer to one question and queues both turns for saving."""
+        history = list(self.history)
+        search_query = await crud.search_query_for(question, history)
+        with observability.span("ask.retrieve") as retrieve_span:
+            context_docs = await self.retriever.ainvoke(search_query)
+            retrieve_span.set_attribute("chunks", len(context_docs))
+
+        parts = []
+        # Timed by hand rather than with a span: a span left open across `yield`
+        # would become the current span of whatever the caller runs meanwhile.
+        started = time.perf_counter()
+        try:
+            async for token in crud.qa_chain(question).astream({
+                "context": context_docs,
+                "chat_history": history,
+                "input": question,
+            }):
+                parts.append(token)
+                yield token
+        except Exception:
+            observability.STAGE_ERRORS.inc(stage="ask.generate")
+            raise
+        finally:
+            observability.STAGE_DURATION.observe(time.perf_counter() - started, stage="ask.generate")
+        answer = "".join(parts)
+
+        self.history.extend([HumanMessage(content=question), AIMessage(content=answer)])
+        if len(self.history) > CHAT_WS_HISTORY_MESSAGES:
+            del self.history[:len(self.history) - CHAT_WS_HISTORY_MESSAGES]
+        self._writes.put_nowait((question, answer))
+
+    async def _write_history(self):
+        while True:
+            turn = await self._writes.get()
+            if turn is None:
+                return
+            try:
+                await asyncio.to_thread(_save_turn, self.document_id, self.user_id, *turn)
+            except Exception as e:
+                observability.logger.warning("Could not save chat turn for document %s: %s", self.document_id, e)
+
+    async def close(self):
+        """Flushes queued history writes and frees the session slot."""
+        global _open
+        self._writes.put_nowait(None)
+        try:
+            await asyncio.shield(self._writer)
+        finally:
+            _open -= 1
+            OPEN_SESSIONS.set(_open)
@@ -0,0 +1,172 @@
+# context.py
+"""
+Context assembly for the answer prompt.
+
+Chunks are created with a 200 character overlap, so neighbouring hits repeat
+part of each other's text, and nothing used to cap how much retrieved text was
+pasted into the prompt. The packer below runs between retrieval and the
+stuff-documents chain:
+
+1. chunks whose text overlaps (one ends where the other begins) are merged,
+2. near-duplicates are dropped,
+3. the rest are re-ordered with MMR so the prompt covers different material,
+4. chunks are packed greedily until the token budget is used up.
+
+The default budget is below what the unpacked pipeline sent (the top
+RETRIEVAL_K chunks of about 1000 characters each, roughly 1000 tokens). The
+saving is counted against that baseline, not against the larger candidate
+pool the packer chooses from.
+"""
+import os
+import re
+from typing import List, Optional, Set
+
+from langchain_core.documents import Document as LCDocument
+
+TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 800))
+# How many fused candidates the retriever hands to the packer.
+CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 8))
+# Chunks the prompt held before packing; the baseline the saving is measured against.
+BASELINE_K = int(os.getenv("RETRIEVAL_K", 4))
+MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_NEAR_DUPLICATE_THRESHOLD", 0.8))
+
+MIN_OVERLAP = 40
+MAX_OVERLAP = 400  # a little more than chunk_overlap
+_WORD_RE = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+def _shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _jaccard(a: Set[tuple], b: Set[tuple]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is a prefix of right (0 if short)."""
+    tail = left[-MAX_OVERLAP:]
+    probe = right[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    pos = tail.find(probe)
+    while pos != -1:
+        if right.startswith(tail[pos:]):
+            return len(tail) - pos
+        pos = tail.find(probe, pos + 1)
+    return 0
+
+
+def _same_source(a: LCDocument, b: LCDocument) -> bool:
+    return a.metadata.get("document_id") == b.metadata.get("document_id")
+
+
+def merge_overlapping(docs: List[LCDocument]) -> List[LCDocument]:
+    """Stitches chunks that continue each other into one passage, keeping rank order."""
+    merged: List[LCDocument] = []
+    for doc in docs:
+        text = doc.page_content
+        for i, existing in enumerate(merged):
+            if not _same_source(existing, doc):
+                continue
+            if text in existing.page_content:
+                break
+            after = _overlap(existing.page_content, text)
+            if after:
+                merged[i] = LCDocument(page_content=existing.page_content + text[after:], metadata=existing.metadata)
+                break
+            before = _overlap(text, existing.page_content)
+            if before:
+                merged[i] = LCDocument(page_content=text + existing.page_content[before:], metadata=existing.metadata)
+                break
+        else:
+            merged.append(doc)
+    return merged
+
+
+class ContextPacker:
+    """Turns a ranked list of retrieved chunks into a compact, diverse context."""
+
+    def __init__(
+        self,
+        token_budget: int = TOKEN_BUDGET,
+        mmr_lambda: float = MMR_LAMBDA,
+        duplicate_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+        baseline_k: int = BASELINE_K,
+    ):
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+        self.baseline_k = baseline_k
+        # Running totals, so the saving is visible without a prompt dump.
+        # baseline_tokens is what the top baseline_k chunks would have cost unpacked.
+        self.stats = {"calls": 0, "retrieved_tokens": 0, "baseline_tokens": 0, "packed_tokens": 0}
+
+    def saving(self) -> Optional[float]:
+        """Fraction of the baseline prompt context saved by packing so far."""
+        if not self.stats["baseline_tokens"]:
+            return None
+        return 1 - self.stats["packed_tokens"] / self.stats["baseline_tokens"]
+
+    def _mmr_order(self, docs: List[LCDocument], shingles: List[Set[tuple]]) -> List[int]:
+        # Retrieval rank stands in for query relevance; shingle overlap for redundancy.
+        n = len(docs)
+        relevance = [1.0 - i / n for i in range(n)]
+        remaining = list(range(n))
+        order: List[int] = []
+        while remaining:
+            def score(i):
+                redundancy = max((_jaccard(shingles[i], shingles[j]) for j in order), default=0.0)
+                return self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * redundancy
+            best = max(remaining, key=score)
+            order.append(best)
+            remaining.remove(best)
+        return order
+
+    def pack(self, docs: List[LCDocument], token_budget: Optional[int] = None) -> List[LCDocument]:
+        budget = token_budget or self.token_budget
+        self.stats["calls"] += 1
+        self.stats["retrieved_tokens"] += sum(estimate_tokens(d.page_content) for d in docs)
+        self.stats["baseline_tokens"] += sum(estimate_tokens(d.page_content) for d in docs[:self.baseline_k])
+        if not docs:
+            return []
+
+        candidates = merge_overlapping(docs)
+        shingles = [_shingles(d.page_content) for d in candidates]
+
+        kept, kept_shingles = [], []
+        for doc, doc_shingles in zip(candidates, shingles):
+            if any(_jaccard(doc_shingles, other) >= self.duplicate_threshold for other in kept_shingles):
+                continue
+            kept.append(doc)
+            kept_shingles.append(doc_shingles)
+
+        packed, used = [], 0
+        for i in self._mmr_order(kept, kept_shingles):
+            cost = estimate_tokens(kept[i].page_content)
+            if used + cost > budget:
+                continue  # a smaller passage further down may still fit
+            packed.append(kept[i])
+            used += cost
+        if not packed:
+            # Always send something: the best passage, cut to the budget.
+            best = kept[0]
+            packed = [LCDocument(page_content=best.page_content[: budget * 4], metadata=best.metadata)]
+            used = estimate_tokens(packed[0].page_content)
+
+        self.stats["packed_tokens"] += used
+        return packed
+
+
+default_packer = ContextPacker()
@@ -1,31 +1,65 @@
-from fastapi import HTTPException, UploadFile
-from sqlalchemy.orm import Session
-import shutil, os, random
+from fastapi import HTTPException, UploadFile, BackgroundTasks
+from sqlalchemy.orm import Session, selectinload
+import shutil, os, random, asyncio
+from functools import lru_cache
 from typing import Optional, List
+from datetime import datetime
 from pydantic import BaseModel, Field
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 
-from . import models, schemas, auth
+from . import models, schemas, auth, ingestion, lexical, context, chat_archive, text_store, spooling, spaced_repetition, reembed
+from .database import SessionLocal
 from langchain_core.messages import HumanMessage, AIMessage
 
-import fitz
-import docx
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_google_genai import GoogleGenerativeAI
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
 from langchain.chains.summarize import load_summarize_chain
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from .sharded_store import ShardedVectorStore, MAX_CHUNKS_PER_DOCUMENT
+from .llm_gateway import LLMGateway
+from .observability import logger, span, record_cache
+from .cache import response_cache
+from .doc_cache import document_cache
 
 # --- Model & Directory Initialization ---
-UPLOAD_DIRECTORY = "./uploads"
 VECTOR_STORE_DIRECTORY = "./vector_stores"
-embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-llm = GoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.7)
+# New stores are embedded with this model. Each per-document store records its
+# own model (see reembed.py), so stores built with an earlier one keep working.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+@lru_cache(maxsize=None)
+def _embeddings_for(model_name: str):
+    return embedding_model if model_name == EMBEDDING_MODEL else HuggingFaceEmbeddings(model_name=model_name)
+# Every chain goes through the gateway, which owns retries, so the client itself makes a single attempt.
+llm = LLMGateway(inner=GoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.7, max_retries=1))
+
+# "faiss" keeps one doc_{id} directory per document; "sharded" writes every
+# document into a fixed set of ID-mapped FAISS shards (see sharded_store.py).
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "faiss")
+sharded_store = None
+if VECTOR_STORE_BACKEND == "sharded":
+    sharded_store = ShardedVectorStore(
+        os.path.join(VECTOR_STORE_DIRECTORY, "shards"),
+        embedding_model,
+        num_shards=int(os.getenv("VECTOR_STORE_SHARDS", 64)),
+        max_resident_shards=int(os.getenv("VECTOR_STORE_RESIDENT_SHARDS", 8)),
+    )
+    sharded_store.start_compactor(float(os.getenv("VECTOR_STORE_COMPACT_SECONDS", 300)))
+
+# Merge, de-duplicate and budget retrieved chunks before they reach the prompt (see context.py).
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "true").lower() == "true"
+
+# Fuse dense results with a per-document BM25 index (see lexical.py).
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 4))
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", 20))
 
 # --- Helper functions ---
 def get_user_from_db(db: Session, email: str):
@@ -37,6 +71,217 @@ def get_document_from_db(db: Session, doc_id: int):
         raise HTTPException(status_code=404, detail="Document not found.")
     return document
 
+# --- Vector store helpers ---
+def _vector_store_path(document_id: int):
+    return os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document_id}")
+
+def _bm25_path(document_id: int):
+    if sharded_store is not None:
+        return os.path.join(sharded_store.root, "lexical", f"doc_{document_id}.json.gz")
+    return os.path.join(_vector_store_path(document_id), "bm25.json.gz")
+
+def _all_chunk_texts(document: models.Document, vector_store=None):
+    """Yields (key, text) for every chunk of a document, as keyed in its vector store."""
+    if sharded_store is not None:
+        for vid, content, _ in sharded_store.get_chunk_records(document.id, document.owner_id):
+            yield vid, content
+        return
+    vector_store = vector_store or _cached_faiss(document)
+    for docstore_id in vector_store.index_to_docstore_id.values():
+        yield docstore_id, vector_store.docstore.search(docstore_id).page_content
+
+def _rebuild_lexical_index(document: models.Document, vector_store=None, path: Optional[str] = None):
+    index = lexical.BM25Index()
+    index.add_many(_all_chunk_texts(document, vector_store))
+    index.save(path or _bm25_path(document.id))
+
+def _publish_faiss(document_id: int, vector_store, write_lexical, model_name: str, index_factory: str):
+    """
+    Writes a document's store, BM25 index and manifest to a new generation
+    directory and swaps it in (see reembed.swap_store). Other workers load
+    either the old store or the new one, never a mix of the two.
+    """
+    generation = reembed.new_generation_path(VECTOR_STORE_DIRECTORY, document_id)
+    try:
+        vector_store.save_local(generation)
+        write_lexical(os.path.join(generation, "bm25.json.gz"))
+        reembed.write_manifest(generation, model_name, index_factory, vector_store.index.d, vector_store.index.ntotal)
+        previous = reembed.swap_store(_vector_store_path(document_id), generation)
+    except BaseException:
+        shutil.rmtree(generation, ignore_errors=True)
+        raise
+    if previous:
+        shutil.rmtree(previous, ignore_errors=True)
+
+class VectorStoreWriter:
+    """Accumulates embedded chunk batches for one document in the configured backend."""
+
+    def __init__(self, document: models.Document, start_index: int = 0):
+        self.document = document
+        self.count = 0
+        # Sharded chunk ids start here, so new chunks can sit next to ones that are still live.
+        self.start_index = start_index
+        self.keys = []
+        self._faiss_store = None
+        self._lexical = lexical.BM25Index()
+        # Files that commit() wrote where none existed, so abort() can remove them.
+        self._created_paths = []
+
+    def add(self, chunks: List[str], vectors: List[List[float]], metadatas: Optional[List[dict]] = None):
+        metadatas = [{**(meta or {}), "document_id": self.document.id} for meta in (metadatas or [{}] * len(chunks))]
+        if sharded_store is not None:
+            keys = sharded_store.add_texts(
+                self.document.id, self.document.owner_id, chunks, metadatas,
+                embeddings=vectors, start_index=self.start_index + self.count,
+            )
+        elif self._faiss_store is None:
+            self._faiss_store = FAISS.from_embeddings(list(zip(chunks, vectors)), embedding_model, metadatas=metadatas)
+            keys = list(self._faiss_store.index_to_docstore_id.values())
+        else:
+            keys = self._faiss_store.add_embeddings(list(zip(chunks, vectors)), metadatas=metadatas)
+        self._lexical.add_many(zip(keys, chunks))
+        self.keys.extend(keys)
+        self.count += len(chunks)
+
+    def commit(self):
+        self._created_paths = [
+            path for path in (_vector_store_path(self.document.id), _bm25_path(self.document.id))
+            if not os.path.lexists(path)
+        ]
+        if sharded_store is not None:
+            sharded_store.flush(self.document.id, self.document.owner_id)
+            self._lexical.save(_bm25_path(self.document.id))
+        elif self._faiss_store is not None:
+            _publish_faiss(
+                self.document.id, self._faiss_store, self._lexical.save, EMBEDDING_MODEL, reembed.DEFAULT_INDEX_FACTORY,
+            )
+
+    def abort(self):
+        if sharded_store is not None and self.count:
+            if self.start_index:
+                sharded_store.remove_ids(self.document.id, self.document.owner_id, self.keys)
+            else:
+                sharded_store.remove_document(self.document.id, self.document.owner_id)
+        # A new document's files are removed if the upload fails after commit(); its id may be reused.
+        for path in self._created_paths:
+            if os.path.isdir(path) or os.path.islink(path):
+                reembed.remove_store(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self._created_paths = []
+        self._faiss_store = None
+
+def _load_faiss(document: models.Document, attempts: int = 2):
+    vector_store_path = _vector_store_path(document.id)
+    if not os.path.exists(vector_store_path):
+        raise HTTPException(status_code=404, detail="Vector store not found.")
+    # Every file is read from the generation the link pointed at when loading started.
+    generation = os.path.realpath(vector_store_path)
+    try:
+        # Queries are embedded with the model the store was built with; stores without a manifest predate reembed.
+        manifest = reembed.read_manifest(generation)
+        embeddings = _embeddings_for(manifest["model"]) if manifest else embedding_model
+        return FAISS.load_local(generation, embeddings, allow_dangerous_deserialization=True)
+    except FileNotFoundError:
+        # Replaced and deleted while loading; the link now points at its successor.
+        if attempts <= 1:
+            raise
+        return _load_faiss(document, attempts - 1)
+
+def _cached_faiss(document: models.Document):
+    """Read-only FAISS store for a document, reused until its version changes."""
+    return document_cache.get_or_load(document, "faiss", lambda: _load_faiss(document))
+
+def _load_lexical(document: models.Document, vector_store=None):
+    # Stores created before hybrid retrieval get their BM25 index on first use.
+    return document_cache.get_or_load(
+        document, "bm25",
+        lambda: lexical.load_or_build(_bm25_path(document.id), lambda: _all_chunk_texts(document, vector_store)),
+    )
+
+def load_retriever(documents: List[models.Document], k: int = RETRIEVAL_K):
+    """Returns one retriever covering all of the given documents."""
+    if sharded_store is not None:
+        # Each document is searched in its own owner's shard.
+        owners = {doc.id: doc.owner_id for doc in documents}
+        for doc in documents:
+            if not sharded_store.has_document(doc.id, doc.owner_id):
+                raise HTTPException(status_code=404, detail="Vector store not found.")
+        if not HYBRID_RETRIEVAL:
+            return sharded_store.as_retriever(owners, k=k)
+        dense = sharded_store.as_retriever(owners, k=RETRIEVAL_FETCH_K)
+        resolve = lambda keys: sharded_store.get_by_ids(keys, owners)
+        lexical_indexes = [(_load_lexical(doc), resolve) for doc in documents]
+    else:
+        stores = [_cached_faiss(doc) for doc in documents]
+        indexes = [_load_lexical(doc, store) for doc, store in zip(documents, stores)] if HYBRID_RETRIEVAL else []
+        vector_store = stores[0]
+        if any(store.embedding_function is not vector_store.embedding_function for store in stores[1:]):
+            # Vectors of different models cannot share one index; see reembed.py.
+            raise HTTPException(status_code=503, detail="These documents are being re-embedded; try again when it has finished.")
+        if len(stores) > 1:
+            # merge_from mutates its target, so merge into a fresh copy, never a cached store.
+            vector_store = _load_faiss(documents[0])
+            for other in stores[1:]:
+                vector_store.merge_from(other)
+        if not HYBRID_RETRIEVAL:
+            return vector_store.as_retriever(search_kwargs={"k": k})
+        dense = vector_store.as_retriever(search_kwargs={"k": RETRIEVAL_FETCH_K})
+
+        def resolve(keys):
+            found = [vector_store.docstore.search(key) for key in keys]
+            return [doc if not isinstance(doc, str) else None for doc in found]
+        lexical_indexes = [(index, resolve) for index in indexes]
+
+    return lexical.HybridRetriever(dense=dense, lexical=lexical_indexes, k=k, fetch_k=max(k, RETRIEVAL_FETCH_K))
+
+def load_document_chunks(document: models.Document, k: int):
+    """Returns up to k chunks of a document for whole-document tasks."""
+    if sharded_store is not None:
+        docs = sharded_store.get_chunks(document.id, document.owner_id, limit=k)
+        if not docs and not sharded_store.has_document(document.id, document.owner_id):
+            raise HTTPException(status_code=404, detail="Vector store not found.")
+        return docs
+    return _cached_faiss(document).similarity_search("", k=k)
+
+def _lock_text(db: Session, content_hash: str):
+    """
+    Locks a text store entry's row until the transaction ends, creating it if
+    needed. Uploads hold it from publishing the text until the document row
+    refers to it, so a concurrent release cannot delete the text in between.
+    """
+    # An UPDATE takes the row lock (the database lock on SQLite); a plain SELECT would not.
+    locked = db.query(models.StoredText).filter(models.StoredText.content_hash == content_hash).update(
+        {models.StoredText.content_hash: content_hash}, synchronize_session=False
+    )
+    if locked:
+        return
+    try:
+        with db.begin_nested():
+            db.add(models.StoredText(content_hash=content_hash))
+    except IntegrityError:
+        # Created by a concurrent upload meanwhile; wait for it instead.
+        _lock_text(db, content_hash)
+
+def _release_text(db: Session, content_hash: Optional[str]):
+    """Deletes a stored text once no document refers to it (identical uploads share one copy)."""
+    if not content_hash:
+        return
+    _lock_text(db, content_hash)
+    if not db.query(models.Document.id).filter(models.Document.content_hash == content_hash).first():
+        text_store.remove(content_hash)
+        db.query(models.StoredText).filter(models.StoredText.content_hash == content_hash).delete(synchronize_session=False)
+    db.commit()
+
+def remove_document_vectors(document: models.Document):
+    if sharded_store is not None:
+        sharded_store.remove_document(document.id, document.owner_id)
+        if os.path.exists(_bm25_path(document.id)):
+            os.remove(_bm25_path(document.id))
+        return
+    # Re-embedded stores are symlinks to a generation directory (see reembed.py).
+    reembed.remove_store(_vector_store_path(document.id))
+
 
 async def create_document(db: Session, file: UploadFile, user: Optional[dict]):
     owner_id = None
@@ -45,37 +290,318 @@ async def create_document(db: Session, file: UploadFile, user: Optional[dict]):
         if db_user:
             owner_id = db_user.id
 
-    temp_file_path = os.path.join(UPLOAD_DIRECTORY, file.filename)
+    upload = None
     try:
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        full_text = ""
-        if file.content_type == "application/pdf":
-            doc = fitz.open(temp_file_path)
-            full_text = "".join(page.get_text() for page in doc)
-        else:
-            full_text = "\n".join([p.text for p in docx.Document(temp_file_path).paragraphs])
-
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_text(full_text)
-        if not chunks:
-            raise ValueError("Document could not be chunked.")
-            
-        vector_store = FAISS.from_texts(chunks, embedding_model)
+        with span("upload.spool"):
+            upload = await spooling.spool_upload(file)
 
+        # The row is committed first so chunks can be written under its id while
+        # pages are still being extracted, without holding a transaction open
+        # for the whole run. It is deleted again if ingestion fails.
         db_document = models.Document(filename=file.filename, owner_id=owner_id)
         db.add(db_document)
         db.commit()
-        db.refresh(db_document)
-        
-        vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{db_document.id}")
-        vector_store.save_local(vector_store_path)
+        document_id = db_document.id
+
+        writer = VectorStoreWriter(db_document)
+        recorder = text_store.TextRecorder()
+        try:
+            with span("upload.ingest") as ingest_span:
+                pages = recorder.record(ingestion.iter_page_texts(upload.source, upload.content_type))
+                async for chunks, metadatas, vectors in ingestion.iter_embedded_batches(pages, embedding_model):
+                    writer.add(chunks, vectors, metadatas)
+                ingest_span.set_attribute("chunks", writer.count)
+            if writer.count == 0:
+                raise ValueError("Document could not be chunked.")
+            with span("upload.commit"):
+                writer.commit()
+                _lock_text(db, recorder.content_hash)
+                db_document.content_hash = recorder.commit()
+                db.commit()
+        except BaseException:
+            writer.abort()
+            recorder.discard()
+            db.rollback()
+            _discard_documents(db, [document_id])
+            raise
+        response_cache.invalidate("documents", owner_id)
 
+        db.refresh(db_document)
         return db_document
     finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        if upload is not None:
+            upload.cleanup()
+
+def _discard_documents(db: Session, document_ids: List[int]):
+    """Deletes the rows committed ahead of ingestions that then failed."""
+    if document_ids:
+        db.query(models.Document).filter(models.Document.id.in_(document_ids)).delete(synchronize_session=False)
+        db.commit()
+
+# --- Batch upload ---
+BATCH_UPLOAD_MAX_FILES = int(os.getenv("BATCH_UPLOAD_MAX_FILES", 50))
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv("BATCH_UPLOAD_CONCURRENCY", 4))
+
+async def create_documents_batch(db: Session, files: List[UploadFile], user: Optional[dict]):
+    """
+    Ingests several files concurrently, pooling their chunks into shared
+    embedding batches. The Document rows are committed before ingestion starts,
+    and the rows of files that fail are deleted afterwards. Each failure is
+    reported in its result; the rest of the files still go in.
+    """
+    if len(files) > BATCH_UPLOAD_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_UPLOAD_MAX_FILES} files per batch.")
+    owner_id = None
+    if user:
+        db_user = get_user_from_db(db, user["email"])
+        if db_user:
+            owner_id = db_user.id
+
+    uploads: List[Optional[spooling.SpooledUpload]] = [None] * len(files)
+    documents = [models.Document(filename=file.filename, owner_id=owner_id) for file in files]
+    writers = [VectorStoreWriter(document) for document in documents]
+    recorders = [text_store.TextRecorder() for _ in files]
+    results = [{"filename": file.filename, "status": "ok", "document": None, "detail": None} for file in files]
+    batcher = ingestion.SharedEmbeddingBatcher(embedding_model)
+    semaphore = asyncio.Semaphore(BATCH_UPLOAD_CONCURRENCY)
+
+    async def ingest(i: int):
+        async with semaphore:
+            try:
+                with span("upload.spool", filename=files[i].filename):
+                    uploads[i] = await spooling.spool_upload(files[i])
+                with span("upload.ingest", filename=files[i].filename) as ingest_span:
+                    pages = recorders[i].record(ingestion.iter_page_texts(uploads[i].source, uploads[i].content_type))
+                    async for chunks, metadatas, vectors in ingestion.iter_embedded_batches(pages, embedding_model, embed=batcher.embed):
+                        writers[i].add(chunks, vectors, metadatas)
+                    ingest_span.set_attribute("chunks", writers[i].count)
+                if writers[i].count == 0:
+                    raise ValueError("Document could not be chunked.")
+                writers[i].commit()
+                _lock_text(db, recorders[i].content_hash)
+                documents[i].content_hash = recorders[i].commit()
+            except Exception as e:
+                logger.warning("Batch upload failed for %s: %s", files[i].filename, e)
+                writers[i].abort()
+                recorders[i].discard()
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                results[i].update(status="error", detail=detail or type(e).__name__)
+
+    try:
+        # Committed up front so every file's chunks can be written under its document id,
+        # with no transaction held open while the files are ingested.
+        db.add_all(documents)
+        db.commit()
+        document_ids = [document.id for document in documents]
+        try:
+            await asyncio.gather(*(ingest(i) for i in range(len(files))))
+            with span("upload.commit"):
+                db.commit()
+            _discard_documents(db, [i for i, result in zip(document_ids, results) if result["status"] != "ok"])
+        except BaseException:
+            for writer, recorder in zip(writers, recorders):
+                writer.abort()
+                recorder.discard()
+            db.rollback()
+            _discard_documents(db, document_ids)
+            raise
+        response_cache.invalidate("documents", owner_id)
+    finally:
+        for upload in uploads:
+            if upload is not None:
+                upload.cleanup()
+
+    for document, result in zip(documents, results):
+        if result["status"] == "ok":
+            db.refresh(document)
+            result["document"] = document
+    succeeded = sum(result["status"] == "ok" for result in results)
+    return {"documents": results, "succeeded": succeeded, "failed": len(results) - succeeded, "embedding_batches": batcher.batches}
+
+def _index_chunks_by_hash(document: models.Document):
+    """Maps content hash -> keys of the existing chunks of a document in its vector store."""
+    by_hash = {}
+    if sharded_store is not None:
+        for vid, content, metadata in sharded_store.get_chunk_records(document.id, document.owner_id):
+            content_hash = metadata.get("content_hash") or ingestion.chunk_hash(content)
+            by_hash.setdefault(content_hash, []).append(vid)
+        return by_hash, None
+
+    vector_store = _load_faiss(document)
+    for docstore_id in vector_store.index_to_docstore_id.values():
+        chunk = vector_store.docstore.search(docstore_id)
+        content_hash = chunk.metadata.get("content_hash") or ingestion.chunk_hash(chunk.page_content)
+        by_hash.setdefault(content_hash, []).append(docstore_id)
+    return by_hash, vector_store
+
+async def replace_document_contents(
+    db: Session, document_id: int, file: UploadFile, user_id: int, background_tasks: Optional[BackgroundTasks] = None
+):
+    """
+    Re-indexes a document from a new upload while keeping its id and history.
+    Only chunks whose content hash is new are embedded; stale vectors are removed.
+    The question bank is cleared and, given `background_tasks`, refilled.
+    """
+    document = db.query(models.Document).filter(models.Document.id == document_id, models.Document.owner_id == user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+
+    upload = await spooling.spool_upload(file)
+    new_chunks = {}  # content hash -> (text, metadata), first occurrence wins
+    recorder = text_store.TextRecorder()
+    try:
+        try:
+            pages = recorder.record(ingestion.iter_page_texts(upload.source, upload.content_type))
+            async for text, metadata in ingestion.iter_chunks(pages):
+                new_chunks.setdefault(metadata["content_hash"], (text, metadata))
+            if not new_chunks:
+                raise HTTPException(status_code=422, detail="Document could not be chunked.")
+        finally:
+            upload.cleanup()
+
+        existing, vector_store = _index_chunks_by_hash(document)
+
+        stale_keys, kept = [], {}
+        for chunk_hash, keys in existing.items():
+            if chunk_hash in new_chunks:
+                kept[keys[0]] = new_chunks[chunk_hash][1]
+                stale_keys.extend(keys[1:])
+            else:
+                stale_keys.extend(keys)
+        added = [chunk for chunk_hash, chunk in new_chunks.items() if chunk_hash not in existing]
+
+        texts = [text for text, _ in added]
+        metadatas = [metadata for _, metadata in added]
+        # New chunks must match the store's model, which a re-embed may have changed.
+        embeddings = vector_store.embedding_function if vector_store is not None else embedding_model
+        vectors = await ingestion.embed_in_batches(texts, embeddings)
+
+        if sharded_store is not None:
+            next_index = max((key & (MAX_CHUNKS_PER_DOCUMENT - 1) for keys in existing.values() for key in keys), default=-1) + 1
+            sharded_store.remove_ids(document.id, document.owner_id, stale_keys)
+            # Page numbers of unchanged chunks may have shifted.
+            sharded_store.update_metadata(document.id, document.owner_id, kept)
+            sharded_store.add_texts(document.id, document.owner_id, texts, metadatas, embeddings=vectors, start_index=next_index)
+            sharded_store.flush(document.id, document.owner_id)
+            _rebuild_lexical_index(document)
+        else:
+            if stale_keys:
+                vector_store.delete(stale_keys)
+            for docstore_id, metadata in kept.items():
+                vector_store.docstore.search(docstore_id).metadata = metadata
+            if texts:
+                vector_store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+            manifest = reembed.read_manifest(os.path.realpath(_vector_store_path(document.id))) or {}
+            _publish_faiss(
+                document.id, vector_store, lambda path: _rebuild_lexical_index(document, vector_store, path),
+                manifest.get("model", EMBEDDING_MODEL), manifest.get("index_factory", reembed.DEFAULT_INDEX_FACTORY),
+            )
+
+        # Stored only once the new vectors are written, so a failed replace leaves no text behind.
+        _lock_text(db, recorder.content_hash)
+        content_hash = recorder.commit()
+    except BaseException:
+        recorder.discard()
+        raise
+
+    document.filename = file.filename
+    previous_hash, document.content_hash = document.content_hash, content_hash
+    # Other workers compare their cached stores against this and reload.
+    document.version = models.Document.version + 1
+    _clear_question_bank(db, document.id)
+    db.commit()
+    if previous_hash != content_hash:
+        _release_text(db, previous_hash)
+    document_cache.evict(document.id)
+    if background_tasks is not None:
+        background_tasks.add_task(refill_question_bank, document.id)
+    response_cache.invalidate("documents", document.owner_id)
+    db.refresh(document)
+    return {
+        "id": document.id,
+        "filename": document.filename,
+        "owner_id": document.owner_id,
+        "chunks_added": len(added),
+        "chunks_removed": len(stale_keys),
+        "chunks_unchanged": len(kept),
+    }
+
+async def rechunk_document(
+    db: Session,
+    document: models.Document,
+    chunk_size: int = ingestion.CHUNK_SIZE,
+    chunk_overlap: int = ingestion.CHUNK_OVERLAP,
+    background_tasks: Optional[BackgroundTasks] = None,
+):
+    """
+    Re-chunks and re-embeds a document from its stored text (see text_store.py),
+    without the source file. The new index is written before the old one is
+    dropped, so searches keep working while this runs. The question bank is
+    cleared and, given `background_tasks`, refilled.
+    """
+    if not text_store.exists(document.content_hash):
+        raise HTTPException(status_code=404, detail="No stored text for this document; upload it again to enable re-chunking.")
+
+    old_keys, start_index = [], 0
+    if sharded_store is not None:
+        old_keys = [vid for vid, _, _ in sharded_store.get_chunk_records(document.id, document.owner_id)]
+        start_index = max((key & (MAX_CHUNKS_PER_DOCUMENT - 1) for key in old_keys), default=-1) + 1
+        chunks_before = len(old_keys)
+    else:
+        chunks_before = _cached_faiss(document).index.ntotal if os.path.exists(_vector_store_path(document.id)) else 0
+
+    writer = VectorStoreWriter(document, start_index=start_index)
+    chunker = ingestion.IncrementalChunker(chunk_size, chunk_overlap)
+    try:
+        with span("rechunk", document_id=document.id) as rechunk_span:
+            pages = text_store.aiter_pages(document.content_hash)
+            async for chunks, metadatas, vectors in ingestion.iter_embedded_batches(pages, embedding_model, chunker=chunker):
+                writer.add(chunks, vectors, metadatas)
+            rechunk_span.set_attribute("chunks", writer.count)
+        if writer.count == 0:
+            raise ValueError("Document could not be chunked.")
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    if sharded_store is not None:
+        sharded_store.remove_ids(document.id, document.owner_id, old_keys)
+        sharded_store.flush(document.id, document.owner_id)
+
+    document.version = models.Document.version + 1
+    _clear_question_bank(db, document.id)
+    db.commit()
+    document_cache.evict(document.id)
+    if background_tasks is not None:
+        background_tasks.add_task(refill_question_bank, document.id)
+    return {"document_id": document.id, "chunks_before": chunks_before, "chunks_after": writer.count}
+
+# --- Version stamps (ETags) ---
+# One aggregate query per resource; inserts and deletes both change the result.
+def _aggregate_stamp(db: Session, id_column, timestamp_column, *filters):
+    row = db.query(func.count(id_column), func.max(id_column), func.max(timestamp_column)).filter(*filters).one()
+    return tuple(row)
+
+def documents_stamp(db: Session, user_id: int):
+    # Documents can be renamed by a content replace, so include the filenames.
+    return tuple(db.query(models.Document.id, models.Document.filename).filter(models.Document.owner_id == user_id).order_by(models.Document.id).all())
+
+def chat_history_stamp(db: Session, document_id: int):
+    hot = _aggregate_stamp(db, models.ChatHistory.id, models.ChatHistory.timestamp, models.ChatHistory.document_id == document_id)
+    archived = _aggregate_stamp(db, models.ChatHistoryArchive.id, models.ChatHistoryArchive.created_at, models.ChatHistoryArchive.document_id == document_id)
+    return hot + archived
+
+def quiz_history_stamp(db: Session, user_id: int, document_id: int):
+    return _aggregate_stamp(
+        db, models.QuizAttempt.id, models.QuizAttempt.timestamp,
+        models.QuizAttempt.user_id == user_id, models.QuizAttempt.document_id == document_id,
+    )
+
+def flashcard_sets_stamp(db: Session, user_id: int, document_id: int):
+    return _aggregate_stamp(
+        db, models.FlashcardSet.id, models.FlashcardSet.timestamp,
+        models.FlashcardSet.user_id == user_id, models.FlashcardSet.document_id == document_id,
+    )
 
 def get_user_documents(db: Session, user_email: str):
     user = get_user_from_db(db, user_email)
@@ -83,8 +609,95 @@ def get_user_documents(db: Session, user_email: str):
         raise HTTPException(status_code=404, detail="User not found")
     return db.query(models.Document).filter(models.Document.owner_id == user.id).all()
 
-def get_chat_history(db: Session, document_id: int):
-    return db.query(models.ChatHistory).filter(models.ChatHistory.document_id == document_id).order_by(models.ChatHistory.timestamp).all()
+# --- Library search ---
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", 8))
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", 300))
+
+def _snippet(text: str, query: str) -> str:
+    """A window of the chunk around the first query term found in it, else its start."""
+    text = " ".join(text.split())
+    if len(text) <= SEARCH_SNIPPET_CHARS:
+        return text
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in lexical.tokenize(query) if len(term) > 2]
+    hit = min((pos for pos in positions if pos >= 0), default=0)
+    start = max(0, min(hit - SEARCH_SNIPPET_CHARS // 3, len(text) - SEARCH_SNIPPET_CHARS))
+    snippet = text[start:start + SEARCH_SNIPPET_CHARS]
+    return ("…" if start else "") + snippet + ("…" if start + SEARCH_SNIPPET_CHARS < len(text) else "")
+
+async def search_library(db: Session, user_email: str, query: str, k: int = 10):
+    """
+    Semantic search over all of a user's documents. The query is embedded once per model.
+    With the sharded backend it is one filtered search; otherwise each document's
+    store is searched concurrently (SEARCH_CONCURRENCY at a time) and the hits
+    are merged by distance.
+    """
+    documents = get_user_documents(db, user_email)
+    if not documents:
+        return {"query": query, "results": [], "documents_searched": 0}
+    filenames = {doc.id: doc.filename for doc in documents}
+
+    with span("search.embed"):
+        vector = await asyncio.to_thread(embedding_model.embed_query, query)
+
+    with span("search.retrieve", documents=len(documents)):
+        if sharded_store is not None:
+            found = await asyncio.to_thread(
+                sharded_store.similarity_search_with_score_by_vector, vector, k, {doc.id: doc.owner_id for doc in documents}
+            )
+            hits = [(chunk, distance, chunk.metadata.get("document_id")) for chunk, distance in found]
+        else:
+            semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+            def search_one(document: models.Document):
+                try:
+                    store = _cached_faiss(document)
+                except HTTPException:
+                    return []  # no vector store on disk
+                if store.embedding_function is embedding_model:
+                    found = store.similarity_search_with_score_by_vector(vector, k=k)
+                else:
+                    # Built with another model, e.g. part-way through a re-embed; its queries need that model.
+                    found = store.similarity_search_with_score(query, k=k)
+                # Tagged here: chunks of stores from before document_id metadata lack it.
+                return [(chunk, distance, document.id) for chunk, distance in found]
+
+            async def bounded(document: models.Document):
+                async with semaphore:
+                    return await asyncio.to_thread(search_one, document)
+
+            per_document = await asyncio.gather(*(bounded(doc) for doc in documents))
+            hits = sorted((hit for found in per_document for hit in found), key=lambda pair: pair[1])[:k]
+
+    results = []
+    for chunk, distance, document_id in hits:
+        results.append({
+            "document_id": document_id,
+            "filename": filenames.get(document_id),
+            "page": chunk.metadata.get("page"),
+            "page_end": chunk.metadata.get("page_end"),
+            "score": float(distance),
+            "snippet": _snippet(chunk.page_content, query),
+        })
+    return {"query": query, "results": results, "documents_searched": len(documents)}
+
+def get_chat_history(db: Session, document_id: int, before_id: Optional[int] = None, limit: Optional[int] = None):
+    """
+    Messages oldest first. With `limit`, returns the newest `limit` messages
+    older than `before_id`, reading from the archive once the hot table runs out.
+    """
+    query = db.query(models.ChatHistory).filter(models.ChatHistory.document_id == document_id)
+    if before_id is not None:
+        query = query.filter(models.ChatHistory.id < before_id)
+    query = query.order_by(models.ChatHistory.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    messages = list(reversed(query.all()))
+    if limit is None or len(messages) < limit:
+        oldest = messages[0].id if messages else before_id
+        remaining = None if limit is None else limit - len(messages)
+        messages = chat_archive.archived_messages(db, document_id, before_id=oldest, limit=remaining) + messages
+    return messages
 
 def create_chat_message(db: Session, document_id: int, role: str, content: str, user_id: Optional[int] = None):
     db_message = models.ChatHistory(
@@ -95,26 +708,12 @@ def create_chat_message(db: Session, document_id: int, role: str, content: str,
     )
     db.add(db_message)
     db.commit()
+    response_cache.invalidate("chat", document_id)
     db.refresh(db_message)
     return db_message
 
-async def get_answer(db: Session, request: schemas.AskRequest, user: Optional[dict]):
-    document = get_document_from_db(db, request.document_id)
-    vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document.id}")
-    if not os.path.exists(vector_store_path):
-        raise HTTPException(status_code=404, detail="Vector store not found.")
-    
-    vector_store = FAISS.load_local(
-        vector_store_path, embedding_model, allow_dangerous_deserialization=True
-    )
-    retriever = vector_store.as_retriever()
-
-    chat_history_messages = [
-        HumanMessage(content=msg.content) if msg.role == "human" else AIMessage(content=msg.content)
-        for msg in request.chat_history or []
-    ]
-
-    base_persona = """
+# --- Chat ---
+CHAT_PERSONA = """
     You are the AI Study Buddy, an expert tutor. Your primary goal is to help a user understand the provided context by explaining it clearly and conversationally.
 
 **CRITICAL FORMATTING RULES:**
@@ -142,60 +741,105 @@ async def get_answer(db: Session, request: schemas.AskRequest, user: Optional[di
     If applicable, explain any relevant formulas or technical terms mentioned in the text.
     
 """
-    user_question_lower = request.question.lower()
-    
+
+_CONTEXTUALIZE_Q_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Given a chat history... reformulate it if needed..."),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}")
+])
+# Built once per detail level instead of on every question.
+_qa_chains = {}
+_reformulate_chain = None
+
+def _detail_instruction(question: str) -> str:
+    user_question_lower = question.lower()
     if any(kw in user_question_lower for kw in ["in detail", "detailed", "elaborate"]):
-        detail_instruction = "Give a long, detailed explanation..."
+        return "Give a long, detailed explanation..."
     elif any(kw in user_question_lower for kw in ["in depth", "explain", "describe"]):
-        detail_instruction = "Provide a thorough, multi-paragraph explanation..."
-    else:
-        detail_instruction = "Keep the answer concise..."
-
-    qa_system_prompt = f"{base_persona}\n\n{detail_instruction}\n\n{{context}}"
-
-    contextualize_q_prompt = ChatPromptTemplate.from_messages([
-        ("system", "Given a chat history... reformulate it if needed..."),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}")
-    ])
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
-
-    qa_prompt = ChatPromptTemplate.from_messages([
-        ("system", qa_system_prompt),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}")
-    ])
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
-
-    response = await rag_chain.ainvoke({
-        "chat_history": chat_history_messages,
-        "input": request.question
-    })
-
-    user_id = None
-    if user:
-        db_user = get_user_from_db(db, user["email"])
-        if db_user:
-            user_id = db_user.id
+        return "Provide a thorough, multi-paragraph explanation..."
+    return "Keep the answer concise..."
+
+def qa_chain(question: str):
+    detail_instruction = _detail_instruction(question)
+    if detail_instruction not in _qa_chains:
+        qa_system_prompt = f"{CHAT_PERSONA}\n\n{detail_instruction}\n\n{{context}}"
+        qa_prompt = ChatPromptTemplate.from_messages([
+            ("system", qa_system_prompt),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}")
+        ])
+        _qa_chains[detail_instruction] = create_stuff_documents_chain(llm, qa_prompt)
+    return _qa_chains[detail_instruction]
+
+def reformulate_chain():
+    global _reformulate_chain
+    if _reformulate_chain is None:
+        _reformulate_chain = _CONTEXTUALIZE_Q_PROMPT | llm | StrOutputParser()
+    return _reformulate_chain
+
+def load_chat_retriever(documents: List[models.Document]):
+    with span("ask.load_retriever", documents=len(documents)):
+        if CONTEXT_PACKING:
+            return load_retriever(documents, k=context.CANDIDATES) | RunnableLambda(context.default_packer.pack)
+        return load_retriever(documents)
+
+async def search_query_for(question: str, chat_history_messages: list) -> str:
+    # Same steps as create_history_aware_retriever + create_retrieval_chain,
+    # run one by one so each stage gets its own span.
+    with span("ask.reformulate", history_messages=len(chat_history_messages)):
+        if chat_history_messages:
+            return await reformulate_chain().ainvoke({"chat_history": chat_history_messages, "input": question})
+        return question
 
-    create_chat_message(db, document.id, "human", request.question, user_id)
-    create_chat_message(db, document.id, "ai", response["answer"], user_id)
+async def get_answer(db: Session, request: schemas.AskRequest, user: Optional[dict]):
+    if not request.document_ids:
+        raise HTTPException(status_code=422, detail="At least one document id is required.")
+    documents = [get_document_from_db(db, doc_id) for doc_id in request.document_ids]
+    # History is recorded against the first document of the selection.
+    document = documents[0]
+    retriever = load_chat_retriever(documents)
 
-    return {"answer": response["answer"]}
+    chat_history_messages = [
+        HumanMessage(content=msg.content) if msg.role == "human" else AIMessage(content=msg.content)
+        for msg in request.chat_history or []
+    ]
+
+    search_query = await search_query_for(request.question, chat_history_messages)
+
+    with span("ask.retrieve") as retrieve_span:
+        context_docs = await retriever.ainvoke(search_query)
+        retrieve_span.set_attribute("chunks", len(context_docs))
+
+    with span("ask.generate"):
+        answer = await qa_chain(request.question).ainvoke({
+            "context": context_docs,
+            "chat_history": chat_history_messages,
+            "input": request.question
+        })
+
+    with span("ask.save_history"):
+        user_id = None
+        if user:
+            db_user = get_user_from_db(db, user["email"])
+            if db_user:
+                user_id = db_user.id
+
+        create_chat_message(db, document.id, "human", request.question, user_id)
+        create_chat_message(db, document.id, "ai", answer, user_id)
+
+    return {"answer": answer}
 
 
 
 async def get_summary(db: Session, request: schemas.DocumentRequest):
     document = get_document_from_db(db, request.document_id)
-    vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document.id}")
-    if not os.path.exists(vector_store_path):
-        raise HTTPException(status_code=404, detail="Vector store not found.")
+    # Kept per document version, so replacing the file (on any worker) regenerates it.
+    summary = await document_cache.aget_or_load(document, "summary", lambda: _generate_summary(document))
+    return {"summary": summary}
 
-    vector_store = FAISS.load_local(
-        vector_store_path, embedding_model, allow_dangerous_deserialization=True
-    )
-    docs = vector_store.similarity_search("", k=50)
+async def _generate_summary(document: models.Document):
+    with span("summary.load_chunks"):
+        docs = load_document_chunks(document, k=50)
     if not docs:
         raise HTTPException(status_code=404, detail="No content to summarize.")
 
@@ -216,19 +860,15 @@ SUMMARY:
     )
 
     chain = summary_prompt | llm
-    summary = await chain.ainvoke({"text": full_text})
-
-    return {"summary": summary}
+    with span("summary.generate"):
+        return await chain.ainvoke({"text": full_text})
 
 
 
-async def create_quiz(db: Session, request: schemas.DocumentRequest):
-    document = get_document_from_db(db, request.document_id)
-    vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document.id}")
-    if not os.path.exists(vector_store_path): raise HTTPException(status_code=404, detail="Vector store not found.")
-
-    vector_store = FAISS.load_local(vector_store_path, embedding_model, allow_dangerous_deserialization=True)
-    all_docs = vector_store.similarity_search("", k=100)
+async def _generate_quiz_questions(document: models.Document):
+    """Runs one LLM generation of a 5-question quiz over a random sample of the document."""
+    with span("quiz.load_chunks"):
+        all_docs = load_document_chunks(document, k=100)
     if not all_docs: raise HTTPException(status_code=404, detail="No content to create quiz from.")
     
     random.shuffle(all_docs)
@@ -262,40 +902,255 @@ Now generate the quiz.
 )
 
     chain = prompt | llm | parser
-    quiz_data = await chain.ainvoke({"context": full_context})
-    return quiz_data
+    with span("quiz.generate"):
+        quiz_data = await chain.ainvoke({"context": full_context})
+    return [q for q in quiz_data.get("questions", []) if q.get("correct_answer") in q.get("options", [])]
+
+# --- Quiz question bank ---
+QUIZ_SIZE = 5
+QUESTION_BANK_TARGET = int(os.getenv("QUESTION_BANK_TARGET", 40))
+# Refill once fewer than this many questions are unseen by the requesting user.
+QUESTION_BANK_LOW_WATER = int(os.getenv("QUESTION_BANK_LOW_WATER", 15))
+# Questions among a user's most recently served ones are not repeated.
+QUESTION_BANK_RECENT = int(os.getenv("QUESTION_BANK_RECENT", 20))
+_refilling_banks = set()
+
+def _normalize_question(text: str):
+    return " ".join(text.lower().split())
+
+def _store_bank_questions(db: Session, document_id: int, questions: List[dict]):
+    existing = {
+        _normalize_question(q) for (q,) in
+        db.query(models.BankQuestion.question).filter(models.BankQuestion.document_id == document_id)
+    }
+    stored = []
+    for q in questions:
+        key = _normalize_question(q["question"])
+        if key in existing:
+            continue
+        existing.add(key)
+        stored.append(models.BankQuestion(
+            document_id=document_id,
+            question=q["question"],
+            options=q["options"],
+            correct_answer=q["correct_answer"],
+            explanation=q.get("explanation", ""),
+        ))
+    db.add_all(stored)
+    db.commit()
+    return stored
+
+def _clear_question_bank(db: Session, document_id: int):
+    """
+    Drops a document's bank questions when its contents change, so quizzes are
+    not served from the old text. Graded answers keep their texts, and quizzes
+    served but not yet submitted are discarded. Does not commit.
+    """
+    question_ids = [
+        question_id for (question_id,) in
+        db.query(models.BankQuestion.id).filter(models.BankQuestion.document_id == document_id)
+    ]
+    if not question_ids:
+        return
+    answers = db.query(models.QuizAnswer).options(selectinload(models.QuizAnswer.question)).filter(
+        models.QuizAnswer.question_id.in_(question_ids)
+    ).all()
+    for answer in answers:
+        question = answer.question
+        answer.question_text, answer.selected_answer, answer.correct_answer = quiz_answer_texts(
+            (None, None, None), (question.question, question.options, question.correct_answer), answer.option_index
+        )
+        answer.question_id = None
+    db.flush()
+    db.query(models.QuizItem).filter(models.QuizItem.question_id.in_(question_ids)).delete(synchronize_session=False)
+    db.query(models.Quiz).filter(
+        models.Quiz.document_id == document_id, models.Quiz.submitted_at.is_(None)
+    ).delete(synchronize_session=False)
+    db.query(models.BankQuestionView).filter(models.BankQuestionView.question_id.in_(question_ids)).delete(synchronize_session=False)
+    db.query(models.BankQuestion).filter(models.BankQuestion.id.in_(question_ids)).delete(synchronize_session=False)
+
+async def refill_question_bank(document_id: int, target: int = QUESTION_BANK_TARGET):
+    """Generates questions in the background until the document's bank holds `target`."""
+    if document_id in _refilling_banks:
+        return
+    _refilling_banks.add(document_id)
+    db = SessionLocal()
+    try:
+        document = db.query(models.Document).filter(models.Document.id == document_id).first()
+        if not document:
+            return
+        failures = 0
+        while failures < 3:
+            count = db.query(func.count(models.BankQuestion.id)).filter(models.BankQuestion.document_id == document_id).scalar()
+            if count >= target:
+                break
+            try:
+                stored = _store_bank_questions(db, document_id, await _generate_quiz_questions(document))
+            except Exception as e:
+                logger.warning("Question bank generation failed: %s", e)
+                stored = []
+            if not stored:
+                failures += 1
+    finally:
+        _refilling_banks.discard(document_id)
+        db.close()
+
+def _served_question(question: models.BankQuestion):
+    # The correct answer and explanation are only revealed by grading.
+    return {"id": question.id, "question": question.question, "options": question.options}
+
+async def create_quiz(db: Session, request: schemas.DocumentRequest, user_id: int, background_tasks: Optional[BackgroundTasks] = None):
+    """
+    Serves a quiz from the document's question bank, skipping questions the user
+    saw recently. Falls back to a live generation only when the bank is too small.
+    """
+    document = get_document_from_db(db, request.document_id)
 
-def save_quiz_attempt(db: Session, user_id: int, request: schemas.SubmitQuizRequest):
-   
-    db_attempt = models.QuizAttempt(
-        document_id=request.document_id,
+    with span("quiz.sample_bank"):
+        recent = (
+            db.query(models.BankQuestionView.question_id)
+            .filter(models.BankQuestionView.user_id == user_id)
+            .order_by(models.BankQuestionView.seen_at.desc())
+            .limit(QUESTION_BANK_RECENT)
+            .subquery()
+        )
+        available_ids = [
+            question_id for (question_id,) in
+            db.query(models.BankQuestion.id).filter(
+                models.BankQuestion.document_id == document.id,
+                models.BankQuestion.id.notin_(db.query(recent.c.question_id)),
+            )
+        ]
+
+    record_cache("question_bank", hit=len(available_ids) >= QUIZ_SIZE)
+    if len(available_ids) >= QUIZ_SIZE:
+        chosen_ids = random.sample(available_ids, QUIZ_SIZE)
+        questions = db.query(models.BankQuestion).filter(models.BankQuestion.id.in_(chosen_ids)).all()
+    else:
+        # Cold bank: generate now, and keep what we generated for next time.
+        generated = await _generate_quiz_questions(document)
+        if not generated:
+            raise HTTPException(status_code=502, detail="Quiz generation failed.")
+        _store_bank_questions(db, document.id, generated)
+        keys = {_normalize_question(q["question"]) for q in generated}
+        questions = [
+            q for q in db.query(models.BankQuestion).filter(models.BankQuestion.document_id == document.id)
+            if _normalize_question(q.question) in keys
+        ][:QUIZ_SIZE]
+
+    db.add_all(models.BankQuestionView(question_id=q.id, user_id=user_id) for q in questions)
+    quiz = models.Quiz(
+        document_id=document.id,
         user_id=user_id,
-        score=request.score
+        items=[models.QuizItem(question_id=q.id, position=i) for i, q in enumerate(questions)],
     )
-    db.add(db_attempt)
+    db.add(quiz)
     db.commit()
-    db.refresh(db_attempt)
 
-    
-    for answer in request.answers:
-        db_answer = models.QuizAnswer(
-            attempt_id=db_attempt.id,
-            question_text=answer.question_text,
-            selected_answer=answer.selected_answer,
-            correct_answer=answer.correct_answer,
-            is_correct=answer.is_correct
-        )
-        db.add(db_answer)
-    
+    if len(available_ids) - len(questions) < QUESTION_BANK_LOW_WATER and background_tasks is not None:
+        # The bank must outgrow a user's recent window to keep serving them fresh questions.
+        target = max(QUESTION_BANK_TARGET, QUESTION_BANK_RECENT + QUESTION_BANK_LOW_WATER + QUIZ_SIZE)
+        background_tasks.add_task(refill_question_bank, document.id, target)
+
+    return {"quiz_id": quiz.id, "questions": [_served_question(q) for q in questions]}
+
+def _correct_index(options: List[str], correct_answer: str) -> Optional[int]:
+    return options.index(correct_answer) if correct_answer in options else None
+
+def grade_quiz(db: Session, user_id: int, request: schemas.SubmitQuizRequest):
+    """
+    Grades a stored quiz from (question_id, option_index) pairs. The answer key
+    is read with one query; the score is computed here, never taken from the client.
+    """
+    quiz = db.query(models.Quiz).filter(models.Quiz.id == request.quiz_id, models.Quiz.user_id == user_id).first()
+    if not quiz:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+
+    key = db.query(
+        models.QuizItem.question_id, models.BankQuestion.options,
+        models.BankQuestion.correct_answer, models.BankQuestion.explanation,
+    ).join(models.BankQuestion, models.BankQuestion.id == models.QuizItem.question_id).filter(
+        models.QuizItem.quiz_id == quiz.id
+    ).order_by(models.QuizItem.position).all()
+
+    chosen = {answer.question_id: answer.option_index for answer in request.answers}
+    if set(chosen) - {question_id for question_id, _, _, _ in key}:
+        raise HTTPException(status_code=422, detail="Answers reference questions that are not in this quiz.")
+
+    graded = []
+    for question_id, options, correct_answer, explanation in key:
+        option_index = chosen.get(question_id)
+        if option_index is not None and not 0 <= option_index < len(options):
+            raise HTTPException(status_code=422, detail=f"Option index out of range for question {question_id}.")
+        correct_index = _correct_index(options, correct_answer)
+        graded.append({
+            "question_id": question_id,
+            "option_index": option_index,
+            "correct_index": correct_index,
+            "is_correct": option_index is not None and option_index == correct_index,
+            "explanation": explanation,
+        })
+    correct = sum(answer["is_correct"] for answer in graded)
+    score = correct / len(graded) * 100 if graded else 0.0
+
+    # Claiming the quiz with a conditional UPDATE makes a concurrent double submit lose cleanly.
+    claimed = db.query(models.Quiz).filter(models.Quiz.id == quiz.id, models.Quiz.submitted_at.is_(None)).update(
+        {models.Quiz.submitted_at: datetime.utcnow()}, synchronize_session=False
+    )
+    if not claimed:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="This quiz has already been submitted.")
+    attempt = models.QuizAttempt(
+        document_id=quiz.document_id,
+        user_id=user_id,
+        quiz_id=quiz.id,
+        score=score,
+        answers=[
+            models.QuizAnswer(question_id=a["question_id"], option_index=a["option_index"], is_correct=a["is_correct"])
+            for a in graded
+        ],
+    )
+    db.add(attempt)
     db.commit()
-    return db_attempt
+    response_cache.invalidate("quiz", user_id, quiz.document_id)
+    return {"attempt_id": attempt.id, "quiz_id": quiz.id, "score": score, "correct": correct, "total": len(graded), "answers": graded}
+
+def quiz_answer_texts(stored: tuple, bank: tuple, option_index: Optional[int]):
+    """
+    (question, selected, correct) texts of an answer. Graded answers are read
+    from their bank question (`bank` = question, options, correct_answer);
+    older answers kept the texts themselves (`stored`).
+    """
+    question, options, correct_answer = bank
+    if question is None:
+        return stored
+    selected = options[option_index] if option_index is not None and 0 <= option_index < len(options) else "No answer"
+    return question, selected, correct_answer
 
 def get_quiz_history_for_document(db: Session, user_id: int, document_id: int):
-    attempts = db.query(models.QuizAttempt).filter(
+    attempts = db.query(models.QuizAttempt).options(
+        selectinload(models.QuizAttempt.answers).joinedload(models.QuizAnswer.question)
+    ).filter(
         models.QuizAttempt.user_id == user_id,
         models.QuizAttempt.document_id == document_id
     ).order_by(models.QuizAttempt.timestamp.desc()).all()
-    return attempts
+
+    history = []
+    for attempt in attempts:
+        answers = []
+        for answer in sorted(attempt.answers, key=lambda a: a.id):
+            question = answer.question
+            bank = (question.question, question.options, question.correct_answer) if question else (None, None, None)
+            question_text, selected, correct_answer = quiz_answer_texts(
+                (answer.question_text, answer.selected_answer, answer.correct_answer), bank, answer.option_index
+            )
+            answers.append({
+                "id": answer.id, "question_id": answer.question_id, "option_index": answer.option_index,
+                "question_text": question_text, "selected_answer": selected, "correct_answer": correct_answer,
+                "is_correct": answer.is_correct,
+            })
+        history.append({"id": attempt.id, "score": attempt.score, "timestamp": attempt.timestamp, "answers": answers})
+    return history
 
 
 def delete_document(db: Session, document_id: int, user_id: int):
@@ -303,13 +1158,16 @@ def delete_document(db: Session, document_id: int, user_id: int):
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or access denied")
     
-    # Delete the associated vector store file
-    vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document.id}")
-    if os.path.exists(vector_store_path):
-        shutil.rmtree(vector_store_path) # Use rmtree to delete the folder
+    # Delete the associated vector store (or drop it from its shard)
+    remove_document_vectors(document)
 
+    content_hash = document.content_hash
     db.delete(document)
     db.commit()
+    _release_text(db, content_hash)
+    document_cache.evict(document_id)
+    response_cache.invalidate("doc", document_id)
+    response_cache.invalidate("documents", user_id)
     return {"message": "Document and all associated data deleted successfully."}
 
 def delete_chat_history(db: Session, document_id: int, user_id: int):
@@ -318,7 +1176,9 @@ def delete_chat_history(db: Session, document_id: int, user_id: int):
         raise HTTPException(status_code=403, detail="Not authorized to delete this chat history")
     
     db.query(models.ChatHistory).filter(models.ChatHistory.document_id == document_id).delete(synchronize_session=False)
+    db.query(models.ChatHistoryArchive).filter(models.ChatHistoryArchive.document_id == document_id).delete(synchronize_session=False)
     db.commit()
+    response_cache.invalidate("chat", document_id)
     return {"message": "Chat history deleted successfully."}
 
 def delete_all_quiz_history(db: Session, document_id: int, user_id: int):
@@ -332,6 +1192,7 @@ def delete_all_quiz_history(db: Session, document_id: int, user_id: int):
         db.delete(attempt)
         
     db.commit()
+    response_cache.invalidate("quiz", user_id, document_id)
     return {"message": "All quiz history for this document has been deleted."}
 
 def delete_single_quiz_attempt(db: Session, attempt_id: int, user_id: int):
@@ -339,8 +1200,10 @@ def delete_single_quiz_attempt(db: Session, attempt_id: int, user_id: int):
     if not attempt:
         raise HTTPException(status_code=404, detail="Quiz attempt not found or access denied")
     
+    document_id = attempt.document_id
     db.delete(attempt)
     db.commit()
+    response_cache.invalidate("quiz", user_id, document_id)
     return {"message": "Quiz attempt deleted successfully."}
 
 def delete_multiple_quiz_attempts(db: Session, attempt_ids: List[int], user_id: int):
@@ -353,10 +1216,13 @@ def delete_multiple_quiz_attempts(db: Session, attempt_ids: List[int], user_id:
     if len(attempts_to_delete) != len(attempt_ids):
         raise HTTPException(status_code=403, detail="One or more quiz attempts not found or access denied")
 
+    document_ids = {attempt.document_id for attempt in attempts_to_delete}
     for attempt in attempts_to_delete:
         db.delete(attempt)
 
     db.commit()
+    for document_id in document_ids:
+        response_cache.invalidate("quiz", user_id, document_id)
     return {"message": f"{len(attempts_to_delete)} quiz attempts deleted successfully."}
 
 def get_flashcard_sets_for_document(db: Session, user_id: int, document_id: int):
@@ -365,70 +1231,131 @@ def get_flashcard_sets_for_document(db: Session, user_id: int, document_id: int)
         models.FlashcardSet.document_id == document_id
     ).order_by(models.FlashcardSet.timestamp.desc()).all()
 
-async def create_flashcards(db: Session, document_id: int, user_id: int):
+# --- Flashcard generation ---
+FLASHCARD_SECTION_CHARS = int(os.getenv("FLASHCARD_SECTION_CHARS", 6000))
+FLASHCARD_MAX_SECTIONS = int(os.getenv("FLASHCARD_MAX_SECTIONS", 6))
+FLASHCARD_CARDS_PER_SECTION = int(os.getenv("FLASHCARD_CARDS_PER_SECTION", 4))
+FLASHCARD_CONCURRENCY = int(os.getenv("FLASHCARD_CONCURRENCY", 3))
+
+# Define a Pydantic model for the AI to structure its output
+class _GeneratedFlashcard(BaseModel):
+    term: str = Field(description="The key term, concept, or name.")
+    definition: str = Field(description="A clear and concise definition or explanation of the term.")
+
+class _GeneratedFlashcardSet(BaseModel):
+    flashcards: List[_GeneratedFlashcard] = Field(description="A list of generated flashcards.")
+
+_flashcard_parser = JsonOutputParser(pydantic_object=_GeneratedFlashcardSet)
+
+_flashcard_prompt = PromptTemplate(
+    template="""You are an expert educator specializing in creating effective study materials.
+    Based *only* on the provided text, identify the most important key terms, concepts, and definitions.
+    Generate a set of {card_count} high-quality flashcards from this text.
+    Your output must be a JSON object that strictly follows this format: {format_instructions}
+
+    **Source Text:**
+    ---
+    {context}
+    ---
+    """,
+    input_variables=["context", "card_count"],
+    partial_variables={"format_instructions": _flashcard_parser.get_format_instructions()},
+)
+
+def _document_sections(texts: List[str]) -> List[str]:
+    """Groups consecutive chunks into sections of roughly FLASHCARD_SECTION_CHARS."""
+    sections, current = [], []
+    size = 0
+    for text in texts:
+        if current and size + len(text) > FLASHCARD_SECTION_CHARS:
+            sections.append(" ".join(current))
+            current, size = [], 0
+        current.append(text)
+        size += len(text)
+    if current:
+        sections.append(" ".join(current))
+    if len(sections) > FLASHCARD_MAX_SECTIONS:
+        # Spread the sections we keep evenly over the document.
+        step = len(sections) / FLASHCARD_MAX_SECTIONS
+        sections = [sections[int(i * step)] for i in range(FLASHCARD_MAX_SECTIONS)]
+    return sections
+
+def _normalize_term(term: str):
+    words = "".join(ch if ch.isalnum() else " " for ch in term.lower()).split()
+    while words and words[0] in ("the", "a", "an"):
+        words = words[1:]
+    return " ".join(words)
+
+async def iter_flashcard_generation(db: Session, document_id: int, user_id: int):
+    """
+    Generates flashcards section by section under a concurrency cap and yields
+    events as sections finish: {"type": "cards", ...} per section, then a final
+    {"type": "set", ...} once the whole set has been saved in one transaction.
+    """
     document = db.query(models.Document).filter(models.Document.id == document_id).first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found.")
 
-    vector_store_path = os.path.join(VECTOR_STORE_DIRECTORY, f"doc_{document.id}")
-    if not os.path.exists(vector_store_path):
-        raise HTTPException(status_code=404, detail="Vector store for document not found.")
-
-    vector_store = FAISS.load_local(vector_store_path, embedding_model, allow_dangerous_deserialization=True)
-    all_docs = vector_store.similarity_search("", k=100)
-    if not all_docs:
+    with span("flashcards.load_chunks"):
+        texts = [text for _, text in _all_chunk_texts(document)]
+    if not texts:
         raise HTTPException(status_code=404, detail="No content found to create flashcards from.")
-        
-    full_context = " ".join([doc.page_content for doc in all_docs])
-
-    # Define a Pydantic model for the AI to structure its output
-    class Flashcard(BaseModel):
-        term: str = Field(description="The key term, concept, or name.")
-        definition: str = Field(description="A clear and concise definition or explanation of the term.")
-
-    class FlashcardSet(BaseModel):
-        flashcards: List[Flashcard] = Field(description="A list of generated flashcards.")
-
-    parser = JsonOutputParser(pydantic_object=FlashcardSet)
-
-    prompt = PromptTemplate(
-        template="""You are an expert educator specializing in creating effective study materials.
-        Based *only* on the provided text, identify the most important key terms, concepts, and definitions.
-        Generate a set of 10 high-quality flashcards from this text.
-        Your output must be a JSON object that strictly follows this format: {format_instructions}
-
-        **Source Text:**
-        ---
-        {context}
-        ---
-        """,
-        input_variables=["context"],
-        partial_variables={"format_instructions": parser.get_format_instructions()},
-    )
-
-    chain = prompt | llm | parser
-    generated_data = await chain.ainvoke({"context": full_context})
-    
-    # Save the new flashcard set to the database
+    sections = _document_sections(texts)
+
+    chain = _flashcard_prompt | llm | _flashcard_parser
+    semaphore = asyncio.Semaphore(FLASHCARD_CONCURRENCY)
+
+    async def generate(section_no: int, section: str):
+        async with semaphore:
+            try:
+                with span("flashcards.generate_section", section=section_no):
+                    data = await chain.ainvoke({"context": section, "card_count": FLASHCARD_CARDS_PER_SECTION})
+                return section_no, data.get("flashcards", [])
+            except Exception as e:
+                # One bad section should not sink the whole set.
+                logger.warning("Flashcard generation failed for section %s: %s", section_no, e)
+                return section_no, []
+
+    seen_terms = set()
+    cards = []
+    for finished in asyncio.as_completed([generate(i, section) for i, section in enumerate(sections)]):
+        section_no, generated = await finished
+        fresh = []
+        for card in generated:
+            key = _normalize_term(card.get("term", ""))
+            if not key or key in seen_terms or not card.get("definition"):
+                continue
+            seen_terms.add(key)
+            fresh.append({"front": card["term"], "back": card["definition"]})
+        cards.extend(fresh)
+        yield {"type": "cards", "section": section_no, "sections": len(sections), "cards": fresh}
+
+    if not cards:
+        raise HTTPException(status_code=502, detail="Flashcard generation failed.")
+
+    # Save the new flashcard set to the database in a single transaction.
+    # Every card gets a review schedule that is due straight away.
+    now = datetime.utcnow()
     new_set = models.FlashcardSet(
         document_id=document_id,
         user_id=user_id,
-        title=f"Flashcards for {document.filename}"
+        title=f"Flashcards for {document.filename}",
+        cards=[
+            models.Flashcard(front=card["front"], back=card["back"], reviews=[models.FlashcardReview(user_id=user_id, due_at=now)])
+            for card in cards
+        ],
     )
-    db.add(new_set)
-    db.commit()
-    db.refresh(new_set)
+    with span("flashcards.save", cards=len(cards)):
+        db.add(new_set)
+        db.commit()
+        response_cache.invalidate("flashcards", user_id, document_id)
+        db.refresh(new_set)
+    yield {"type": "set", "set": new_set}
 
-    for card_data in generated_data['flashcards']:
-        db_card = models.Flashcard(
-            set_id=new_set.id,
-            front=card_data['term'],
-            back=card_data['definition']
-        )
-        db.add(db_card)
-    
-    db.commit()
-    return new_set
+async def create_flashcards(db: Session, document_id: int, user_id: int):
+    async for event in iter_flashcard_generation(db, document_id, user_id):
+        if event["type"] == "set":
+            return event["set"]
 
 
 def delete_flashcard_set(db: Session, set_id: int, user_id: int):
@@ -441,8 +1368,10 @@ def delete_flashcard_set(db: Session, set_id: int, user_id: int):
     if set_to_delete.user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this flashcard set")
 
+    document_id = set_to_delete.document_id
     db.delete(set_to_delete)
     db.commit()
+    response_cache.invalidate("flashcards", user_id, document_id)
     return
 
 def delete_multiple_flashcard_sets(db: Session, item_ids: List[int], user_id: int):
@@ -455,10 +1384,13 @@ def delete_multiple_flashcard_sets(db: Session, item_ids: List[int], user_id: in
     if len(sets_to_delete) != len(set(item_ids)):
          raise HTTPException(status_code=403, detail="One or more flashcard sets not found or access denied")
 
+    document_ids = {f_set.document_id for f_set in sets_to_delete}
     for f_set in sets_to_delete:
         db.delete(f_set)
 
     db.commit()
+    for document_id in document_ids:
+        response_cache.invalidate("flashcards", user_id, document_id)
     return
 
 def delete_all_flashcard_sets_for_document(db: Session, document_id: int, user_id: int):
@@ -471,10 +1403,61 @@ def delete_all_flashcard_sets_for_document(db: Session, document_id: int, user_i
     if not document:
         raise HTTPException(status_code=404, detail="Document not found or you do not have permission")
 
+    # Sets made by any user on this document go, so every one of their caches is stale.
+    set_owners = {f_set.user_id for f_set in document.flashcard_sets}
     document.flashcard_sets = []
     db.commit()
+    for set_owner in set_owners:
+        response_cache.invalidate("flashcards", set_owner, document_id)
     return
 
+# --- Spaced repetition ---
+def review_flashcard(db: Session, user_id: int, card_id: int, grade: int):
+    """Records one graded review of a card and reschedules it (SM-2)."""
+    def locked_review():
+        # Locked, so two reviews of the same card are applied one after the other.
+        return db.query(models.FlashcardReview).filter(
+            models.FlashcardReview.user_id == user_id, models.FlashcardReview.card_id == card_id
+        ).with_for_update().first()
+
+    review = locked_review()
+    if review is None:
+        # Cards from before scheduling existed get their schedule on first review.
+        owned = db.query(models.Flashcard.id).join(models.FlashcardSet).filter(
+            models.Flashcard.id == card_id, models.FlashcardSet.user_id == user_id
+        ).first()
+        if not owned:
+            raise HTTPException(status_code=404, detail="Flashcard not found")
+        try:
+            with db.begin_nested():
+                review = models.FlashcardReview(user_id=user_id, card_id=card_id)
+                db.add(review)
+        except IntegrityError:
+            # A concurrent first review created the schedule; apply this grade on top of it.
+            review = locked_review()
+    spaced_repetition.schedule(review, grade)
+    db.commit()
+    db.refresh(review)
+    return review
+
+def get_due_flashcards(db: Session, user_id: int, limit: int, now: Optional[datetime] = None):
+    """
+    The user's next `limit` due cards across all sets, most overdue first.
+    Walks ix_flashcard_reviews_user_due in order and stops after `limit`
+    rows, so the cost does not grow with the number of cards.
+    """
+    rows = db.query(
+        models.FlashcardReview.card_id, models.Flashcard.set_id, models.FlashcardSet.document_id,
+        models.Flashcard.front, models.Flashcard.back, models.FlashcardReview.due_at,
+        models.FlashcardReview.repetitions, models.FlashcardReview.interval_days,
+    ).join(models.Flashcard, models.Flashcard.id == models.FlashcardReview.card_id).join(
+        models.FlashcardSet, models.FlashcardSet.id == models.Flashcard.set_id
+    ).filter(
+        models.FlashcardReview.user_id == user_id,
+        models.FlashcardReview.due_at <= (now or datetime.utcnow()),
+    ).order_by(models.FlashcardReview.due_at).limit(limit).all()
+    return [row._asdict() for row in rows]
+
 def update_user_password(db: Session, user: models.User, new_password: str):
     """Updates the password for a given user object."""
     hashed_password = auth.get_password_hash(new_password)
@@ -12,7 +12,13 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL is None:
     raise Exception("DATABASE_URL environment variable not set.")
 
-engine = create_engine(DATABASE_URL, echo=True)
+# SQLite (used by the local benchmark fixture) must be shareable across FastAPI's threadpool.
+connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(
+    DATABASE_URL,
+    echo=os.getenv("DATABASE_ECHO", "true").lower() == "true",
+    connect_args=connect_args,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -0,0 +1,67 @@
+# doc_cache.py
+"""
+Per-process cache of state derived from one document: loaded FAISS stores,
+BM25 indexes and summaries.
+
+Each entry remembers the ``Document.version`` it was built from. Callers pass
+the Document row they already loaded for the request, so checking an entry
+costs no extra query. A write handled by any worker bumps the version in the
+database, so every worker sees the mismatch on its next request and rebuilds.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from . import models
+from .observability import record_cache
+
+DOCUMENT_CACHE_ENTRIES = int(os.getenv("DOCUMENT_CACHE_ENTRIES", 64))
+
+
+class VersionedCache:
+    def __init__(self, max_entries: int = DOCUMENT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document: models.Document, kind: str) -> Optional[Any]:
+        key = (document.id, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == document.version:
+                self._entries.move_to_end(key)
+                record_cache(f"document:{kind}", True)
+                return entry[1]
+        record_cache(f"document:{kind}", False)
+        return None
+
+    def put(self, document: models.Document, kind: str, value: Any):
+        key = (document.id, kind)
+        with self._lock:
+            self._entries[key] = (document.version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, document: models.Document, kind: str, load: Callable[[], Any]) -> Any:
+        value = self.get(document, kind)
+        if value is None:
+            value = load()
+            self.put(document, kind, value)
+        return value
+
+    async def aget_or_load(self, document: models.Document, kind: str, load: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(document, kind)
+        if value is None:
+            value = await load()
+            self.put(document, kind, value)
+        return value
+
+    def evict(self, document_id: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == document_id]:
+                del self._entries[key]
+
+
+document_cache = VersionedCache()
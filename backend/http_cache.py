@@ -0,0 +1,68 @@
+# http_cache.py
+"""
+Conditional GET and response compression for the dashboard's polling endpoints.
+
+A read endpoint computes a cheap version stamp for its resource (typically
+count / max id / max timestamp from one aggregate query, see crud.py) and asks
+``not_modified()`` whether the client already has it. If so, it returns a
+bodiless 304 and never loads or serializes the rows. Otherwise the ETag is
+attached to the normal response, so the browser revalidates with
+If-None-Match on its next poll.
+"""
+import hashlib
+import os
+from typing import Optional
+
+from fastapi import Request, Response
+from starlette.middleware.gzip import GZipMiddleware
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # optional dependency; gzip is always available
+    BrotliMiddleware = None
+
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", 1000))
+
+
+def make_etag(resource: str, *stamp) -> str:
+    digest = hashlib.sha1(repr((resource,) + stamp).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: W/"x" and "x" are the same validator.
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, response: Response, resource: str, *stamp) -> Optional[Response]:
+    """Returns a 304 response if the client's copy is current; otherwise tags `response`."""
+    etag = make_etag(resource, *stamp)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+class CompressionMiddleware:
+    """Brotli (when installed) or gzip above a size threshold; NDJSON streams and exports are left alone."""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        # Compressors buffer output, which would hold back streamed events;
+        # exports are compressed by the endpoint itself when asked to.
+        if scope["type"] == "http" and (scope["path"].endswith("/stream") or scope["path"].startswith("/export")):
+            await self.app(scope, receive, send)
+        else:
+            await self.compressed(scope, receive, send)
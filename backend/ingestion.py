@@ -0,0 +1,305 @@
+# ingestion.py
+"""
+Streaming document ingestion.
+
+PDF pages are extracted in parallel worker processes (a few pages per task),
+handed over in page order, chunked incrementally and grouped into bounded
+embedding batches. The producer and the embedding consumer are connected by a
+bounded queue, so extraction never runs far ahead of embedding and peak memory
+does not grow with the size of the document.
+"""
+import asyncio
+import hashlib
+import io
+import os
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Optional, Tuple, Union
+
+import docx
+import fitz
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 1000))
+CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", 200))
+PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", 8))
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", 64))
+# Number of embedding batches allowed to wait between the extractor and the embedder.
+MAX_PENDING_BATCHES = int(os.getenv("INGEST_MAX_PENDING_BATCHES", 4))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def chunk_hash(text: str) -> str:
+    """Content hash used to recognise unchanged chunks across re-uploads."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: the API process already runs threads (the shard compactor,
+        # replica health checks, torch), and forking a threaded process can deadlock.
+        _executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=get_context("spawn"))
+    return _executor
+
+
+# --- Extraction (runs in worker processes) ---
+def _pdf_page_count(path: str) -> int:
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+def _extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    with fitz.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+async def iter_pdf_pages(path: str) -> AsyncIterator[Tuple[int, str]]:
+    """Yields (page_number, text) in order, extracting page ranges in parallel."""
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    page_count = await loop.run_in_executor(executor, _pdf_page_count, path)
+
+    ranges = [(start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK)]
+    max_in_flight = INGEST_WORKERS * 2
+    pending = []
+    next_range = 0
+    try:
+        while next_range < len(ranges) or pending:
+            # Keep the pool busy, but never hold more than max_in_flight ranges of text.
+            while next_range < len(ranges) and len(pending) < max_in_flight:
+                start, stop = ranges[next_range]
+                pending.append((start, loop.run_in_executor(executor, _extract_pdf_pages, path, start, stop)))
+                next_range += 1
+            start, future = pending.pop(0)
+            for offset, text in enumerate(await future):
+                yield start + offset + 1, text
+    finally:
+        # The consumer stopped early (failure or cancellation); ranges not started yet are dropped.
+        for _, future in pending:
+            future.cancel()
+
+
+def _extract_pdf_bytes(data: bytes) -> List[str]:
+    # Small uploads are kept in memory (see spooling.py); one thread is enough for them.
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return [page.get_text() for page in doc]
+
+
+def iter_docx_pages(source) -> Iterator[Tuple[Optional[int], str]]:
+    """DOCX has no pages; paragraphs are yielded in groups with no page number."""
+    group = []
+    for paragraph in docx.Document(source).paragraphs:
+        group.append(paragraph.text)
+        if len(group) >= 50:
+            yield None, "\n".join(group)
+            group = []
+    if group:
+        yield None, "\n".join(group)
+
+
+# --- Incremental chunking ---
+class IncrementalChunker:
+    """
+    Splits a stream of page texts with the same splitter as before, emitting
+    chunks as soon as they can no longer change. Each chunk records the page
+    it starts on and the page it ends on.
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
+        )
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.base_offset = 0  # offset of buffer[0] in the whole document
+        self.page_starts: List[int] = []
+        self.page_numbers: List[Optional[int]] = []
+
+    def _page_at(self, offset: int) -> Optional[int]:
+        idx = bisect_right(self.page_starts, offset) - 1
+        return self.page_numbers[max(idx, 0)] if self.page_numbers else None
+
+    def _emit(self, docs) -> List[Tuple[str, dict]]:
+        out = []
+        for doc in docs:
+            start = self.base_offset + doc.metadata["start_index"]
+            end = start + len(doc.page_content) - 1
+            metadata = {"page": self._page_at(start), "content_hash": chunk_hash(doc.page_content)}
+            end_page = self._page_at(end)
+            if end_page != metadata["page"]:
+                metadata["page_end"] = end_page
+            out.append((doc.page_content, metadata))
+        return out
+
+    def add_page(self, page_number: Optional[int], text: str) -> List[Tuple[str, dict]]:
+        if self.buffer:
+            self.buffer += "\n"
+        self.page_starts.append(self.base_offset + len(self.buffer))
+        self.page_numbers.append(page_number)
+        self.buffer += text
+        if len(self.buffer) < self.chunk_size * 4:
+            return []
+
+        docs = self.splitter.create_documents([self.buffer])
+        if len(docs) < 2:
+            return []
+        # The last chunk may still grow with the next page, so it is kept.
+        keep_from = docs[-1].metadata["start_index"]
+        ready = self._emit(docs[:-1])
+        self.buffer = self.buffer[keep_from:]
+        self.base_offset += keep_from
+        self._trim_page_index()
+        return ready
+
+    def _trim_page_index(self):
+        first_needed = max(bisect_right(self.page_starts, self.base_offset) - 1, 0)
+        del self.page_starts[:first_needed]
+        del self.page_numbers[:first_needed]
+
+    def finish(self) -> List[Tuple[str, dict]]:
+        if not self.buffer.strip():
+            return []
+        ready = self._emit(self.splitter.create_documents([self.buffer]))
+        self.buffer = ""
+        return ready
+
+
+# --- Pipeline ---
+async def iter_page_texts(source: Union[str, bytes], content_type: str) -> AsyncIterator[Tuple[Optional[int], str]]:
+    """`source` is a file path, or the file's bytes for uploads small enough to stay in memory."""
+    if content_type == "application/pdf":
+        if isinstance(source, bytes):
+            for number, text in enumerate(await asyncio.to_thread(_extract_pdf_bytes, source), start=1):
+                yield number, text
+        else:
+            async for page in iter_pdf_pages(source):
+                yield page
+    else:
+        docx_source = io.BytesIO(source) if isinstance(source, bytes) else source
+        for page in await asyncio.to_thread(lambda: list(iter_docx_pages(docx_source))):
+            yield page
+
+
+async def iter_chunks(
+    pages: AsyncIterator[Tuple[Optional[int], str]],
+    chunker: Optional[IncrementalChunker] = None,
+) -> AsyncIterator[Tuple[str, dict]]:
+    """Chunks a stream of page texts, yielding (text, metadata) as chunks are final."""
+    chunker = chunker or IncrementalChunker()
+    async for page_number, text in pages:
+        for chunk in chunker.add_page(page_number, text):
+            yield chunk
+    for chunk in chunker.finish():
+        yield chunk
+
+
+async def iter_embedded_batches(
+    pages: AsyncIterator[Tuple[Optional[int], str]],
+    embeddings,
+    embed: Optional[Callable[[List[str]], Awaitable[List[List[float]]]]] = None,
+    chunker: Optional[IncrementalChunker] = None,
+):
+    """
+    Consumes page texts and yields (texts, metadatas, vectors) batches.
+    Chunking runs ahead of embedding by at most MAX_PENDING_BATCHES batches.
+    `embed` replaces the direct embedding call, e.g. with a SharedEmbeddingBatcher;
+    `chunker` overrides the default chunk size and overlap.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_PENDING_BATCHES)
+
+    async def produce():
+        batch: List[Tuple[str, dict]] = []
+        try:
+            async for chunk in iter_chunks(pages, chunker):
+                batch.append(chunk)
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    await queue.put(batch)
+                    batch = []
+            if batch:
+                await queue.put(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await queue.put(exc)
+            return
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            texts = [text for text, _ in batch]
+            metadatas = [meta for _, meta in batch]
+            if embed is not None:
+                vectors = await embed(texts)
+            else:
+                vectors = await asyncio.to_thread(embeddings.embed_documents, texts)
+            yield texts, metadatas, vectors
+    finally:
+        if not producer.done():
+            producer.cancel()
+
+
+async def embed_in_batches(texts: List[str], embeddings) -> List[List[float]]:
+    """Embeds texts EMBED_BATCH_SIZE at a time off the event loop."""
+    vectors: List[List[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        vectors.extend(await asyncio.to_thread(embeddings.embed_documents, texts[start:start + EMBED_BATCH_SIZE]))
+    return vectors
+
+
+class SharedEmbeddingBatcher:
+    """
+    Pools embedding requests from concurrent ingestions into batches of up to
+    `batch_size` texts. A small file's last, partial batch is embedded together
+    with other files' batches instead of on its own.
+    """
+
+    def __init__(self, embeddings, batch_size: int = EMBED_BATCH_SIZE, linger_seconds: float = 0.02):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.batches = 0
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._runner: Optional[asyncio.Task] = None
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future))
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        while self._pending:
+            if sum(len(texts) for texts, _ in self._pending) < self.batch_size:
+                # Give the other ingestions a moment to contribute to this batch.
+                await asyncio.sleep(self.linger_seconds)
+            taken, size = [], 0
+            while self._pending and (not taken or size + len(self._pending[0][0]) <= self.batch_size):
+                texts, future = self._pending.pop(0)
+                taken.append((texts, future))
+                size += len(texts)
+            try:
+                vectors = await asyncio.to_thread(
+                    self.embeddings.embed_documents, [text for texts, _ in taken for text in texts]
+                )
+            except Exception as exc:
+                for _, future in taken:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            self.batches += 1
+            offset = 0
+            for texts, future in taken:
+                if not future.done():
+                    future.set_result(vectors[offset:offset + len(texts)])
+                offset += len(texts)
@@ -0,0 +1,175 @@
+# lexical.py
+"""
+BM25 keyword index and reciprocal rank fusion.
+
+Dense retrieval is weak on exact terms such as course codes, formula names or
+section numbers. Each document therefore also gets a small inverted index that
+is built during ingestion and stored next to its vectors. The index only keeps
+postings and chunk keys (FAISS docstore ids or shard vector ids), never the
+chunk text itself, so it stays compact on disk.
+"""
+import gzip
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Hashable, Iterable, List, Sequence, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document as LCDocument
+from langchain_core.retrievers import BaseRetriever
+
+# Keeps things like "cmpe-272", "3.2.1" and "o(n)" together as single terms.
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+
+RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+DENSE_WEIGHT = float(os.getenv("HYBRID_DENSE_WEIGHT", 1.0))
+LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", 1.0))
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """Okapi BM25 over the chunks of one document."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.keys: List[Hashable] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key: Hashable, text: str):
+        position = len(self.keys)
+        terms = tokenize(text)
+        self.keys.append(key)
+        self.lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            self.postings[term].append((position, tf))
+
+    def add_many(self, items: Iterable[Tuple[Hashable, str]]):
+        for key, text in items:
+            self.add(key, text)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[Hashable, float]]:
+        if not self.keys:
+            return []
+        n_docs = len(self.keys)
+        avg_len = (sum(self.lengths) / n_docs) or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / avg_len)
+                scores[position] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.keys[position], score) for position, score in best]
+
+    # --- Persistence ---
+    def save(self, path: str):
+        payload = {
+            "k1": self.k1,
+            "b": self.b,
+            "keys": self.keys,
+            "lengths": self.lengths,
+            # Postings are flattened to [pos, tf, pos, tf, ...] to keep the file small.
+            "postings": {term: [n for pair in plist for n in pair] for term, plist in self.postings.items()},
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as fh:
+            json.dump(payload, fh, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            payload = json.load(fh)
+        index = cls(k1=payload["k1"], b=payload["b"])
+        index.keys = payload["keys"]
+        index.lengths = payload["lengths"]
+        for term, flat in payload["postings"].items():
+            index.postings[term] = list(zip(flat[0::2], flat[1::2]))
+        return index
+
+
+def _fusion_key(doc: LCDocument):
+    return doc.metadata.get("content_hash") or doc.page_content
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: Sequence[Sequence[LCDocument]],
+    weights: Sequence[float],
+    k: int,
+    rrf_k: int = RRF_K,
+) -> List[LCDocument]:
+    """Fuses ranked lists with weighted RRF: score = sum(w / (rrf_k + rank))."""
+    scores: Dict[str, float] = defaultdict(float)
+    docs: Dict[str, LCDocument] = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, doc in enumerate(ranked, start=1):
+            key = _fusion_key(doc)
+            scores[key] += weight / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in best]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs the dense retriever and every lexical index, then fuses the two
+    rankings with reciprocal rank fusion.
+    """
+
+    dense: BaseRetriever
+    # (index, resolver) pairs; the resolver turns index keys back into chunks,
+    # returning None for keys that no longer exist.
+    lexical: List[Tuple[BM25Index, Callable[[List[Hashable]], List[LCDocument]]]]
+    k: int = 4
+    fetch_k: int = 20
+    dense_weight: float = DENSE_WEIGHT
+    lexical_weight: float = LEXICAL_WEIGHT
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _lexical_ranking(self, query: str) -> List[LCDocument]:
+        hits = []
+        for index, resolver in self.lexical:
+            scored = index.search(query, self.fetch_k)
+            if not scored:
+                continue
+            keys = [key for key, _ in scored]
+            for doc, (_, score) in zip(resolver(keys), scored):
+                if doc is not None:
+                    hits.append((doc, score))
+        hits.sort(key=lambda pair: pair[1], reverse=True)
+        return [doc for doc, _ in hits[: self.fetch_k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[LCDocument]:
+        dense_docs = self.dense.invoke(query, config={"callbacks": run_manager.get_child()})
+        lexical_docs = self._lexical_ranking(query)
+        return reciprocal_rank_fusion(
+            [dense_docs, lexical_docs], [self.dense_weight, self.lexical_weight], self.k
+        )
+
+
+def load_or_build(path: str, build: Callable[[], Iterable[Tuple[Hashable, str]]]) -> BM25Index:
+    """Loads a persisted index, building and saving it first if it does not exist yet."""
+    if os.path.exists(path):
+        return BM25Index.load(path)
+    index = BM25Index()
+    index.add_many(build())
+    index.save(path)
+    return index
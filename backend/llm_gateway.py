@@ -0,0 +1,309 @@
+# llm_gateway.py
+"""
+Shared gateway in front of the LLM.
+
+Every chain in crud.py uses ``crud.llm``, which is an ``LLMGateway`` wrapping
+the real model. Because the gateway is itself a LangChain LLM, the chains do
+not change. Each call goes through, in order:
+
+- single-flight: an identical prompt already in flight is awaited, not re-sent,
+- a token bucket that limits the request rate,
+- a semaphore that limits how many calls are in flight,
+- a per-call deadline covering all attempts, with jittered exponential
+  backoff between retries of 429 and 5xx style failures.
+
+Streamed calls (``astream``) get the same rate limit, slot and retries, but
+are never coalesced. They are retried only until the first token arrives;
+after that, a failure is passed to the caller. The slot is held until the
+stream ends, and the deadline covers the time to the first token.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from pydantic import PrivateAttr
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = (
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "InternalServerError", "DeadlineExceeded", "GatewayTimeout",
+)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    for attr in ("code", "status_code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int) and code in _RETRYABLE_STATUS:
+            return True
+    return any(name in type(exc).__name__ for name in _RETRYABLE_NAMES)
+
+
+class LLMDeadlineExceeded(Exception):
+    """Raised when a call could not complete within its deadline."""
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, up to `capacity` banked."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """Takes a token if one is available; otherwise returns the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    async def acquire(self, deadline: float) -> float:
+        waited = 0.0
+        while True:
+            wait = self.take()
+            if wait == 0.0:
+                return waited
+            if time.monotonic() + wait > deadline:
+                raise LLMDeadlineExceeded("Rate limit wait would exceed the call deadline.")
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+class GatewayMetrics:
+    """Plain counters; exported by the /metrics endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {
+            "calls": 0,
+            "upstream_calls": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "failures": 0,
+            "deadline_exceeded": 0,
+            "rate_limit_wait_seconds": 0.0,
+            "upstream_seconds": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.in_flight = 0
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {**self.counters, "in_flight": self.in_flight}
+
+
+class LLMGateway(LLM):
+    """LangChain LLM that applies concurrency, rate, retry and coalescing policy to `inner`."""
+
+    inner: BaseLanguageModel
+    max_in_flight: int = int(os.getenv("LLM_MAX_IN_FLIGHT", 8))
+    rate_per_second: float = float(os.getenv("LLM_RATE_PER_SECOND", 5))
+    burst: float = float(os.getenv("LLM_BURST", 10))
+    max_retries: int = int(os.getenv("LLM_MAX_RETRIES", 3))
+    backoff_base_seconds: float = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", 0.5))
+    timeout_seconds: float = float(os.getenv("LLM_TIMEOUT_SECONDS", 60))
+
+    _semaphore: asyncio.Semaphore = PrivateAttr()
+    _sync_semaphore: threading.BoundedSemaphore = PrivateAttr()
+    _bucket: TokenBucket = PrivateAttr()
+    _in_flight: Dict[str, asyncio.Future] = PrivateAttr(default_factory=dict)
+    _metrics: GatewayMetrics = PrivateAttr(default_factory=GatewayMetrics)
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._sync_semaphore = threading.BoundedSemaphore(self.max_in_flight)
+        self._bucket = TokenBucket(self.rate_per_second, self.burst)
+
+    @property
+    def _llm_type(self) -> str:
+        return "gateway"
+
+    @property
+    def metrics(self) -> GatewayMetrics:
+        return self._metrics
+
+    @staticmethod
+    def _key(prompt: str, stop: Optional[List[str]]) -> str:
+        return hashlib.sha256(repr((prompt, stop)).encode("utf-8")).hexdigest()
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: uniform in [0, base * 2^attempt].
+        return random.uniform(0, self.backoff_base_seconds * (2 ** attempt))
+
+    # --- Async path (used by every chain in crud.py) ---
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        self._metrics.incr("calls")
+        key = self._key(prompt, stop)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._metrics.incr("coalesced")
+        else:
+            # The upstream call runs as its own task so a caller that goes away
+            # does not cancel it for everyone else waiting on the same prompt.
+            task = asyncio.ensure_future(self._call_with_policy(prompt, stop, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller went away
+
+    async def _call_with_policy(self, prompt: str, stop: Optional[List[str]], **kwargs: Any) -> str:
+        deadline = time.monotonic() + self.timeout_seconds
+        attempt = 0
+        while True:
+            try:
+                waited = await self._bucket.acquire(deadline)
+                self._metrics.incr("rate_limit_wait_seconds", waited)
+                remaining = deadline - time.monotonic()
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=max(remaining, 0))
+                try:
+                    self._metrics.in_flight += 1
+                    self._metrics.incr("upstream_calls")
+                    started = time.monotonic()
+                    try:
+                        result = await asyncio.wait_for(
+                            self.inner.ainvoke(prompt, stop=stop, **kwargs),
+                            timeout=max(deadline - time.monotonic(), 0),
+                        )
+                        # Token counts are estimated at ~4 characters per token.
+                        self._metrics.incr("prompt_tokens", len(prompt) // 4)
+                        self._metrics.incr("completion_tokens", len(result) // 4)
+                        return result
+                    finally:
+                        self._metrics.incr("upstream_seconds", time.monotonic() - started)
+                        self._metrics.in_flight -= 1
+                finally:
+                    self._semaphore.release()
+            except LLMDeadlineExceeded:
+                self._metrics.incr("deadline_exceeded")
+                raise
+            except Exception as exc:
+                delay = self._backoff(attempt)
+                if not is_retryable(exc) or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    self._metrics.incr("failures")
+                    if isinstance(exc, asyncio.TimeoutError):
+                        self._metrics.incr("deadline_exceeded")
+                        raise LLMDeadlineExceeded("LLM call exceeded its deadline.") from exc
+                    raise
+                self._metrics.incr("retries")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        self._metrics.incr("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        attempt = 0
+        while True:
+            streamed = False
+            try:
+                waited = await self._bucket.acquire(deadline)
+                self._metrics.incr("rate_limit_wait_seconds", waited)
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=max(deadline - time.monotonic(), 0))
+                try:
+                    self._metrics.in_flight += 1
+                    self._metrics.incr("upstream_calls")
+                    started = time.monotonic()
+                    completion = 0
+                    try:
+                        stream = self.inner.astream(prompt, stop=stop, **kwargs).__aiter__()
+                        while True:
+                            # Only the first token is bound by the deadline; a long answer may keep streaming.
+                            timeout = None if streamed else max(deadline - time.monotonic(), 0)
+                            try:
+                                token = await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+                            except StopAsyncIteration:
+                                break
+                            streamed = True
+                            text = token if isinstance(token, str) else getattr(token, "text", str(token))
+                            completion += len(text)
+                            if run_manager:
+                                await run_manager.on_llm_new_token(text)
+                            yield GenerationChunk(text=text)
+                        self._metrics.incr("prompt_tokens", len(prompt) // 4)
+                        self._metrics.incr("completion_tokens", completion // 4)
+                        return
+                    finally:
+                        self._metrics.incr("upstream_seconds", time.monotonic() - started)
+                        self._metrics.in_flight -= 1
+                finally:
+                    self._semaphore.release()
+            except LLMDeadlineExceeded:
+                self._metrics.incr("deadline_exceeded")
+                raise
+            except Exception as exc:
+                delay = self._backoff(attempt)
+                if streamed or not is_retryable(exc) or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                    self._metrics.incr("failures")
+                    if isinstance(exc, asyncio.TimeoutError):
+                        self._metrics.incr("deadline_exceeded")
+                        raise LLMDeadlineExceeded("LLM call exceeded its deadline.") from exc
+                    raise
+                self._metrics.incr("retries")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    # --- Sync path (kept for completeness; the app itself only calls the LLM asynchronously) ---
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        self._metrics.incr("calls")
+        deadline = time.monotonic() + self.timeout_seconds
+        attempt = 0
+        while True:
+            wait = self._bucket.take()
+            if wait:
+                time.sleep(wait)
+                continue
+            with self._sync_semaphore:
+                try:
+                    self._metrics.incr("upstream_calls")
+                    return self.inner.invoke(prompt, stop=stop, **kwargs)
+                except Exception as exc:
+                    delay = self._backoff(attempt)
+                    if not is_retryable(exc) or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                        self._metrics.incr("failures")
+                        raise
+            self._metrics.incr("retries")
+            attempt += 1
+            time.sleep(delay)
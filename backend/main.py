@@ -1,7 +1,13 @@
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from .database import engine, Base
-from .routers import authentication, documents, interactions, flashcards
+from .routers import authentication, documents, interactions, flashcards, export
+from . import crud, context, observability
+from .http_cache import CompressionMiddleware
+from .spooling import UploadLimitMiddleware
+from .replicas import ReadYourWritesMiddleware
 
 
 Base.metadata.create_all(bind=engine)
@@ -22,10 +28,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Added before the metrics middleware so latency includes compression.
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(UploadLimitMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    observability.HTTP_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        observability.HTTP_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        observability.HTTP_DURATION.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status,
+        )
+
+
+def _gateway_metrics():
+    lines = []
+    for name, value in crud.llm.metrics.snapshot().items():
+        metric = f"studybuddy_llm_{name}" if name == "in_flight" else f"studybuddy_llm_{name}_total"
+        kind = "gauge" if name == "in_flight" else "counter"
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {value}"]
+    return lines
+
+
+def _context_metrics():
+    lines = []
+    for name, value in context.default_packer.stats.items():
+        metric = f"studybuddy_context_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    saving = context.default_packer.saving()
+    if saving is not None:
+        lines += ["# TYPE studybuddy_context_saving_ratio gauge", f"studybuddy_context_saving_ratio {round(saving, 4)}"]
+    return lines
+
+
+observability.register_collector(_gateway_metrics)
+observability.register_collector(_context_metrics)
+
 app.include_router(authentication.router)
 app.include_router(documents.router)
 app.include_router(interactions.router)
 app.include_router(flashcards.router)
+app.include_router(export.router)
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    return PlainTextResponse(observability.render_prometheus(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def read_root():
@@ -0,0 +1,151 @@
+# maintenance.py
+"""
+Offline maintenance jobs. Run from the project root, with the same
+environment (.env) as the API:
+
+    python -m backend.maintenance archive-chat [--hot-window 200] [--min-age-days 30] [--dry-run]
+    python -m backend.maintenance rechunk [--document-id 12 ...] [--chunk-size 1000] [--chunk-overlap 200]
+    python -m backend.maintenance backfill-reviews
+    python -m backend.maintenance reembed --model BAAI/bge-small-en-v1.5 [--index-factory SQfp16] [--workers 4] [--swap-at-end]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import exists, insert, literal, select
+
+from . import models, chat_archive, ingestion, text_store, spaced_repetition, reembed as reembed_job
+from .database import Base, SessionLocal, engine
+from .observability import logger
+
+
+def archive_chat(args):
+    db = SessionLocal()
+    try:
+        results = chat_archive.archive_all(db, args.hot_window, args.min_age_days, dry_run=args.dry_run)
+    finally:
+        db.close()
+    totals = {key: sum(r[key] for r in results) for key in ("messages", "segments", "raw_bytes", "compressed_bytes")}
+    totals["documents"] = len([r for r in results if r["messages"]])
+    if totals["compressed_bytes"]:
+        totals["compression_ratio"] = round(totals["raw_bytes"] / totals["compressed_bytes"], 2)
+    print(json.dumps({"dry_run": args.dry_run, **totals}, indent=2))
+
+
+def rechunk(args):
+    # Imported here: crud loads the embedding model, which archive-chat does not need.
+    from . import crud
+
+    db = SessionLocal()
+    results, skipped, failed = [], [], []
+    started = time.perf_counter()
+
+    async def run():
+        # One event loop for the whole run, so loop-bound state (embedding batchers, the LLM gateway) is reused.
+        query = db.query(models.Document).order_by(models.Document.id)
+        if args.document_id:
+            query = query.filter(models.Document.id.in_(args.document_id))
+        for document in query.all():
+            if not text_store.exists(document.content_hash):
+                skipped.append(document.id)
+                continue
+            try:
+                results.append(await crud.rechunk_document(db, document, args.chunk_size, args.chunk_overlap))
+                # Re-chunking clears the question bank; refill it here, as there is no request to defer to.
+                await crud.refill_question_bank(document.id)
+            except Exception as e:
+                db.rollback()
+                logger.warning("Re-chunking document %s failed: %s", document.id, e)
+                failed.append(document.id)
+
+    try:
+        asyncio.run(run())
+    finally:
+        db.close()
+    print(json.dumps({
+        "chunk_size": args.chunk_size,
+        "chunk_overlap": args.chunk_overlap,
+        "documents": len(results),
+        "chunks_before": sum(r["chunks_before"] for r in results),
+        "chunks_after": sum(r["chunks_after"] for r in results),
+        "skipped_without_text": skipped,
+        "failed": failed,
+        "seconds": round(time.perf_counter() - started, 2),
+    }, indent=2))
+
+
+def backfill_reviews(args):
+    """Gives cards created before spaced repetition a schedule that is due now, in one INSERT ... SELECT."""
+    missing = select(
+        models.FlashcardSet.user_id, models.Flashcard.id, literal(spaced_repetition.INITIAL_EASINESS),
+        literal(0), literal(0), literal(0), literal(datetime.utcnow()),
+    ).join(models.FlashcardSet, models.FlashcardSet.id == models.Flashcard.set_id).where(
+        ~exists().where(
+            models.FlashcardReview.card_id == models.Flashcard.id,
+            models.FlashcardReview.user_id == models.FlashcardSet.user_id,
+        )
+    )
+    statement = insert(models.FlashcardReview).from_select(
+        ["user_id", "card_id", "easiness", "interval_days", "repetitions", "lapses", "due_at"], missing
+    )
+    db = SessionLocal()
+    try:
+        created = db.execute(statement).rowcount
+        db.commit()
+    finally:
+        db.close()
+    print(json.dumps({"reviews_created": created}, indent=2))
+
+
+def reembed(args):
+    report = reembed_job.run(
+        args.model, args.index_factory, workers=args.workers, checkpoint_path=args.checkpoint,
+        document_ids=args.document_id, swap_at_end=args.swap_at_end, restart=args.restart,
+        dry_run=args.dry_run, remove_orphans=args.remove_orphans, batch_size=args.batch_size,
+    )
+    print(json.dumps({"dry_run": args.dry_run, **report}, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive = commands.add_parser("archive-chat", help="move old chat turns into compressed monthly archives")
+    archive.add_argument("--hot-window", type=int, default=chat_archive.CHAT_HOT_WINDOW, help="messages kept hot per document")
+    archive.add_argument("--min-age-days", type=int, default=chat_archive.CHAT_ARCHIVE_MIN_AGE_DAYS)
+    archive.add_argument("--dry-run", action="store_true", help="report what would move without changing anything")
+    archive.set_defaults(func=archive_chat)
+
+    rechunk_cmd = commands.add_parser("rechunk", help="re-chunk and re-embed documents from their stored text")
+    rechunk_cmd.add_argument("--document-id", type=int, action="append", help="limit to these documents (repeatable)")
+    rechunk_cmd.add_argument("--chunk-size", type=int, default=ingestion.CHUNK_SIZE)
+    rechunk_cmd.add_argument("--chunk-overlap", type=int, default=ingestion.CHUNK_OVERLAP)
+    rechunk_cmd.set_defaults(func=rechunk)
+
+    backfill = commands.add_parser("backfill-reviews", help="schedule flashcards that have no review state yet")
+    backfill.set_defaults(func=backfill_reviews)
+
+    reembed_cmd = commands.add_parser("reembed", help="rebuild every document's vector store with a new embedder or index")
+    reembed_cmd.add_argument("--model", default=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"), help="sentence-transformers model name")
+    reembed_cmd.add_argument("--index-factory", default=reembed_job.DEFAULT_INDEX_FACTORY, help="FAISS index factory string: Flat, or SQfp16 for half the memory")
+    reembed_cmd.add_argument("--workers", type=int, default=2, help="embedding processes")
+    reembed_cmd.add_argument("--batch-size", type=int, default=None, help="chunks per embedding call (default INGEST_EMBED_BATCH_SIZE)")
+    reembed_cmd.add_argument("--document-id", type=int, action="append", help="limit to these documents (repeatable)")
+    reembed_cmd.add_argument("--checkpoint", default=reembed_job.DEFAULT_CHECKPOINT, help="progress file; re-running resumes from it")
+    reembed_cmd.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    reembed_cmd.add_argument("--swap-at-end", action="store_true", help="build everything first, then swap all stores at once")
+    reembed_cmd.add_argument("--dry-run", action="store_true", help="report pending work and orphaned stores only")
+    reembed_cmd.add_argument("--remove-orphans", action="store_true", help="delete the orphaned store directories found")
+    reembed_cmd.set_defaults(func=reembed)
+
+    args = parser.parse_args()
+    # create_all adds missing tables only.
+    Base.metadata.create_all(bind=engine)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
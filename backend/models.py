@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, Text, DateTime, Float, Boolean, JSON, Index, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime
@@ -23,13 +23,28 @@ class Document(Base):
     filename = Column(String, index=True, nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     owner = relationship("User", back_populates="documents")
+    # Bumped whenever the document's contents change; caches of derived state compare against it.
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # SHA-256 of the extracted text in text_store; lets the document be re-chunked without its source file.
+    content_hash = Column(String(64), nullable=True, index=True)
     chat_messages = relationship("ChatHistory", back_populates="document", cascade="all, delete-orphan")
     # FIXED: This relationship was missing, causing the error.
     quiz_attempts = relationship("QuizAttempt", back_populates="document", cascade="all, delete-orphan")
     flashcard_sets = relationship("FlashcardSet", back_populates="document", cascade="all, delete-orphan")  # ✅ Added
+    bank_questions = relationship("BankQuestion", back_populates="document", cascade="all, delete-orphan")
+    chat_archives = relationship("ChatHistoryArchive", back_populates="document", cascade="all, delete-orphan")
+    quizzes = relationship("Quiz", back_populates="document", cascade="all, delete-orphan")
 
 
 
+class StoredText(Base):
+    """
+    One row per text_store entry. Its row lock serialises publishing the text
+    for an upload with deleting it once no document refers to it.
+    """
+    __tablename__ = "stored_texts"
+    content_hash = Column(String(64), primary_key=True)
+
 class ChatHistory(Base):
     __tablename__ = "chat_history"
     id = Column(Integer, primary_key=True, index=True)
@@ -41,6 +56,21 @@ class ChatHistory(Base):
     document = relationship("Document", back_populates="chat_messages")
     user = relationship("User", back_populates="chat_messages")
 
+class ChatHistoryArchive(Base):
+    """Older chat messages of one document and month, as zlib-compressed JSON (see chat_archive.py)."""
+    __tablename__ = "chat_history_archive"
+    __table_args__ = (Index("ix_chat_history_archive_document_last", "document_id", "last_id"),)
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
+    month = Column(String, nullable=False)  # "YYYY-MM"
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    document = relationship("Document", back_populates="chat_archives")
+
 class QuizAttempt(Base):
     __tablename__ = "quiz_attempts"
     id = Column(Integer, primary_key=True, index=True)
@@ -48,21 +78,78 @@ class QuizAttempt(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     score = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # The served quiz this attempt graded; NULL for attempts submitted before quizzes were stored.
+    quiz_id = Column(Integer, ForeignKey("quizzes.id"), nullable=True)
     
     document = relationship("Document", back_populates="quiz_attempts")
     user = relationship("User", back_populates="quiz_attempts")
     answers = relationship("QuizAnswer", back_populates="attempt", cascade="all, delete-orphan")
+    quiz = relationship("Quiz", back_populates="attempt")
 
 class QuizAnswer(Base):
     __tablename__ = "quiz_answers"
     id = Column(Integer, primary_key=True, index=True)
     attempt_id = Column(Integer, ForeignKey("quiz_attempts.id"), nullable=False)
-    question_text = Column(Text, nullable=False)
-    selected_answer = Column(Text, nullable=False)
-    correct_answer = Column(Text, nullable=False)
+    # Graded answers reference the bank question and the chosen option.
+    question_id = Column(Integer, ForeignKey("bank_questions.id"), nullable=True)
+    option_index = Column(Integer, nullable=True)
+    # Only set on attempts from before question_id existed, and on imported ones.
+    question_text = Column(Text, nullable=True)
+    selected_answer = Column(Text, nullable=True)
+    correct_answer = Column(Text, nullable=True)
     is_correct = Column(Boolean, nullable=False)
     
     attempt = relationship("QuizAttempt", back_populates="answers")
+    question = relationship("BankQuestion")
+
+class Quiz(Base):
+    """A quiz as served to a user; its questions are graded server-side on submission."""
+    __tablename__ = "quizzes"
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set when graded; a quiz can be submitted once.
+    submitted_at = Column(DateTime, nullable=True)
+
+    document = relationship("Document", back_populates="quizzes")
+    items = relationship("QuizItem", back_populates="quiz", cascade="all, delete-orphan", order_by="QuizItem.position")
+    attempt = relationship("QuizAttempt", back_populates="quiz", uselist=False)
+
+class QuizItem(Base):
+    __tablename__ = "quiz_items"
+    id = Column(Integer, primary_key=True, index=True)
+    quiz_id = Column(Integer, ForeignKey("quizzes.id"), nullable=False, index=True)
+    question_id = Column(Integer, ForeignKey("bank_questions.id"), nullable=False)
+    position = Column(Integer, nullable=False)
+
+    quiz = relationship("Quiz", back_populates="items")
+    question = relationship("BankQuestion")
+
+class BankQuestion(Base):
+    """A pre-generated quiz question; /generate-quiz samples from these."""
+    __tablename__ = "bank_questions"
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    question = Column(Text, nullable=False)
+    options = Column(JSON, nullable=False)
+    correct_answer = Column(Text, nullable=False)
+    explanation = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    document = relationship("Document", back_populates="bank_questions")
+    views = relationship("BankQuestionView", back_populates="question", cascade="all, delete-orphan")
+
+class BankQuestionView(Base):
+    """Records which bank questions a user was served, so repeats can be avoided."""
+    __tablename__ = "bank_question_views"
+    __table_args__ = (Index("ix_bank_question_views_user_seen", "user_id", "seen_at"),)
+    id = Column(Integer, primary_key=True, index=True)
+    question_id = Column(Integer, ForeignKey("bank_questions.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    seen_at = Column(DateTime, default=datetime.utcnow)
+
+    question = relationship("BankQuestion", back_populates="views")
 
 class FlashcardSet(Base):
     __tablename__ = "flashcard_sets"
@@ -83,4 +170,25 @@ class Flashcard(Base):
     front = Column(Text, nullable=False)
     back = Column(Text, nullable=False)
 
-    flashcard_set = relationship("FlashcardSet", back_populates="cards")
\ No newline at end of file
+    flashcard_set = relationship("FlashcardSet", back_populates="cards")
+    reviews = relationship("FlashcardReview", back_populates="card", cascade="all, delete-orphan")
+
+class FlashcardReview(Base):
+    """A user's SM-2 schedule for one card (see spaced_repetition.py)."""
+    __tablename__ = "flashcard_reviews"
+    __table_args__ = (
+        # Serves "next N due cards for this user" as one bounded index range scan.
+        Index("ix_flashcard_reviews_user_due", "user_id", "due_at"),
+        UniqueConstraint("user_id", "card_id", name="uq_flashcard_reviews_user_card"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    card_id = Column(Integer, ForeignKey("flashcards.id"), nullable=False)
+    easiness = Column(Float, nullable=False, default=2.5)
+    interval_days = Column(Integer, nullable=False, default=0)
+    repetitions = Column(Integer, nullable=False, default=0)
+    lapses = Column(Integer, nullable=False, default=0)
+    due_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_reviewed_at = Column(DateTime, nullable=True)
+
+    card = relationship("Flashcard", back_populates="reviews")
\ No newline at end of file
@@ -0,0 +1,239 @@
+# observability.py
+"""
+Tracing spans and Prometheus metrics for the RAG pipeline.
+
+``span("ask.retrieve")`` times a stage, records it in the
+``studybuddy_stage_duration_seconds`` histogram and, when the OpenTelemetry
+SDK is installed, opens a real OTel span. Without the SDK, spans are kept in a
+small in-memory ring buffer and can be written out as OTLP/JSON
+(``TRACE_EXPORT_FILE``), which any OpenTelemetry collector can ingest.
+
+``render_prometheus()`` produces the text served at ``/metrics``.
+"""
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional dependency
+    otel_trace = None
+
+logger = logging.getLogger("studybuddy")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 2000))
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+# --- Metric types ---
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name, self.help = name, help_text
+        self.values: Dict[LabelKey, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(k)} {v}" for k, v in sorted(self.values.items())]
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.buckets = name, help_text, tuple(buckets)
+        self.counts: Dict[LabelKey, List[int]] = {}
+        self.sums: Dict[LabelKey, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self.counts.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', str(bound)))} {cumulative}")
+                cumulative += counts[-1]
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {self.sums[key]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+_metrics: Dict[str, object] = {}
+# Callables returning extra exposition lines (e.g. the LLM gateway's counters).
+_collectors: List[Callable[[], List[str]]] = []
+
+
+def _register(metric):
+    return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return _register(Counter(name, help_text))
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    return _register(Gauge(name, help_text))
+
+
+def histogram(name: str, help_text: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, buckets))
+
+
+def register_collector(collector: Callable[[], List[str]]):
+    _collectors.append(collector)
+
+
+def render_prometheus() -> str:
+    lines: List[str] = []
+    for metric in _metrics.values():
+        lines += metric.render()
+    for collector in _collectors:
+        try:
+            lines += collector()
+        except Exception as exc:
+            logger.warning("Metrics collector failed: %s", exc)
+    return "\n".join(lines) + "\n"
+
+
+STAGE_DURATION = histogram("studybuddy_stage_duration_seconds", "Duration of pipeline stages.")
+STAGE_ERRORS = counter("studybuddy_stage_errors_total", "Pipeline stages that raised.")
+HTTP_DURATION = histogram("studybuddy_http_request_duration_seconds", "HTTP request latency by route.")
+HTTP_IN_FLIGHT = gauge("studybuddy_http_requests_in_flight", "HTTP requests currently being served.")
+CACHE_REQUESTS = counter("studybuddy_cache_requests_total", "Cache lookups by cache and result.")
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+# --- Spans ---
+_current_span: contextvars.ContextVar = contextvars.ContextVar("studybuddy_span", default=None)
+_finished_spans: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_export_lock = threading.Lock()
+
+
+class SpanRecord:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent: Optional["SpanRecord"], attributes: dict):
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes)
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def export_otlp_json(spans: Optional[List[SpanRecord]] = None) -> dict:
+    """Buffered spans as an OTLP/JSON ExportTraceServiceRequest."""
+    spans = list(_finished_spans) if spans is None else spans
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "ai-study-buddy-api"}}]},
+            "scopeSpans": [{"scope": {"name": "backend.observability"}, "spans": [s.to_otlp() for s in spans]}],
+        }]
+    }
+
+
+def _finish(record: SpanRecord):
+    _finished_spans.append(record)
+    if TRACE_EXPORT_FILE and record.parent_id is None:
+        # One OTLP/JSON line per finished root span and its children.
+        trace = [s for s in _finished_spans if s.trace_id == record.trace_id]
+        with _export_lock, open(TRACE_EXPORT_FILE, "a") as fh:
+            fh.write(json.dumps(export_otlp_json(trace)) + "\n")
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times a pipeline stage; usable in sync and async code alike."""
+    parent = _current_span.get()
+    record = SpanRecord(name, parent, attributes)
+    token = _current_span.set(record)
+    otel_cm = otel_trace.get_tracer("backend").start_as_current_span(name, attributes=attributes) if otel_trace else None
+    otel_span = otel_cm.__enter__() if otel_cm else None
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as exc:
+        record.error = f"{type(exc).__name__}: {exc}"
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started, stage=name)
+        record.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if otel_cm:
+            for key, value in record.attributes.items():
+                otel_span.set_attribute(key, str(value))
+            otel_cm.__exit__(None, None, None)
+        _finish(record)
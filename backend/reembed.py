@@ -0,0 +1,410 @@
+# reembed.py
+"""
+Bulk re-embedding of the per-document FAISS stores (`faiss` backend).
+
+Each document's chunks are read from its current store and embedded again in
+a pool of worker processes. The new index is built with the configured FAISS
+index factory string. Chunk texts, metadata and docstore ids are kept, so the
+BM25 index next to the store stays valid and is copied over.
+
+Every store records the model it was embedded with in `embedding.json`, and
+the API embeds queries for a store with that model. Stores on the old and the
+new model therefore both keep working while a run is in progress. Documents
+uploaded during the run are picked up before it finishes.
+
+A new store is written to its own directory under `vector_stores/.generations`.
+`doc_{id}` is then pointed at it by replacing a symlink, which is a single
+rename, so readers see either the old store or the new one and never a
+partial write. The document's version is bumped so every worker reloads it.
+The first swap of a store that is still a plain directory needs two renames;
+for that moment the store is missing rather than half-written.
+
+Progress goes to a checkpoint file after every document. Running the same
+command again resumes where it stopped.
+"""
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from multiprocessing import get_context
+from typing import Dict, List, Optional
+
+from .observability import logger
+
+GENERATIONS_DIRECTORY = ".generations"
+STORE_MANIFEST = "embedding.json"
+DEFAULT_INDEX_FACTORY = "Flat"
+DEFAULT_CHECKPOINT = "reembed_checkpoint.json"
+
+_worker_embeddings = None
+
+
+# --- Manifest ---
+def write_manifest(store_path: str, model_name: str, index_factory: str, dimension: int, chunks: int):
+    with open(os.path.join(store_path, STORE_MANIFEST), "w") as fh:
+        json.dump({
+            "model": model_name,
+            "index_factory": index_factory,
+            "dimension": dimension,
+            "chunks": chunks,
+            "created_at": datetime.utcnow().isoformat(),
+        }, fh)
+
+
+def read_manifest(store_path: str) -> Optional[dict]:
+    """The store's manifest, or None for stores written before manifests existed."""
+    path = os.path.join(store_path, STORE_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def check_index_factory(index_factory: str):
+    """
+    Rejects index types the API cannot maintain. Stores are appended to without
+    ids and have chunks removed by id when a document is replaced, and an index
+    that needs training cannot be built for a document with a few chunks.
+    """
+    import faiss
+    import numpy as np
+
+    try:
+        index = faiss.index_factory(8, index_factory)
+    except RuntimeError as e:
+        raise SystemExit(f"Invalid index factory {index_factory!r}: {e}")
+    if not index.is_trained:
+        raise SystemExit(f"Index factory {index_factory!r} needs training; use one that does not, such as Flat or SQfp16.")
+    try:
+        index.add(np.zeros((1, 8), dtype="float32"))
+        index.remove_ids(np.array([0], dtype="int64"))
+    except RuntimeError:
+        raise SystemExit(f"Index factory {index_factory!r} cannot add and remove vectors by position; use Flat or SQfp16.")
+
+
+# --- Worker processes ---
+def _init_worker(model_name: str, threads: int):
+    global _worker_embeddings
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def build_store(document_id: int, source: str, target: str, model_name: str, index_factory: str, batch_size: int) -> dict:
+    """Re-embeds the store at `source` into a new directory `target`; runs in a worker process."""
+    import faiss
+    import numpy as np
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+
+    started = time.perf_counter()
+    try:
+        store = FAISS.load_local(source, _worker_embeddings, allow_dangerous_deserialization=True)
+        ids = list(store.index_to_docstore_id.values())
+        chunks = [store.docstore.search(key) for key in ids]
+        texts = [chunk.page_content for chunk in chunks]
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            vectors.extend(_worker_embeddings.embed_documents(texts[start:start + batch_size]))
+        matrix = np.asarray(vectors, dtype="float32")
+
+        index = faiss.index_factory(matrix.shape[1], index_factory)
+        if not index.is_trained:
+            index.train(matrix)
+        index.add(matrix)
+        rebuilt = FAISS(_worker_embeddings, index, InMemoryDocstore(dict(zip(ids, chunks))), dict(enumerate(ids)))
+
+        os.makedirs(target)
+        rebuilt.save_local(target)
+        bm25 = os.path.join(source, "bm25.json.gz")
+        if os.path.exists(bm25):
+            shutil.copy2(bm25, os.path.join(target, "bm25.json.gz"))
+        write_manifest(target, model_name, index_factory, int(matrix.shape[1]), len(ids))
+    except BaseException:
+        shutil.rmtree(target, ignore_errors=True)
+        raise
+    return {"document_id": document_id, "chunks": len(ids), "seconds": time.perf_counter() - started}
+
+
+# --- Atomic swap ---
+def new_generation_path(root: str, document_id: int) -> str:
+    return os.path.join(root, GENERATIONS_DIRECTORY, f"doc_{document_id}-{uuid.uuid4().hex[:12]}")
+
+
+def swap_store(store_path: str, generation: str) -> Optional[str]:
+    """Points `store_path` at `generation`; returns the directory it replaced, for the caller to delete."""
+    # Unique per call, so two swaps of the same store cannot trip over each other's link.
+    link = f"{store_path}.swap-{uuid.uuid4().hex[:12]}"
+    os.symlink(os.path.relpath(generation, os.path.dirname(store_path)), link)
+    previous = None
+    if os.path.islink(store_path):
+        previous = os.path.realpath(store_path)
+    elif os.path.isdir(store_path):
+        previous = store_path + ".old"
+        os.rename(store_path, previous)
+    os.replace(link, store_path)
+    return previous
+
+
+def remove_store(store_path: str):
+    """Deletes a store, whether it is a plain directory or a symlink to a generation."""
+    if os.path.islink(store_path):
+        generation = os.path.realpath(store_path)
+        os.unlink(store_path)
+        shutil.rmtree(generation, ignore_errors=True)
+    elif os.path.exists(store_path):
+        shutil.rmtree(store_path)
+
+
+# --- Checkpoint ---
+class Checkpoint:
+    """Finished, built-but-not-swapped and failed documents of one run, rewritten atomically after each change."""
+
+    def __init__(self, path: str, model: str, index_factory: str):
+        self.path = path
+        self.state = {"model": model, "index_factory": index_factory, "done": [], "built": {}, "failed": {}}
+
+    @classmethod
+    def load(cls, path: str, model: str, index_factory: str, restart: bool = False) -> "Checkpoint":
+        checkpoint = cls(path, model, index_factory)
+        if restart or not os.path.exists(path):
+            return checkpoint
+        with open(path) as fh:
+            state = json.load(fh)
+        if (state.get("model"), state.get("index_factory")) != (model, index_factory):
+            raise SystemExit(
+                f"{path} is for model {state.get('model')!r} with index {state.get('index_factory')!r}; "
+                "pass --restart to discard it."
+            )
+        checkpoint.state.update(state)
+        # Failures are retried on resume.
+        checkpoint.state["failed"] = {}
+        return checkpoint
+
+    @property
+    def done(self) -> set:
+        return set(self.state["done"])
+
+    @property
+    def built(self) -> Dict[str, dict]:
+        return self.state["built"]
+
+    def mark_built(self, document_id: int, generation: str, version: int, chunks: int):
+        self.state["built"][str(document_id)] = {"generation": generation, "version": version, "chunks": chunks}
+        self.save()
+
+    def mark_done(self, document_id: int):
+        self.state["built"].pop(str(document_id), None)
+        self.state["done"].append(document_id)
+        self.save()
+
+    def mark_failed(self, document_id: int, error: str):
+        self.state["built"].pop(str(document_id), None)
+        self.state["failed"][str(document_id)] = error
+        self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self.state, fh)
+        os.replace(tmp, self.path)
+
+
+# --- Orphans ---
+def _tree_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path) for name in files
+        if not os.path.islink(os.path.join(root, name))
+    )
+
+
+def find_orphans(root: str, document_ids: set, keep_generations: set = frozenset()) -> List[dict]:
+    """Store directories with no Document row, leftovers of interrupted swaps and unreferenced generations."""
+    if not os.path.isdir(root):
+        return []
+    orphans, referenced = [], set(keep_generations)
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if name in ("shards", GENERATIONS_DIRECTORY):
+            continue
+        suffix = name[len("doc_"):]
+        if name.startswith("doc_") and suffix.isdigit() and int(suffix) in document_ids:
+            if os.path.islink(path):
+                referenced.add(os.path.realpath(path))
+            continue
+        orphans.append({"path": path, "bytes": _tree_bytes(path)})
+    generations = os.path.join(root, GENERATIONS_DIRECTORY)
+    if os.path.isdir(generations):
+        for name in sorted(os.listdir(generations)):
+            path = os.path.join(generations, name)
+            if os.path.realpath(path) not in referenced:
+                orphans.append({"path": path, "bytes": _tree_bytes(path)})
+    return orphans
+
+
+def _remove_path(path: str):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# --- Driver ---
+def run(
+    model_name: str,
+    index_factory: str = DEFAULT_INDEX_FACTORY,
+    workers: int = 2,
+    checkpoint_path: str = DEFAULT_CHECKPOINT,
+    document_ids: Optional[List[int]] = None,
+    swap_at_end: bool = False,
+    restart: bool = False,
+    dry_run: bool = False,
+    remove_orphans: bool = False,
+    batch_size: Optional[int] = None,
+) -> dict:
+    # Imported here so worker processes, which import this module, do not load the API's models.
+    from sqlalchemy import update
+    from . import crud, ingestion, models
+    from .database import SessionLocal
+
+    if crud.sharded_store is not None:
+        raise SystemExit("reembed rebuilds per-document stores; with the sharded backend use `rechunk` with EMBEDDING_MODEL set.")
+    check_index_factory(index_factory)
+
+    root = crud.VECTOR_STORE_DIRECTORY
+    db = SessionLocal()
+    try:
+        def document_rows():
+            db.commit()  # ends the read transaction, so documents committed since are seen
+            query = db.query(models.Document.id, models.Document.version).order_by(models.Document.id)
+            if document_ids:
+                query = query.filter(models.Document.id.in_(document_ids))
+            return query.all()
+
+        rows = document_rows()
+        all_ids = {document_id for (document_id,) in db.query(models.Document.id)}
+
+        checkpoint = Checkpoint.load(checkpoint_path, model_name, index_factory, restart=restart)
+        done = checkpoint.done
+        pending = [(i, v) for i, v in rows if i not in done and str(i) not in checkpoint.built]
+        missing = [i for i, _ in pending if not os.path.exists(crud._vector_store_path(i))]
+        pending = [(i, v) for i, v in pending if i not in missing]
+        orphans = find_orphans(root, all_ids, {os.path.realpath(b["generation"]) for b in checkpoint.built.values()})
+
+        report = {
+            "model": model_name,
+            "index_factory": index_factory,
+            "documents": len(rows),
+            "already_done": len([i for i, _ in rows if i in done]),
+            "to_build": len(pending),
+            "built_awaiting_swap": len(checkpoint.built),
+            "missing_store": missing,
+            "orphans": orphans,
+            "orphan_bytes": sum(o["bytes"] for o in orphans),
+        }
+        if dry_run:
+            return report
+
+        retired, failed = [], {}
+
+        def swap(document_id: int, generation: str, version: int):
+            # A document changed since its build would lose that change; leave it for the next run.
+            current = db.query(models.Document.version).filter(models.Document.id == document_id).scalar()
+            if current != version:
+                shutil.rmtree(generation, ignore_errors=True)
+                checkpoint.mark_failed(document_id, "changed during re-embedding")
+                failed[document_id] = "changed during re-embedding"
+                return
+            previous = swap_store(crud._vector_store_path(document_id), generation)
+            if previous:
+                retired.append(previous)
+            db.execute(
+                update(models.Document)
+                .where(models.Document.id == document_id, models.Document.version == version)
+                .values(version=models.Document.version + 1)
+            )
+            db.commit()
+            checkpoint.mark_done(document_id)
+
+        rebuilt, chunks, build_seconds, picked_up = 0, 0, 0.0, 0
+        started = time.perf_counter()
+        threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+        os.makedirs(os.path.join(root, GENERATIONS_DIRECTORY), exist_ok=True)
+        seen = done | {int(i) for i in checkpoint.built} | {i for i, _ in pending} | set(missing)
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("spawn"),
+            initializer=_init_worker, initargs=(model_name, threads),
+        ) as pool:
+            while pending:
+                futures = {}
+                for document_id, version in pending:
+                    generation = new_generation_path(root, document_id)
+                    future = pool.submit(
+                        build_store, document_id, crud._vector_store_path(document_id), generation,
+                        model_name, index_factory, batch_size or ingestion.EMBED_BATCH_SIZE,
+                    )
+                    futures[future] = (document_id, version, generation)
+                for finished, future in enumerate(as_completed(futures), start=1):
+                    document_id, version, generation = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning("Re-embedding document %s failed: %s", document_id, e)
+                        checkpoint.mark_failed(document_id, str(e))
+                        failed[document_id] = str(e)
+                        continue
+                    rebuilt += 1
+                    chunks += result["chunks"]
+                    build_seconds += result["seconds"]
+                    elapsed = time.perf_counter() - started
+                    print(f"[{finished}/{len(futures)}] document {document_id}: {result['chunks']} chunks in "
+                          f"{result['seconds']:.1f}s ({chunks / elapsed:.1f} chunks/s overall)")
+                    if swap_at_end:
+                        checkpoint.mark_built(document_id, generation, version, result["chunks"])
+                    else:
+                        swap(document_id, generation, version)
+                # Documents uploaded meanwhile were embedded by the API's model; rebuild them as well.
+                pending = [(i, v) for i, v in document_rows() if i not in seen and os.path.exists(crud._vector_store_path(i))]
+                seen.update(i for i, _ in pending)
+                picked_up += len(pending)
+        elapsed = time.perf_counter() - started
+
+        # Builds from this run and from interrupted earlier runs are swapped together, just before deploy.
+        for document_id, built in list(checkpoint.built.items()):
+            if os.path.isdir(built["generation"]):
+                swap(int(document_id), built["generation"], built["version"])
+            else:
+                checkpoint.mark_failed(int(document_id), "built store is missing")
+                failed[int(document_id)] = "built store is missing"
+        # Replaced stores are deleted last, so readers that opened one before its swap can finish loading it.
+        for path in retired:
+            shutil.rmtree(path, ignore_errors=True)
+
+        if remove_orphans:
+            for orphan in orphans:
+                _remove_path(orphan["path"])
+
+        report.update({
+            "rebuilt": rebuilt,
+            "uploaded_during_run": picked_up,
+            "failed": failed,
+            "chunks": chunks,
+            "seconds": round(elapsed, 2),
+            "documents_per_second": round(rebuilt / elapsed, 3) if elapsed else None,
+            "chunks_per_second": round(chunks / elapsed, 1) if elapsed else None,
+            "mean_seconds_per_document": round(build_seconds / rebuilt, 2) if rebuilt else None,
+            "orphans_removed": remove_orphans,
+        })
+        return report
+    finally:
+        db.close()
@@ -0,0 +1,169 @@
+# replicas.py
+"""
+Read-replica routing.
+
+Read-only endpoints (listings, history, progress reports, exports) take their
+session from `get_read_db` instead of `get_db`. With READ_REPLICA_URLS set,
+these sessions go round-robin to the replicas that passed their last health
+check. If none did, they fall back to the primary. Without replicas,
+`get_read_db` is the same as `get_db`.
+
+Read-your-writes: ReadYourWritesMiddleware marks a client after any
+POST/PUT/PATCH/DELETE. For READ_YOUR_WRITES_SECONDS after that, the client's
+reads go to the primary, so a lagging replica never hides what they just
+wrote. Marks are kept in Redis when the response cache uses it, so every
+worker sees them; otherwise they are per process.
+
+To try it locally, copy the SQLite file and point a replica at the copy
+(DATABASE_URL=sqlite:///./app.db, READ_REPLICA_URLS=sqlite:///./replica.db),
+or run two local Postgres instances with streaming replication.
+"""
+import hashlib
+import itertools
+import os
+import threading
+from typing import Iterator, List, Optional
+
+from fastapi import Request
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import observability
+from .cache import MemoryBackend, RedisBackend, response_cache
+from .database import SessionLocal
+
+READ_REPLICA_URLS = [url.strip() for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_HEALTH_CHECK_SECONDS = float(os.getenv("REPLICA_HEALTH_CHECK_SECONDS", 10))
+# A Postgres replica further behind than this is treated as unhealthy (0 disables the check).
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 30))
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+READ_SESSIONS = observability.counter("studybuddy_read_sessions_total", "Read-only sessions by target (replica index or primary).")
+REPLICA_HEALTHY = observability.gauge("studybuddy_replica_healthy", "1 if the replica passed its last health check.")
+
+
+class ReplicaPool:
+    def __init__(self, urls: List[str]):
+        self.urls = urls
+        self.engines = [
+            create_engine(
+                url,
+                pool_pre_ping=True,
+                connect_args={"check_same_thread": False} if url.startswith("sqlite") else {},
+            )
+            for url in urls
+        ]
+        self.session_factories = [sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in self.engines]
+        self.healthy = [True] * len(urls)
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _probe(self, i: int) -> bool:
+        try:
+            with self.engines[i].connect() as conn:
+                conn.execute(text("SELECT 1"))
+                if REPLICA_MAX_LAG_SECONDS and self.engines[i].dialect.name == "postgresql":
+                    lag = conn.execute(text(
+                        "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+                    )).scalar()
+                    if lag is not None and float(lag) > REPLICA_MAX_LAG_SECONDS:
+                        return False
+            return True
+        except Exception as e:
+            observability.logger.warning("Read replica %s failed its health check: %s", i, e)
+            return False
+
+    def check(self):
+        for i in range(len(self.engines)):
+            healthy = self._probe(i)
+            if healthy != self.healthy[i]:
+                if healthy:
+                    observability.logger.info("Read replica %s is healthy again.", i)
+                else:
+                    observability.logger.warning("Read replica %s is out of rotation.", i)
+            self.healthy[i] = healthy
+            REPLICA_HEALTHY.set(1 if healthy else 0, replica=i)
+
+    def start_health_checks(self, interval_seconds: float = REPLICA_HEALTH_CHECK_SECONDS):
+        if self._thread is not None or not self.engines:
+            return
+
+        def run():
+            while not self._stop.wait(interval_seconds):
+                self.check()
+
+        self.check()
+        self._thread = threading.Thread(target=run, name="replica-health", daemon=True)
+        self._thread.start()
+
+    def session(self) -> Session:
+        """A session on the next healthy replica, or on the primary if there is none."""
+        for _ in range(len(self.engines)):
+            i = next(self._counter) % len(self.engines)
+            if self.healthy[i]:
+                READ_SESSIONS.inc(target=i)
+                return self.session_factories[i]()
+        READ_SESSIONS.inc(target="primary")
+        return SessionLocal()
+
+    def close(self):
+        self._stop.set()
+        for engine in self.engines:
+            engine.dispose()
+
+
+replica_pool = ReplicaPool(READ_REPLICA_URLS)
+replica_pool.start_health_checks()
+
+
+# A private memory backend unless Redis is available: marks must not be evicted by cached responses.
+_marks = response_cache.backend if isinstance(response_cache.backend, RedisBackend) else MemoryBackend(max_bytes=4 * 1024 * 1024)
+
+
+def _client_key(request: Request) -> str:
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return "ryw:" + hashlib.sha256(authorization.encode("utf-8")).hexdigest()[:32]
+    return f"ryw:ip:{request.client.host if request.client else 'unknown'}"
+
+
+def _wrote_recently(request: Request) -> bool:
+    return _marks.get(_client_key(request)) is not None
+
+
+def read_session(request: Request) -> Session:
+    """Session for a read-only request: a replica, unless this client just wrote."""
+    if not replica_pool.engines or _wrote_recently(request):
+        if replica_pool.engines:
+            READ_SESSIONS.inc(target="primary")
+        return SessionLocal()
+    return replica_pool.session()
+
+
+def get_read_db(request: Request) -> Iterator[Session]:
+    """Dependency like get_db, for endpoints that only read."""
+    db = read_session(request)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+class ReadYourWritesMiddleware:
+    """Marks clients that send a write, so their next reads are served by the primary."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replica_pool.engines or scope["method"] not in WRITE_METHODS:
+            return await self.app(scope, receive, send)
+        key = _client_key(Request(scope))
+        # Marked before and after: reads racing the write and reads right after it both see the primary.
+        _marks.set(key, b"1", READ_YOUR_WRITES_SECONDS)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _marks.set(key, b"1", READ_YOUR_WRITES_SECONDS)
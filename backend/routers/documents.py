@@ -1,8 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, BackgroundTasks, Request, Response, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from .. import models, auth, crud, schemas 
 from ..database import get_db
+from ..replicas import get_read_db
+from ..http_cache import not_modified
+from ..cache import response_cache
 
 router = APIRouter(
     prefix="/documents",
@@ -11,30 +14,82 @@ router = APIRouter(
 
 @router.post("/upload", response_model=schemas.DocumentResponse)
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     current_user: Optional[dict] = Depends(auth.get_current_user)
 ):
-    return await crud.create_document(db=db, file=file, user=current_user)
+    document = await crud.create_document(db=db, file=file, user=current_user)
+    # Warm the quiz question bank so the first quiz is served instantly.
+    background_tasks.add_task(crud.refill_question_bank, document.id)
+    return document
+
+@router.post("/upload-batch", response_model=schemas.BatchUploadResponse)
+async def upload_documents_batch(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    db: Session = Depends(get_db),
+    current_user: Optional[dict] = Depends(auth.get_current_user)
+):
+    """Upload several files at once; each file's outcome is reported separately."""
+    result = await crud.create_documents_batch(db=db, files=files, user=current_user)
+    for item in result["documents"]:
+        if item["document"] is not None:
+            background_tasks.add_task(crud.refill_question_bank, item["document"].id)
+    return result
+
+@router.put("/{document_id}/content", response_model=schemas.DocumentReindexResponse)
+async def replace_document_contents(
+    document_id: int,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Replace a document's file, re-embedding only the chunks that changed."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    user = crud.get_user_from_db(db, current_user["email"])
+    return await crud.replace_document_contents(db=db, document_id=document_id, file=file, user_id=user.id, background_tasks=background_tasks)
 
 @router.get("/", response_model=List[schemas.DocumentResponse])
 def get_user_documents(
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     current_user: dict = Depends(auth.get_current_user)
 ):
     if not current_user:
         raise HTTPException(status_code=401, detail="Authentication required")
-    return crud.get_user_documents(db=db, user_email=current_user["email"])
+    user = crud.get_user_from_db(db, current_user["email"])
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if cached := not_modified(request, response, f"documents:{user.id}", crud.documents_stamp(db, user.id)):
+        return cached
+    return response_cache.json_response(
+        response, f"documents:{user.id}", [("documents", user.id)], List[schemas.DocumentResponse],
+        lambda: crud.get_user_documents(db=db, user_email=current_user["email"]),
+    )
 
 
 
 @router.get("/{document_id}/history", response_model=List[schemas.ChatMessage])
 def get_document_chat_history(
     document_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    db: Session = Depends(get_read_db),
 ):
-   
-    return crud.get_chat_history(db=db, document_id=document_id)
+    """Chat history, oldest first. Page backwards by passing the first returned message's id as `before_id`."""
+    page = f"history:{document_id}:{before_id}:{limit}"
+    if cached := not_modified(request, response, page, crud.chat_history_stamp(db, document_id)):
+        return cached
+    return response_cache.json_response(
+        response, page, [("doc", document_id), ("chat", document_id)], List[schemas.ChatMessage],
+        lambda: crud.get_chat_history(db=db, document_id=document_id, before_id=before_id, limit=limit),
+    )
 
 @router.delete("/{document_id}", status_code=200)
 def delete_document(
@@ -50,7 +105,9 @@ def delete_document(
 @router.get("/{document_id}/progress-report", response_model=schemas.ProgressReportResponse)
 def get_document_progress_report(
     document_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     current_user: dict = Depends(auth.get_current_user)
 ):
     if not current_user:
@@ -59,5 +116,12 @@ def get_document_progress_report(
     user = crud.get_user_from_db(db, current_user["email"])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    # The report is derived entirely from the quiz attempts.
+    if cached := not_modified(request, response, f"progress:{user.id}:{document_id}", crud.quiz_history_stamp(db, user.id, document_id)):
+        return cached
 
-    return crud.get_progress_report_for_document(db=db, user_id=user.id, document_id=document_id)
\ No newline at end of file
+    return response_cache.json_response(
+        response, f"progress:{user.id}:{document_id}", [("doc", document_id), ("quiz", user.id, document_id)],
+        schemas.ProgressReportResponse,
+        lambda: crud.get_progress_report_for_document(db=db, user_id=user.id, document_id=document_id),
+    )
\ No newline at end of file
@@ -0,0 +1,276 @@
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from typing import Optional
+from datetime import datetime
+import gzip
+import json
+import zlib
+from .. import auth, crud, models, chat_archive
+from ..cache import response_cache
+from ..database import get_db
+from ..replicas import get_read_db, read_session
+
+router = APIRouter(
+    prefix="/export",
+    tags=["Export"]
+)
+
+EXPORT_FORMAT_VERSION = 1
+YIELD_PER = 500
+IMPORT_BATCH = 500
+# Lines are grouped into chunks of about this size before they are sent.
+CHUNK_BYTES = 64 * 1024
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _line(record: dict) -> bytes:
+    return (json.dumps(record, default=_json_default) + "\n").encode("utf-8")
+
+
+# --- Record streams (each holds one row / one parent's children at a time) ---
+def _chat_records(db: Session, document_id: int):
+    for segment in db.query(models.ChatHistoryArchive).filter(
+        models.ChatHistoryArchive.document_id == document_id
+    ).order_by(models.ChatHistoryArchive.first_id).yield_per(1):
+        for row in chat_archive.decode_segment(segment):
+            yield {"type": "chat_message", "document_id": document_id, "role": row["role"], "content": row["content"], "timestamp": row["timestamp"]}
+    rows = db.query(
+        models.ChatHistory.role, models.ChatHistory.content, models.ChatHistory.timestamp
+    ).filter(models.ChatHistory.document_id == document_id).order_by(models.ChatHistory.id).yield_per(YIELD_PER)
+    for role, content, timestamp in rows:
+        yield {"type": "chat_message", "document_id": document_id, "role": role, "content": content, "timestamp": timestamp}
+
+
+def _quiz_records(db: Session, user_id: int, document_id: Optional[int] = None):
+    query = db.query(
+        models.QuizAttempt.id, models.QuizAttempt.document_id, models.QuizAttempt.score, models.QuizAttempt.timestamp,
+        models.QuizAnswer.id, models.QuizAnswer.question_text, models.QuizAnswer.selected_answer,
+        models.QuizAnswer.correct_answer, models.QuizAnswer.is_correct, models.QuizAnswer.option_index,
+        models.BankQuestion.question, models.BankQuestion.options, models.BankQuestion.correct_answer,
+    ).outerjoin(models.QuizAnswer, models.QuizAnswer.attempt_id == models.QuizAttempt.id).outerjoin(
+        models.BankQuestion, models.BankQuestion.id == models.QuizAnswer.question_id
+    ).filter(models.QuizAttempt.user_id == user_id)
+    if document_id is not None:
+        query = query.filter(models.QuizAttempt.document_id == document_id)
+    current = None
+    # Rows arrive grouped by attempt, so each attempt is emitted as soon as the next one starts.
+    for (attempt_id, doc_id, score, timestamp, answer_id, question, selected, correct, is_correct, option_index,
+         bank_question, bank_options, bank_correct) in query.order_by(models.QuizAttempt.id, models.QuizAnswer.id).yield_per(YIELD_PER):
+        if current is None or current["_id"] != attempt_id:
+            if current is not None:
+                current.pop("_id")
+                yield current
+            current = {"_id": attempt_id, "type": "quiz_attempt", "document_id": doc_id, "score": score, "timestamp": timestamp, "answers": []}
+        if answer_id is not None:
+            # Graded answers are exported with their texts, so the file stands on its own.
+            question, selected, correct = crud.quiz_answer_texts(
+                (question, selected, correct), (bank_question, bank_options, bank_correct), option_index
+            )
+            current["answers"].append({"question_text": question, "selected_answer": selected, "correct_answer": correct, "is_correct": is_correct})
+    if current is not None:
+        current.pop("_id")
+        yield current
+
+
+def _flashcard_records(db: Session, user_id: int, document_id: Optional[int] = None):
+    query = db.query(
+        models.FlashcardSet.id, models.FlashcardSet.document_id, models.FlashcardSet.title, models.FlashcardSet.timestamp,
+        models.Flashcard.front, models.Flashcard.back,
+    ).outerjoin(models.Flashcard, models.Flashcard.set_id == models.FlashcardSet.id).filter(models.FlashcardSet.user_id == user_id)
+    if document_id is not None:
+        query = query.filter(models.FlashcardSet.document_id == document_id)
+    current = None
+    for set_id, doc_id, title, timestamp, front, back in query.order_by(
+        models.FlashcardSet.id, models.Flashcard.id
+    ).yield_per(YIELD_PER):
+        if current is None or current["_id"] != set_id:
+            if current is not None:
+                current.pop("_id")
+                yield current
+            current = {"_id": set_id, "type": "flashcard_set", "document_id": doc_id, "title": title, "timestamp": timestamp, "cards": []}
+        if front is not None:
+            current["cards"].append({"front": front, "back": back})
+    if current is not None:
+        current.pop("_id")
+        yield current
+
+
+def _stream(records_for, scope: dict, compress: bool, request: Request):
+    """NDJSON body with its own read session, since the request's session is closed before streaming."""
+    def body():
+        db = read_session(request)
+        encoder = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: gzip container
+        buffer = bytearray(_line({"type": "export", "version": EXPORT_FORMAT_VERSION, "exported_at": datetime.utcnow(), **scope}))
+        try:
+            for record in records_for(db):
+                buffer += _line(record)
+                if len(buffer) >= CHUNK_BYTES:
+                    yield encoder.compress(bytes(buffer)) if encoder else bytes(buffer)
+                    buffer.clear()
+            if encoder:
+                yield encoder.compress(bytes(buffer)) + encoder.flush()
+            elif buffer:
+                yield bytes(buffer)
+        finally:
+            db.close()
+
+    name = "_".join(f"{k}-{v}" for k, v in scope.items())
+    filename = f"studybuddy_{name}.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        body(),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _require_user(db: Session, current_user: Optional[dict]) -> models.User:
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    user = crud.get_user_from_db(db, current_user["email"])
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+def _owned_document(db: Session, document_id: int, user_id: int) -> models.Document:
+    document = db.query(models.Document).filter(models.Document.id == document_id, models.Document.owner_id == user_id).first()
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found or access denied")
+    return document
+
+
+@router.get("/documents/{document_id}")
+def export_document(
+    document_id: int,
+    request: Request,
+    compress: bool = False,
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Stream a document's chat history, quiz attempts and flashcard sets as NDJSON (gzip with `compress=true`)."""
+    user = _require_user(db, current_user)
+    document = _owned_document(db, document_id, user.id)
+    user_id, filename = user.id, document.filename
+
+    def records(stream_db: Session):
+        yield {"type": "document", "document_id": document_id, "filename": filename}
+        yield from _chat_records(stream_db, document_id)
+        yield from _quiz_records(stream_db, user_id, document_id)
+        yield from _flashcard_records(stream_db, user_id, document_id)
+
+    return _stream(records, {"document": document_id}, compress, request)
+
+
+@router.get("/account")
+def export_account(
+    request: Request,
+    compress: bool = False,
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Stream everything in the caller's account as NDJSON (gzip with `compress=true`)."""
+    user = _require_user(db, current_user)
+    user_id = user.id
+
+    def records(stream_db: Session):
+        documents = stream_db.query(models.Document.id, models.Document.filename).filter(
+            models.Document.owner_id == user_id
+        ).order_by(models.Document.id).all()
+        for document_id, filename in documents:
+            yield {"type": "document", "document_id": document_id, "filename": filename}
+        for document_id, _ in documents:
+            yield from _chat_records(stream_db, document_id)
+        yield from _quiz_records(stream_db, user_id)
+        yield from _flashcard_records(stream_db, user_id)
+
+    return _stream(records, {"user": user_id}, compress, request)
+
+
+@router.post("/documents/{document_id}/import")
+def import_document_records(
+    document_id: int,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """
+    Import an NDJSON export (plain or gzip) into one of the caller's documents.
+    Chat messages, quiz attempts and flashcard sets are added with batched
+    inserts; every record is attached to this document and this user.
+    """
+    user = _require_user(db, current_user)
+    _owned_document(db, document_id, user.id)
+
+    head = file.file.read(2)
+    file.file.seek(0)
+    stream = gzip.open(file.file, "rt", encoding="utf-8") if head == b"\x1f\x8b" else (line.decode("utf-8") for line in file.file)
+
+    counts = {"chat_message": 0, "quiz_attempt": 0, "flashcard_set": 0}
+    pending = {"chat_message": [], "quiz_attempt": [], "flashcard_set": []}
+
+    def flush(kind: str):
+        records = pending[kind]
+        if not records:
+            return
+        if kind == "chat_message":
+            db.bulk_insert_mappings(models.ChatHistory, records)
+        elif kind == "quiz_attempt":
+            children = [r.pop("answers") for r in records]
+            # return_defaults fills in the new ids, which the answers need.
+            db.bulk_insert_mappings(models.QuizAttempt, records, return_defaults=True)
+            db.bulk_insert_mappings(models.QuizAnswer, [
+                {**answer, "attempt_id": r["id"]} for r, answers in zip(records, children) for answer in answers
+            ])
+        else:
+            children = [r.pop("cards") for r in records]
+            db.bulk_insert_mappings(models.FlashcardSet, records, return_defaults=True)
+            cards = [
+                {"front": card["front"], "back": card["back"], "set_id": r["id"]} for r, cards in zip(records, children) for card in cards
+            ]
+            db.bulk_insert_mappings(models.Flashcard, cards, return_defaults=True)
+            # Imported cards start their review schedule as due now, like newly generated ones.
+            now = datetime.utcnow()
+            db.bulk_insert_mappings(models.FlashcardReview, [{"user_id": user.id, "card_id": card["id"], "due_at": now} for card in cards])
+        counts[kind] += len(records)
+        pending[kind] = []
+
+    line_no = 0
+    try:
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.get("type")
+            if kind not in pending:
+                continue  # header and document lines
+            timestamp = datetime.fromisoformat(record["timestamp"]) if record.get("timestamp") else datetime.utcnow()
+            base = {"document_id": document_id, "user_id": user.id, "timestamp": timestamp}
+            if kind == "chat_message":
+                pending[kind].append({**base, "role": record["role"], "content": record["content"]})
+            elif kind == "quiz_attempt":
+                answers = [
+                    {k: a[k] for k in ("question_text", "selected_answer", "correct_answer", "is_correct")}
+                    for a in record.get("answers", [])
+                ]
+                pending[kind].append({**base, "score": record["score"], "answers": answers})
+            else:
+                pending[kind].append({**base, "title": record.get("title") or "Flashcards", "cards": record.get("cards", [])})
+            if len(pending[kind]) >= IMPORT_BATCH:
+                flush(kind)
+        for kind in pending:
+            flush(kind)
+        db.commit()
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        db.rollback()
+        raise HTTPException(status_code=422, detail=f"Invalid export file near line {line_no}: {e}")
+
+    response_cache.invalidate("chat", document_id)
+    response_cache.invalidate("quiz", user.id, document_id)
+    response_cache.invalidate("flashcards", user.id, document_id)
+    return {"imported": counts}
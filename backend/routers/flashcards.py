@@ -1,15 +1,21 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Response
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Request, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
 from typing import List
-from .. import auth, crud, schemas
-from ..database import get_db
+import json
+from .. import auth, crud, schemas, admission
+from ..database import get_db, SessionLocal
+from ..replicas import get_read_db
+from ..http_cache import not_modified
+from ..cache import response_cache
 
 router = APIRouter(
     prefix="/flashcards",
     tags=["Flashcards"]
 )
 
-@router.post("/generate", response_model=schemas.FlashcardSetResponse)
+@router.post("/generate", response_model=schemas.FlashcardSetResponse, dependencies=[Depends(admission.admit(admission.BULK))])
 async def generate_flashcards(
     request: schemas.DocumentRequest,
     db: Session = Depends(get_db),
@@ -20,16 +26,80 @@ async def generate_flashcards(
     user = crud.get_user_from_db(db, current_user["email"])
     return await crud.create_flashcards(db=db, document_id=request.document_id, user_id=user.id)
 
+@router.post("/generate/stream")
+async def generate_flashcards_stream(
+    request: schemas.DocumentRequest,
+    http_request: Request,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Generate flashcards, streaming each section's cards as NDJSON as soon as it is ready."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    user = crud.get_user_from_db(db, current_user["email"])
+    document_id, user_id = request.document_id, user.id
+    # Admitted here rather than in a dependency, so the slot is held while the body streams.
+    ticket = await admission.controller.acquire(admission.client_key(http_request, current_user), admission.BULK)
+
+    async def stream():
+        # The request's session is closed before the body streams, so use our own.
+        stream_db = SessionLocal()
+        try:
+            async for event in crud.iter_flashcard_generation(stream_db, document_id, user_id):
+                if event["type"] == "set":
+                    event = {"type": "set", "set": schemas.FlashcardSetResponse.model_validate(event["set"]).model_dump(mode="json")}
+                yield json.dumps(event) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"type": "error", "status": e.status_code, "detail": e.detail}) + "\n"
+        finally:
+            stream_db.close()
+            admission.controller.release(ticket)
+
+    # release() is idempotent; the background task covers a client that disconnects before the body starts.
+    return StreamingResponse(stream(), media_type="application/x-ndjson", background=BackgroundTask(admission.controller.release, ticket))
+
+@router.post("/review", response_model=schemas.FlashcardReviewResponse)
+def review_flashcard(
+    request: schemas.FlashcardReviewRequest,
+    db: Session = Depends(get_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Grade one review of a card (0-5); returns its new schedule."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    user = crud.get_user_from_db(db, current_user["email"])
+    return crud.review_flashcard(db=db, user_id=user.id, card_id=request.card_id, grade=request.grade)
+
+@router.get("/due", response_model=List[schemas.DueFlashcard])
+def get_due_flashcards(
+    limit: int = Query(20, ge=1, le=200),
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """The caller's next due cards across all sets, most overdue first."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    user = crud.get_user_from_db(db, current_user["email"])
+    return crud.get_due_flashcards(db=db, user_id=user.id, limit=limit)
+
 @router.get("/document/{document_id}", response_model=List[schemas.FlashcardSetResponse])
 def get_flashcard_sets(
     document_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     current_user: dict = Depends(auth.get_current_user)
 ):
     if not current_user:
         raise HTTPException(status_code=401, detail="Authentication required")
     user = crud.get_user_from_db(db, current_user["email"])
-    return crud.get_flashcard_sets_for_document(db=db, user_id=user.id, document_id=document_id)
+    if cached := not_modified(request, response, f"flashcards:{user.id}:{document_id}", crud.flashcard_sets_stamp(db, user.id, document_id)):
+        return cached
+    return response_cache.json_response(
+        response, f"flashcards:{user.id}:{document_id}", [("doc", document_id), ("flashcards", user.id, document_id)],
+        List[schemas.FlashcardSetResponse],
+        lambda: crud.get_flashcard_sets_for_document(db=db, user_id=user.id, document_id=document_id),
+    )
 
 
 @router.delete("/set/{set_id}", status_code=status.HTTP_204_NO_CONTENT)
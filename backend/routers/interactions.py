@@ -1,8 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+import contextlib
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Response, Query, WebSocket, WebSocketDisconnect
 from sqlalchemy.orm import Session
-from .. import auth, crud, schemas # Import schemas
-from ..database import get_db
+from .. import auth, crud, models, schemas, chat_sessions # Import schemas
+from ..admission import admit, controller, INTERACTIVE, BULK
+from ..http_cache import not_modified
+from ..cache import response_cache
+from ..database import get_db, SessionLocal
+from ..replicas import get_read_db
 from typing import Optional, List, Dict
+from ..observability import logger
 
 
 
@@ -12,7 +19,7 @@ router = APIRouter(
 
 from fastapi import Request
 
-@router.post("/ask")
+@router.post("/ask", dependencies=[Depends(admit(INTERACTIVE))])
 async def ask_question(
     request: Request,  
     db: Session = Depends(get_db),
@@ -20,26 +27,113 @@ async def ask_question(
 ):
     try:
         body = await request.json()
-        print("🔥 Incoming request body:", body)
         parsed_request = schemas.AskRequest(**body)
     except Exception as e:
-        print("❌ Invalid or malformed input:", e)
+        logger.info("Invalid /ask payload: %s", e)
         raise HTTPException(status_code=422, detail="Invalid input format")
     
     return await crud.get_answer(db=db, request=parsed_request, user=current_user)
 
 
-@router.post("/summarize")
+@router.websocket("/ws/documents/{document_id}/chat")
+async def chat_websocket(websocket: WebSocket, document_id: int, token: Optional[str] = None):
+    """
+    Chat about one document over a WebSocket (pass the access token as `?token=`).
+    Send `{"question": "..."}`; the answer arrives as `{"type": "token", "text": ...}`
+    frames followed by `{"type": "done"}`. Errors are sent as `{"type": "error", "status", "detail"}`.
+    """
+    try:
+        current_user = await auth.get_current_user(token) if token else None
+    except HTTPException:
+        current_user = None
+    if not current_user:
+        return await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Authentication required")
+
+    # The database is only needed to set the session up, so no connection is held while it is open.
+    db = SessionLocal()
+    try:
+        user = crud.get_user_from_db(db, current_user["email"])
+        document = db.query(models.Document).filter(models.Document.id == document_id).first()
+        if not user or not document or document.owner_id not in (None, user.id):
+            return await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Document not found or access denied")
+        await websocket.accept()
+        try:
+            session = await chat_sessions.ChatSession.open(db, document, user.id)
+        except chat_sessions.SessionLimitReached:
+            return await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Too many open chat sessions")
+        except HTTPException as e:
+            await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+            return await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        db.close()
+
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive_json(), timeout=chat_sessions.CHAT_WS_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                await websocket.close(code=status.WS_1000_NORMAL_CLOSURE, reason="Idle timeout")
+                break
+            except (ValueError, KeyError, TypeError):
+                # Not JSON, or a binary frame.
+                message = None
+            question = message.get("question") if isinstance(message, dict) else None
+            if not isinstance(question, str) or not question.strip():
+                await websocket.send_json({"type": "error", "status": 422, "detail": "Send {\"question\": \"...\"}."})
+                continue
+            try:
+                ticket = await controller.acquire(current_user["email"], INTERACTIVE)
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+                continue
+            try:
+                # Closed explicitly, so generation stops as soon as sending fails.
+                async with contextlib.aclosing(session.answer(question)) as tokens:
+                    async for text in tokens:
+                        await websocket.send_json({"type": "token", "text": text})
+                await websocket.send_json({"type": "done"})
+            except WebSocketDisconnect:
+                raise
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+            except Exception as e:
+                logger.info("Chat session answer failed: %s", e)
+                await websocket.send_json({"type": "error", "status": 502, "detail": "The answer could not be generated."})
+            finally:
+                controller.release(ticket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await session.close()
+
+
+@router.get("/search", response_model=schemas.SearchResponse)
+async def search_library(
+    q: str = Query(..., min_length=1, max_length=500),
+    k: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+    current_user: dict = Depends(auth.get_current_user)
+):
+    """Semantic search across all of the caller's documents; returns ranked snippets with document and page."""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    return await crud.search_library(db=db, user_email=current_user["email"], query=q, k=k)
+
+
+@router.post("/summarize", dependencies=[Depends(admit(BULK))])
 async def summarize_document(request: schemas.DocumentRequest, db: Session = Depends(get_db)):
     return await crud.get_summary(db=db, request=request)
 
-@router.post("/generate-quiz", response_model=schemas.Quiz)
-async def generate_quiz(request: schemas.DocumentRequest, db: Session = Depends(get_db), current_user: dict = Depends(auth.get_current_user)):
+@router.post("/generate-quiz", response_model=schemas.ServedQuiz, dependencies=[Depends(admit(BULK))])
+async def generate_quiz(request: schemas.DocumentRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db), current_user: dict = Depends(auth.get_current_user)):
     if not current_user:
         raise HTTPException(status_code=401, detail="Authentication required to generate a quiz")
-    return await crud.create_quiz(db=db, request=request)
+    user = crud.get_user_from_db(db, current_user["email"])
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return await crud.create_quiz(db=db, request=request, user_id=user.id, background_tasks=background_tasks)
 
-@router.post("/submit-quiz", status_code=201)
+@router.post("/submit-quiz", response_model=schemas.QuizResult, status_code=201)
 def submit_quiz(
     request: schemas.SubmitQuizRequest,
     db: Session = Depends(get_db),
@@ -52,14 +146,15 @@ def submit_quiz(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    crud.save_quiz_attempt(db=db, user_id=user.id, request=request)
-    return {"message": "Quiz attempt saved successfully."}
+    return crud.grade_quiz(db=db, user_id=user.id, request=request)
 
 
 @router.get("/documents/{document_id}/quiz-history", response_model=List[schemas.QuizAttemptResponse])
 def get_quiz_history(
     document_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
     current_user: dict = Depends(auth.get_current_user)
 ):
     if not current_user:
@@ -68,8 +163,14 @@ def get_quiz_history(
     user = crud.get_user_from_db(db, current_user["email"])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    if cached := not_modified(request, response, f"quiz-history:{user.id}:{document_id}", crud.quiz_history_stamp(db, user.id, document_id)):
+        return cached
         
-    return crud.get_quiz_history_for_document(db=db, user_id=user.id, document_id=document_id)
+    return response_cache.json_response(
+        response, f"quiz-history:{user.id}:{document_id}", [("doc", document_id), ("quiz", user.id, document_id)],
+        List[schemas.QuizAttemptResponse],
+        lambda: crud.get_quiz_history_for_document(db=db, user_id=user.id, document_id=document_id),
+    )
 
 @router.delete("/documents/{document_id}/chat", status_code=200)
 def delete_chat_for_document(
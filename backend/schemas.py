@@ -22,6 +22,23 @@ class DocumentResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class DocumentReindexResponse(DocumentResponse):
+    chunks_added: int
+    chunks_removed: int
+    chunks_unchanged: int
+
+class BatchUploadItem(BaseModel):
+    filename: str
+    status: str  # "ok" or "error"
+    document: Optional[DocumentResponse] = None
+    detail: Optional[str] = None
+
+class BatchUploadResponse(BaseModel):
+    documents: List[BatchUploadItem]
+    succeeded: int
+    failed: int
+    embedding_batches: int
+
 # --- Chat History Schemas ---
 # This is for sending data TO the frontend
 class ChatMessage(BaseModel):
@@ -45,11 +62,25 @@ class AskRequest(BaseModel):
     document_ids: List[int] # Changed from single int to a list of ints
     chat_history: Optional[List[ChatMessageInput]] = None
 
+class SearchHit(BaseModel):
+    document_id: int
+    filename: Optional[str] = None
+    page: Optional[int] = None
+    page_end: Optional[int] = None
+    score: float  # L2 distance; lower is closer
+    snippet: str
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[SearchHit]
+    documents_searched: int
+
 class DocumentRequest(BaseModel):
     document_id: int
 
 # --- Quiz Schemas ---
 class QuizQuestion(BaseModel):
+    id: Optional[int] = None
     question: str
     options: List[str]
     correct_answer: str
@@ -58,22 +89,46 @@ class QuizQuestion(BaseModel):
 class Quiz(BaseModel):
     questions: List[QuizQuestion]
 
-class UserAnswer(BaseModel):
-    question_text: str
-    selected_answer: str
-    correct_answer: str
-    is_correct: bool
+class ServedQuizQuestion(BaseModel):
+    """A question as sent to the client: answers stay on the server until grading."""
+    id: int
+    question: str
+    options: List[str]
+
+class ServedQuiz(BaseModel):
+    quiz_id: int
+    questions: List[ServedQuizQuestion]
+
+class QuizAnswerSubmission(BaseModel):
+    question_id: int
+    option_index: Optional[int] = None  # None = left unanswered
 
 class SubmitQuizRequest(BaseModel):
-    document_id: int
-    answers: List[UserAnswer]
+    quiz_id: int
+    answers: List[QuizAnswerSubmission]
+
+class GradedAnswer(BaseModel):
+    question_id: int
+    option_index: Optional[int] = None
+    correct_index: Optional[int] = None
+    is_correct: bool
+    explanation: str
+
+class QuizResult(BaseModel):
+    attempt_id: int
+    quiz_id: int
     score: float
+    correct: int
+    total: int
+    answers: List[GradedAnswer]
 
 class QuizAnswerResponse(BaseModel):
     id: int
-    question_text: str
-    selected_answer: str
-    correct_answer: str
+    question_id: Optional[int] = None
+    option_index: Optional[int] = None
+    question_text: Optional[str] = None
+    selected_answer: Optional[str] = None
+    correct_answer: Optional[str] = None
     is_correct: bool
     class Config:
         from_attributes = True
@@ -107,6 +162,33 @@ class FlashcardSetResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class FlashcardReviewRequest(BaseModel):
+    card_id: int
+    grade: int = Field(..., ge=0, le=5, description="SM-2 recall grade: 0 = forgot, 3 = recalled with effort, 5 = perfect")
+
+class FlashcardReviewResponse(BaseModel):
+    card_id: int
+    easiness: float
+    interval_days: int
+    repetitions: int
+    lapses: int
+    due_at: datetime
+    last_reviewed_at: Optional[datetime] = None
+    class Config:
+        from_attributes = True
+
+class DueFlashcard(BaseModel):
+    card_id: int
+    set_id: int
+    document_id: int
+    front: str
+    back: str
+    due_at: datetime
+    repetitions: int
+    interval_days: int
+    class Config:
+        from_attributes = True
+
 class DeleteItemsRequest(BaseModel):
     """A generic schema for deleting multiple items by a list of their IDs."""
     item_ids: List[int]
@@ -0,0 +1,503 @@
+# sharded_store.py
+"""
+Optional multi-tenant vector store.
+
+Instead of one FAISS directory per document, chunks are written into a fixed
+number of shards. Each shard is a single ID-mapped FAISS index plus a small
+SQLite table holding the chunk text and metadata. A document's vector ids are
+packed as ``(document_id << CHUNK_ID_BITS) | chunk_index`` so that a document
+maps to one contiguous id range, which makes filtering and removal cheap.
+
+Documents are placed by owner, so every document a user owns lives in the same
+shard and a question over any subset of them is a single FAISS search. Reads
+take a mapping of document id to owner id, so a selection that spans owners
+searches each owner's shard and merges the hits.
+
+Shards are reference-counted while in use. An evicted shard is closed by its
+last user, and is reused, not reloaded, if it is requested again before that.
+
+Several API workers can write the same shard. The chunk table is SQLite, which
+serialises its own writes. Index saves are serialised with a lock file. Each
+worker keeps a log of the changes it has not saved yet. If another worker
+saved the index in the meantime, that index is re-read and the log is replayed
+on top of it before saving, so neither worker's vectors are lost.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document as LCDocument
+from langchain_core.retrievers import BaseRetriever
+
+from .observability import logger
+
+CHUNK_ID_BITS = 20
+MAX_CHUNKS_PER_DOCUMENT = 1 << CHUNK_ID_BITS
+
+
+def vector_id(document_id: int, chunk_index: int) -> int:
+    if chunk_index >= MAX_CHUNKS_PER_DOCUMENT:
+        raise ValueError("Document has too many chunks for the sharded store.")
+    return (document_id << CHUNK_ID_BITS) | chunk_index
+
+
+def document_id_range(document_id: int):
+    """Half-open range of vector ids owned by a document."""
+    return document_id << CHUNK_ID_BITS, (document_id + 1) << CHUNK_ID_BITS
+
+
+def _ranges_selector(ranges):
+    selectors = [faiss.IDSelectorRange(lo, hi) for lo, hi in ranges]
+    selector = selectors[0]
+    for other in selectors[1:]:
+        selector = faiss.IDSelectorOr(selector, other)
+    return selector
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock shared by every process that opens `path`."""
+    with open(path, "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class _Shard:
+    """One FAISS IndexIDMap2 and its chunk metadata, guarded by a lock."""
+
+    def __init__(self, number: int, path: str, dimension: int):
+        self.number = number
+        self.path = path
+        self.lock = threading.RLock()
+        self.dirty = False
+        # Operations in progress, and whether the store has dropped it from residency.
+        # Both are guarded by the store's lock.
+        self.users = 0
+        self.evicted = False
+        # Documents whose metadata is gone but whose vectors are still in the
+        # index. They are filtered at search time and removed by compact().
+        self.tombstones = set()
+
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, "index.faiss")
+        self.lock_file = os.path.join(path, "index.lock")
+        # Changes not yet saved, in order, so they can be replayed on an index another worker saved.
+        self.pending: List[tuple] = []
+        # Identity of the index file this copy was read from; another worker saving changes it.
+        self.loaded_version = self._file_version()
+        if self.loaded_version is not None:
+            self.index = faiss.read_index(self.index_file)
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+
+        self.meta = sqlite3.connect(os.path.join(path, "chunks.sqlite"), check_same_thread=False)
+        self.meta.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " id INTEGER PRIMARY KEY,"
+            " document_id INTEGER NOT NULL,"
+            " content TEXT NOT NULL,"
+            " metadata TEXT)"
+        )
+        self.meta.execute("CREATE INDEX IF NOT EXISTS ix_chunks_document_id ON chunks (document_id)")
+        self.meta.commit()
+        self._recover_tombstones()
+
+    def _recover_tombstones(self):
+        # A crash between delete and compaction leaves vectors without metadata.
+        if self.index.ntotal == 0:
+            return
+        ids = faiss.vector_to_array(self.index.id_map)
+        indexed_docs = set(np.unique(ids >> CHUNK_ID_BITS).tolist())
+        live_docs = {row[0] for row in self.meta.execute("SELECT DISTINCT document_id FROM chunks")}
+        self.tombstones = indexed_docs - live_docs
+
+    def _file_version(self):
+        # Saves replace the file, so its inode changes even when the mtime does not.
+        try:
+            stat = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    # Local changes go through these, so they are recorded for replay.
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.index.add_with_ids(vectors, ids)
+        self.pending.append(("add", vectors, ids))
+        self.dirty = True
+
+    def remove(self, ids: Optional[np.ndarray] = None, ranges: Optional[List[tuple]] = None):
+        self._apply_remove(self.index, ids, ranges)
+        self.pending.append(("remove", ids, ranges))
+        self.dirty = True
+
+    @staticmethod
+    def _apply_remove(index, ids, ranges):
+        if ids is not None:
+            index.remove_ids(faiss.IDSelectorBatch(ids))
+        if ranges:
+            index.remove_ids(_ranges_selector(ranges))
+
+    def _reload(self, version):
+        """Reads the saved index and replays the unsaved local changes on top of it."""
+        index = faiss.read_index(self.index_file)
+        for op, first, second in self.pending:
+            if op == "add":
+                # The other worker may have saved these ids too; keep a single copy.
+                index.remove_ids(faiss.IDSelectorBatch(second))
+                index.add_with_ids(first, second)
+            else:
+                self._apply_remove(index, first, second)
+        self.index = index
+        self.loaded_version = version
+        self._recover_tombstones()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with _file_lock(self.lock_file):
+                version = self._file_version()
+                if version is not None and version != self.loaded_version:
+                    self._reload(version)
+                tmp_file = os.path.join(self.path, f"index.faiss.{os.getpid()}.tmp")
+                faiss.write_index(self.index, tmp_file)
+                os.replace(tmp_file, self.index_file)
+                self.loaded_version = self._file_version()
+            self.pending.clear()
+            self.dirty = False
+
+    def refresh_if_stale(self):
+        """Re-reads the index if another process saved a newer one since it was loaded."""
+        version = self._file_version()
+        if version is None or version == self.loaded_version:
+            return
+        with self.lock:
+            if version != self.loaded_version:
+                self._reload(version)
+
+    def close(self):
+        with self.lock:
+            self.save()
+            self.meta.close()
+
+
+class ShardedVectorStore:
+    """A fixed set of FAISS shards with LRU residency and background compaction."""
+
+    def __init__(
+        self,
+        root: str,
+        embeddings,
+        num_shards: int = 64,
+        max_resident_shards: int = 8,
+    ):
+        self.root = root
+        self.embeddings = embeddings
+        self.num_shards = num_shards
+        self.max_resident_shards = max_resident_shards
+        self._dimension: Optional[int] = None
+        self._shards: "OrderedDict[int, _Shard]" = OrderedDict()
+        # Evicted shards that are still in use; the last user closes them.
+        self._draining: Dict[int, _Shard] = {}
+        self._lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # --- Shard placement & residency ---
+    def shard_for(self, document_id: int, owner_id: Optional[int]) -> int:
+        key = owner_id if owner_id is not None else document_id
+        return key % self.num_shards
+
+    def _dimension_for_new_shard(self) -> int:
+        if self._dimension is None:
+            self._dimension = len(self.embeddings.embed_query("dimension probe"))
+        return self._dimension
+
+    def _acquire(self, shard_no: int) -> _Shard:
+        with self._lock:
+            shard = self._shards.get(shard_no)
+            if shard is None and shard_no in self._draining:
+                # Still open for an earlier user; reusing it keeps its unsaved writes.
+                shard = self._draining.pop(shard_no)
+                shard.evicted = False
+                self._shards[shard_no] = shard
+            if shard is not None:
+                self._shards.move_to_end(shard_no)
+                # With several workers, another one may have written this shard.
+                shard.refresh_if_stale()
+            else:
+                path = os.path.join(self.root, f"shard_{shard_no:03d}")
+                if os.path.exists(os.path.join(path, "index.faiss")):
+                    shard = _Shard(shard_no, path, dimension=0)
+                else:
+                    shard = _Shard(shard_no, path, dimension=self._dimension_for_new_shard())
+                self._shards[shard_no] = shard
+            shard.users += 1
+
+            # Cold shards are flushed and dropped; hot ones stay resident.
+            while len(self._shards) > self.max_resident_shards:
+                _, evicted = self._shards.popitem(last=False)
+                evicted.evicted = True
+                if evicted.users:
+                    self._draining[evicted.number] = evicted
+                else:
+                    evicted.close()
+            return shard
+
+    def _release(self, shard: _Shard):
+        with self._lock:
+            shard.users -= 1
+            if shard.evicted and shard.users == 0 and self._draining.get(shard.number) is shard:
+                del self._draining[shard.number]
+                shard.close()
+
+    @contextmanager
+    def _shard(self, shard_no: int) -> Iterator[_Shard]:
+        """A resident shard that is not closed until the block exits."""
+        shard = self._acquire(shard_no)
+        try:
+            yield shard
+        finally:
+            self._release(shard)
+
+    # --- Writes ---
+    def add_texts(
+        self,
+        document_id: int,
+        owner_id: Optional[int],
+        texts: Sequence[str],
+        metadatas: Optional[Sequence[dict]] = None,
+        embeddings: Optional[Sequence[Sequence[float]]] = None,
+        start_index: int = 0,
+    ) -> List[int]:
+        if not texts:
+            return []
+        if embeddings is None:
+            embeddings = self.embeddings.embed_documents(list(texts))
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [vector_id(document_id, start_index + i) for i in range(len(texts))]
+
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            if document_id in shard.tombstones:
+                # The id is being reused before compaction caught up.
+                shard.remove(ranges=[document_id_range(document_id)])
+                shard.tombstones.discard(document_id)
+            shard.add(np.asarray(embeddings, dtype="float32"), np.asarray(ids, dtype="int64"))
+            shard.meta.executemany(
+                "INSERT OR REPLACE INTO chunks (id, document_id, content, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (vid, document_id, text, json.dumps({**meta, "document_id": document_id}))
+                    for vid, text, meta in zip(ids, texts, metadatas)
+                ],
+            )
+            shard.meta.commit()
+        return ids
+
+    def flush(self, document_id: int, owner_id: Optional[int]):
+        """Writes the shard holding a document to disk after a series of add_texts calls."""
+        with self._shard(self.shard_for(document_id, owner_id)) as shard:
+            shard.save()
+
+    def remove_document(self, document_id: int, owner_id: Optional[int]):
+        """Drops a document's metadata now; its vectors go at the next compaction."""
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            shard.meta.execute("DELETE FROM chunks WHERE document_id = ?", (document_id,))
+            shard.meta.commit()
+            shard.tombstones.add(document_id)
+
+    def remove_ids(self, document_id: int, owner_id: Optional[int], ids: Iterable[int]):
+        """Removes individual chunks of a document immediately."""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return
+        with self._shard(self.shard_for(document_id, owner_id)) as shard:
+            with shard.lock:
+                shard.remove(ids=np.asarray(ids, dtype="int64"))
+                shard.meta.executemany("DELETE FROM chunks WHERE id = ?", [(i,) for i in ids])
+                shard.meta.commit()
+            shard.save()
+
+    def update_metadata(self, document_id: int, owner_id: Optional[int], metadatas: Dict[int, dict]):
+        """Rewrites the metadata of existing chunks without touching their vectors."""
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            shard.meta.executemany(
+                "UPDATE chunks SET metadata = ? WHERE id = ?",
+                [(json.dumps({**meta, "document_id": document_id}), vid) for vid, meta in metadatas.items()],
+            )
+            shard.meta.commit()
+
+    def get_chunk_records(self, document_id: int, owner_id: Optional[int]):
+        """Returns (vector_id, content, metadata) for every chunk of a document."""
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            rows = shard.meta.execute(
+                "SELECT id, content, metadata FROM chunks WHERE document_id = ? ORDER BY id", (document_id,)
+            ).fetchall()
+        return [(vid, content, json.loads(meta or "{}")) for vid, content, meta in rows]
+
+    def has_document(self, document_id: int, owner_id: Optional[int]) -> bool:
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            row = shard.meta.execute(
+                "SELECT 1 FROM chunks WHERE document_id = ? LIMIT 1", (document_id,)
+            ).fetchone()
+        return row is not None
+
+    # --- Reads ---
+    # `owners` maps each document id to its owner id, which decides its shard.
+    def _by_shard(self, owners: Dict[int, Optional[int]]) -> Dict[int, List[int]]:
+        by_shard: Dict[int, List[int]] = {}
+        for document_id, owner_id in owners.items():
+            by_shard.setdefault(self.shard_for(document_id, owner_id), []).append(document_id)
+        return by_shard
+
+    def similarity_search_by_vector(
+        self,
+        embedding: Sequence[float],
+        k: int = 4,
+        owners: Optional[Dict[int, Optional[int]]] = None,
+    ) -> List[LCDocument]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, owners)]
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: Sequence[float],
+        k: int = 4,
+        owners: Optional[Dict[int, Optional[int]]] = None,
+    ):
+        if not owners:
+            return []
+        query = np.asarray([embedding], dtype="float32")
+
+        hits = []
+        for shard_no, document_ids in self._by_shard(owners).items():
+            with self._shard(shard_no) as shard, shard.lock:
+                if shard.index.ntotal == 0:
+                    continue
+                params = faiss.SearchParameters(sel=_ranges_selector([document_id_range(d) for d in document_ids]))
+                distances, ids = shard.index.search(query, k, params=params)
+                hits.extend(self._hydrate(shard, ids[0], distances[0]))
+        hits.sort(key=lambda pair: pair[1])
+        return hits[:k]
+
+    def similarity_search(self, query: str, k: int = 4, owners: Optional[Dict[int, Optional[int]]] = None) -> List[LCDocument]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k, owners)
+
+    def get_chunks(self, document_id: int, owner_id: Optional[int], limit: Optional[int] = None) -> List[LCDocument]:
+        """Returns a document's chunks in ingestion order, without a vector search."""
+        sql = "SELECT content, metadata FROM chunks WHERE document_id = ? ORDER BY id"
+        params: tuple = (document_id,)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = (document_id, limit)
+        with self._shard(self.shard_for(document_id, owner_id)) as shard, shard.lock:
+            rows = shard.meta.execute(sql, params).fetchall()
+        return [LCDocument(page_content=content, metadata=json.loads(meta or "{}")) for content, meta in rows]
+
+    def get_by_ids(self, ids: Sequence[int], owners: Dict[int, Optional[int]]) -> List[Optional[LCDocument]]:
+        """Returns the chunks for the given vector ids, aligned with ids (None if missing or not in `owners`)."""
+        found: Dict[int, LCDocument] = {}
+        by_shard: Dict[int, List[int]] = {}
+        for vid in ids:
+            document_id = int(vid) >> CHUNK_ID_BITS
+            if document_id in owners:
+                by_shard.setdefault(self.shard_for(document_id, owners[document_id]), []).append(int(vid))
+        for shard_no, shard_ids in by_shard.items():
+            placeholders = ",".join("?" * len(shard_ids))
+            with self._shard(shard_no) as shard, shard.lock:
+                rows = shard.meta.execute(
+                    f"SELECT id, content, metadata FROM chunks WHERE id IN ({placeholders})", shard_ids
+                ).fetchall()
+            for vid, content, meta in rows:
+                found[vid] = LCDocument(page_content=content, metadata=json.loads(meta or "{}"))
+        return [found.get(int(vid)) for vid in ids]
+
+    @staticmethod
+    def _hydrate(shard: _Shard, ids, distances):
+        wanted = [int(i) for i in ids if i >= 0]
+        if not wanted:
+            return []
+        placeholders = ",".join("?" * len(wanted))
+        rows = shard.meta.execute(
+            f"SELECT id, content, metadata FROM chunks WHERE id IN ({placeholders})", wanted
+        ).fetchall()
+        by_id: Dict[int, tuple] = {row[0]: row for row in rows}
+        hits = []
+        for vid, distance in zip(ids, distances):
+            row = by_id.get(int(vid))
+            if row is None:
+                continue  # tombstoned, waiting for compaction
+            hits.append((LCDocument(page_content=row[1], metadata=json.loads(row[2] or "{}")), float(distance)))
+        return hits
+
+    def as_retriever(self, owners: Dict[int, Optional[int]], k: int = 4):
+        return ShardedRetriever(store=self, owners=dict(owners), k=k)
+
+    # --- Compaction ---
+    def compact(self):
+        """Physically removes tombstoned documents from every resident shard."""
+        with self._lock:
+            shards = list(self._shards.values())
+            for shard in shards:
+                shard.users += 1
+        for shard in shards:
+            try:
+                with shard.lock:
+                    if not shard.tombstones:
+                        continue
+                    shard.remove(ranges=[document_id_range(d) for d in shard.tombstones])
+                    shard.tombstones.clear()
+                    shard.meta.execute("VACUUM")
+                shard.save()
+            finally:
+                self._release(shard)
+
+    def start_compactor(self, interval_seconds: float = 300.0):
+        if self._compactor is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    self.compact()
+                except Exception as exc:  # keep the thread alive
+                    logger.warning("Vector shard compaction failed: %s", exc)
+
+        self._compactor = threading.Thread(target=run, name="shard-compactor", daemon=True)
+        self._compactor.start()
+
+    def close(self):
+        self._stop.set()
+        self.compact()
+        with self._lock:
+            for shard in [*self._shards.values(), *self._draining.values()]:
+                shard.close()
+            self._shards.clear()
+            self._draining.clear()
+
+
+class ShardedRetriever(BaseRetriever):
+    """LangChain retriever over a subset of documents in a ShardedVectorStore."""
+
+    store: ShardedVectorStore
+    # Document id -> owner id, which places each document in its shard.
+    owners: Dict[int, Optional[int]]
+    k: int = 4
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[LCDocument]:
+        return self.store.similarity_search(query, self.k, self.owners)
@@ -0,0 +1,46 @@
+# spaced_repetition.py
+"""
+SM-2 scheduling for flashcard reviews.
+
+A review is graded 0-5 (0 = blank, 3 = recalled with effort, 5 = perfect).
+A grade of 3 or more moves the card to the next interval: 1 day, then
+6 days, then the previous interval times the card's easiness factor. A
+lower grade is a lapse and restarts the card at 1 day. The easiness factor
+changes after every review and never falls below 1.3.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+from . import models
+
+INITIAL_EASINESS = 2.5
+MIN_EASINESS = 1.3
+PASSING_GRADE = 3
+
+
+def schedule(review: models.FlashcardReview, grade: int, now: Optional[datetime] = None) -> models.FlashcardReview:
+    """Applies one graded review to `review` in place and sets its next due time."""
+    now = now or datetime.utcnow()
+    easiness = review.easiness if review.easiness is not None else INITIAL_EASINESS
+    repetitions = review.repetitions or 0
+    interval = review.interval_days or 0
+
+    if grade >= PASSING_GRADE:
+        if repetitions == 0:
+            interval = 1
+        elif repetitions == 1:
+            interval = 6
+        else:
+            interval = max(1, round(interval * easiness))
+        repetitions += 1
+    else:
+        repetitions = 0
+        interval = 1
+        review.lapses = (review.lapses or 0) + 1
+
+    review.easiness = max(MIN_EASINESS, easiness + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    review.repetitions = repetitions
+    review.interval_days = interval
+    review.last_reviewed_at = now
+    review.due_at = now + timedelta(days=interval)
+    return review
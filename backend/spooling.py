@@ -0,0 +1,142 @@
+# spooling.py
+"""
+Upload spooling.
+
+Each upload is read in chunks with a running size check. Small files stay in
+memory and are parsed from the buffer. Larger ones are written off the event
+loop to a temp file with a unique name, so two uploads with the same filename
+never share a path. The file type is taken from the leading bytes; the
+client's Content-Type header is not trusted.
+
+UploadLimitMiddleware caps the size of the whole multipart body while it is
+being received, so an oversized request is rejected before it is fully read.
+"""
+import asyncio
+import io
+import os
+import tempfile
+import zipfile
+from typing import Optional, Union
+
+from fastapi import HTTPException, UploadFile
+from starlette.responses import JSONResponse
+
+UPLOAD_DIRECTORY = "./uploads"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 50 * 1024 * 1024))
+# Files up to this size are parsed from memory and never written to disk.
+UPLOAD_MEMORY_MAX_BYTES = int(os.getenv("UPLOAD_MEMORY_MAX_BYTES", 4 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", 256 * 1024 * 1024))
+READ_CHUNK_BYTES = 1024 * 1024
+
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class SpooledUpload:
+    """An upload held either in memory (`data`) or in a unique temp file (`path`)."""
+
+    def __init__(self, filename: str, content_type: str, size: int, data: Optional[bytes] = None, path: Optional[str] = None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.data = data
+        self.path = path
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        return self.data if self.data is not None else self.path
+
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def sniff_content_type(head: bytes, source: Union[bytes, str]) -> str:
+    """PDF or DOCX, judged by magic bytes; anything else is a 415."""
+    if head.startswith(b"%PDF-"):
+        return PDF
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source) as archive:
+                if any(name.startswith("word/") for name in archive.namelist()):
+                    return DOCX
+        except zipfile.BadZipFile:
+            pass
+    raise HTTPException(status_code=415, detail="Unsupported file type. Upload a PDF or DOCX file.")
+
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File is larger than the {limit // (1024 * 1024)} MB limit.")
+
+
+async def spool_upload(
+    file: UploadFile,
+    max_bytes: int = UPLOAD_MAX_BYTES,
+    memory_max_bytes: int = UPLOAD_MEMORY_MAX_BYTES,
+) -> SpooledUpload:
+    """Reads an upload chunk by chunk; the caller must call cleanup() on the result."""
+    buffer = bytearray()
+    path, handle, size = None, None, 0
+    try:
+        while chunk := await file.read(READ_CHUNK_BYTES):
+            size += len(chunk)
+            if size > max_bytes:
+                raise _too_large(max_bytes)
+            if handle is None and size <= memory_max_bytes:
+                buffer += chunk
+                continue
+            if handle is None:
+                os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+                fd, path = tempfile.mkstemp(prefix="upload_", suffix=os.path.splitext(file.filename or "")[1], dir=UPLOAD_DIRECTORY)
+                handle = os.fdopen(fd, "wb")
+                chunk, buffer = bytes(buffer) + chunk, bytearray()
+            await asyncio.to_thread(handle.write, chunk)
+        if handle is not None:
+            await asyncio.to_thread(handle.close)
+            handle = None
+            with open(path, "rb") as fh:
+                head = fh.read(8)
+            upload = SpooledUpload(file.filename, sniff_content_type(head, path), size, path=path)
+        else:
+            data = bytes(buffer)
+            upload = SpooledUpload(file.filename, sniff_content_type(data[:8], data), size, data=data)
+        return upload
+    except BaseException:
+        if handle is not None:
+            handle.close()
+        if path and os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class UploadLimitMiddleware:
+    """Rejects multipart request bodies over `max_bytes`, by header and while streaming."""
+
+    def __init__(self, app, max_bytes: int = UPLOAD_MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/"):
+            return await self.app(scope, receive, send)
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+            response = JSONResponse({"detail": "Request body too large."}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Raised inside form parsing, so FastAPI turns it into the 413 response.
+                    raise HTTPException(status_code=413, detail="Request body too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,6 @@
+import os
+
+# database.py and auth.py read these at import time.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("DATABASE_ECHO", "false")
+os.environ.setdefault("SECRET_KEY", "test-secret")
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.admission import BULK, INTERACTIVE, AdmissionController
+
+
+def _controller(**overrides) -> AdmissionController:
+    options = dict(max_active=1, max_queue=10, queue_timeout=5, user_concurrency=0, user_rate_per_minute=0, user_burst=0)
+    options.update(overrides)
+    return AdmissionController(**options)
+
+
+async def _wait_queued(controller: AdmissionController, depth: int):
+    while len(controller._queue) < depth:
+        await asyncio.sleep(0)
+
+
+def test_release_hands_the_slot_to_interactive_before_bulk_and_fifo_within_a_priority():
+    async def scenario():
+        controller = _controller()
+        first = await controller.acquire("holder", INTERACTIVE)
+        order, tickets = [], {}
+
+        async def waiter(name, priority):
+            tickets[name] = await controller.acquire(name, priority)
+            order.append(name)
+
+        tasks = [
+            asyncio.create_task(waiter("bulk-1", BULK)),
+            asyncio.create_task(waiter("bulk-2", BULK)),
+            asyncio.create_task(waiter("chat-1", INTERACTIVE)),
+            asyncio.create_task(waiter("chat-2", INTERACTIVE)),
+        ]
+        await _wait_queued(controller, 4)
+
+        ticket = first
+        for admitted in range(1, len(tasks) + 1):
+            controller.release(ticket)
+            while len(order) < admitted:
+                await asyncio.sleep(0)
+            # The slot moved to the waiter without being freed in between.
+            assert controller.active == 1
+            ticket = tickets[order[-1]]
+        controller.release(ticket)
+        assert controller.active == 0
+        assert not controller._queue
+        return order
+
+    assert asyncio.run(scenario()) == ["chat-1", "chat-2", "bulk-1", "bulk-2"]
+
+
+def test_release_is_idempotent_and_skips_cancelled_waiters():
+    async def scenario():
+        controller = _controller()
+        ticket = await controller.acquire("a", INTERACTIVE)
+        gone = asyncio.create_task(controller.acquire("gone", INTERACTIVE))
+        staying = asyncio.create_task(controller.acquire("staying", BULK))
+        await _wait_queued(controller, 2)
+        gone.cancel()
+        await asyncio.sleep(0)
+
+        controller.release(ticket)
+        controller.release(ticket)
+        second = await staying
+        assert controller.active == 1
+        controller.release(second)
+        assert controller.active == 0
+        assert controller._user_requests == {}
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_per_user_concurrency_are_rejected():
+    async def scenario():
+        controller = _controller(max_queue=1, user_concurrency=1)
+        await controller.acquire("a", INTERACTIVE)
+        with pytest.raises(HTTPException) as busy_user:
+            await controller.acquire("a", INTERACTIVE)
+        assert busy_user.value.status_code == 429
+
+        queued = asyncio.create_task(controller.acquire("b", INTERACTIVE))
+        await _wait_queued(controller, 1)
+        with pytest.raises(HTTPException) as full:
+            await controller.acquire("c", INTERACTIVE)
+        assert full.value.status_code == 503
+        assert "Retry-After" in full.value.headers
+        queued.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_gives_up_the_place_in_line():
+    async def scenario():
+        controller = _controller(queue_timeout=0.05)
+        holder = await controller.acquire("a", INTERACTIVE)
+        with pytest.raises(HTTPException) as timed_out:
+            await controller.acquire("b", INTERACTIVE)
+        assert timed_out.value.status_code == 503
+        assert not controller._queue
+        controller.release(holder)
+        assert controller.active == 0
+
+    asyncio.run(scenario())
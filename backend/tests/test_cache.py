@@ -0,0 +1,111 @@
+from typing import List
+
+import pytest
+from fastapi import Response
+
+from backend.cache import FakeRedis, MemoryBackend, RedisBackend, ResponseCache
+
+
+@pytest.fixture(params=["memory", "fake"])
+def cache(request):
+    backend = MemoryBackend() if request.param == "memory" else RedisBackend(FakeRedis())
+    return ResponseCache(backend, ttl=60)
+
+
+def _renderer(bodies):
+    calls = []
+
+    def render():
+        calls.append(1)
+        return bodies[len(calls) - 1]
+    return render, calls
+
+
+def test_hit_until_scope_is_invalidated(cache):
+    render, calls = _renderer([b"first", b"second"])
+    assert cache.get_or_render("documents:1", [("documents", 1)], render) == b"first"
+    assert cache.get_or_render("documents:1", [("documents", 1)], render) == b"first"
+    assert len(calls) == 1
+
+    cache.invalidate("documents", 1)
+    assert cache.get_or_render("documents:1", [("documents", 1)], render) == b"second"
+    assert len(calls) == 2
+
+
+def test_invalidation_is_per_scope(cache):
+    render, calls = _renderer([b"doc", b"other"])
+    cache.get_or_render("doc:1", [("doc", 1)], render)
+    cache.invalidate("doc", 2)
+    assert cache.get_or_render("doc:1", [("doc", 1)], render) == b"doc"
+    assert len(calls) == 1
+
+
+def test_entry_depends_on_every_scope(cache):
+    render, calls = _renderer([b"a", b"b"])
+    scopes = [("doc", 3), ("quiz", 7, 3)]
+    cache.get_or_render("quiz:7:3", scopes, render)
+    cache.invalidate("quiz", 7, 3)
+    assert cache.get_or_render("quiz:7:3", scopes, render) == b"b"
+
+
+def test_json_response_is_keyed_by_etag(cache):
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [len(loads)]
+
+    def respond(etag):
+        response = Response()
+        response.headers["etag"] = etag
+        return cache.json_response(response, "documents:1", [("documents", 1)], List[int], load)
+
+    first = respond('"v1"')
+    assert first.body == b"[1]"
+    assert first.headers["etag"] == '"v1"'
+    assert respond('"v1"').body == b"[1]"
+    # Another worker's write changes the ETag even if its invalidation never reached this backend.
+    assert respond('"v2"').body == b"[2]"
+    assert len(loads) == 2
+
+
+def test_no_backend_always_renders():
+    cache = ResponseCache(None)
+    render, calls = _renderer([b"x", b"y"])
+    cache.get_or_render("documents:1", [("documents", 1)], render)
+    cache.get_or_render("documents:1", [("documents", 1)], render)
+    assert len(calls) == 2
+
+
+def test_memory_counters_are_bounded_and_expire(monkeypatch):
+    backend = MemoryBackend(max_bytes=200, counter_ttl=10)
+    cache = ResponseCache(backend)
+    for user_id in range(100):
+        cache.invalidate("documents", user_id)
+    assert backend.size <= 200
+
+    now = [1000.0]
+    monkeypatch.setattr("backend.cache.time.monotonic", lambda: now[0])
+    backend.add("gen:doc:1", 5)
+    now[0] += 11
+    assert backend.get("gen:doc:1") is None
+
+
+def test_lost_counter_does_not_return_to_an_old_generation():
+    backend = MemoryBackend(counter_ttl=60)
+    cache = ResponseCache(backend)
+    before = cache._generation(("doc", 1))
+    backend._entries.clear()  # as if the counter had been evicted
+    backend.size = 0
+    cache.invalidate("doc", 1)
+    assert cache._generation(("doc", 1)) != before
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_bytes=10)
+    backend.set("a", b"12345", ttl=60)
+    backend.set("b", b"12345", ttl=60)
+    backend.get("a")
+    backend.set("c", b"12345", ttl=60)
+    assert backend.get("a") == b"12345"
+    assert backend.get("b") is None
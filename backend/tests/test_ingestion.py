@@ -0,0 +1,52 @@
+from backend.ingestion import IncrementalChunker
+
+
+def _pages(count: int, words_per_page: int = 60):
+    return [(number, " ".join(f"p{number}w{i}" for i in range(words_per_page))) for number in range(1, count + 1)]
+
+
+def _chunk_all(chunker, pages):
+    chunks = []
+    for number, text in pages:
+        chunks.extend(chunker.add_page(number, text))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+def test_chunks_carry_the_page_they_start_and_end_on():
+    # Short pages, so most chunks span more than one of them.
+    pages = _pages(40, words_per_page=8)
+    chunks = _chunk_all(IncrementalChunker(chunk_size=200, chunk_overlap=0), pages)
+
+    assert chunks
+    for text, metadata in chunks:
+        words = text.split()
+        first = int(words[0][1:].split("w")[0])
+        last = int(words[-1][1:].split("w")[0])
+        assert metadata["page"] == first
+        assert metadata.get("page_end", first) == last
+    assert any("page_end" in metadata for _, metadata in chunks)
+
+
+def test_streaming_emits_before_finish_and_matches_a_single_pass():
+    pages = _pages(12)
+    chunker = IncrementalChunker(chunk_size=200, chunk_overlap=40)
+    early = []
+    for number, text in pages:
+        early.extend(chunker.add_page(number, text))
+    assert early, "chunks should be emitted while pages are still arriving"
+    streamed = early + chunker.finish()
+
+    whole = IncrementalChunker(chunk_size=200, chunk_overlap=40)
+    single = whole.add_page(1, "\n".join(text for _, text in pages)) + whole.finish()
+    assert [text for text, _ in streamed] == [text for text, _ in single]
+
+
+def test_content_hash_is_stable_and_empty_input_yields_nothing():
+    first = _chunk_all(IncrementalChunker(chunk_size=200, chunk_overlap=0), _pages(3))
+    second = _chunk_all(IncrementalChunker(chunk_size=200, chunk_overlap=0), _pages(3))
+    assert [m["content_hash"] for _, m in first] == [m["content_hash"] for _, m in second]
+
+    chunker = IncrementalChunker()
+    assert chunker.add_page(1, "   ") == []
+    assert chunker.finish() == []
@@ -0,0 +1,48 @@
+from langchain_core.documents import Document as LCDocument
+
+from backend.lexical import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+def _doc(text: str) -> LCDocument:
+    return LCDocument(page_content=text, metadata={"content_hash": text})
+
+
+def test_tokenize_keeps_codes_and_section_numbers_together():
+    assert tokenize("See CMPE-272, section 3.2.1 and O(n) time.") == [
+        "see", "cmpe-272", "section", "3.2.1", "and", "o", "n", "time",
+    ]
+
+
+def test_bm25_ranks_exact_term_matches_first(tmp_path):
+    index = BM25Index()
+    index.add_many([
+        ("a", "the lecture covers sorting algorithms in general"),
+        ("b", "quicksort partitions around a pivot; quicksort is fast"),
+        ("c", "merge sort is stable"),
+    ])
+    assert [key for key, _ in index.search("quicksort pivot")] == ["b"]
+    assert index.search("nothing matches this") == []
+    assert BM25Index().search("anything") == []
+
+    path = str(tmp_path / "bm25.json.gz")
+    index.save(path)
+    loaded = BM25Index.load(path)
+    assert loaded.search("quicksort pivot") == index.search("quicksort pivot")
+    assert len(loaded) == 3
+
+
+def test_rrf_prefers_documents_found_by_both_rankings():
+    a, b, c, d = _doc("a"), _doc("b"), _doc("c"), _doc("d")
+    dense = [a, b, c]
+    lexical = [d, c]
+    fused = reciprocal_rank_fusion([dense, lexical], [1.0, 1.0], k=4, rrf_k=60)
+    assert fused[0] is c
+    assert {doc.page_content for doc in fused} == {"a", "b", "c", "d"}
+
+
+def test_rrf_weights_and_k():
+    a, b = _doc("a"), _doc("b")
+    assert reciprocal_rank_fusion([[a], [b]], [1.0, 2.0], k=2) == [b, a]
+    assert reciprocal_rank_fusion([[a], [b]], [2.0, 1.0], k=1) == [a]
+    # The same chunk returned by both retrievers is merged by content hash.
+    assert len(reciprocal_rank_fusion([[_doc("a")], [_doc("a")]], [1.0, 1.0], k=4)) == 1
@@ -0,0 +1,63 @@
+import os
+
+from backend.reembed import find_orphans, new_generation_path, remove_store, swap_store
+
+
+def _generation(root, document_id: int, content: str) -> str:
+    path = new_generation_path(str(root), document_id)
+    os.makedirs(path)
+    with open(os.path.join(path, "index.faiss"), "w") as fh:
+        fh.write(content)
+    return path
+
+
+def _read(store_path: str) -> str:
+    with open(os.path.join(store_path, "index.faiss")) as fh:
+        return fh.read()
+
+
+def test_swap_store_publishes_generations_and_returns_the_previous_one(tmp_path):
+    store = str(tmp_path / "doc_1")
+    first = _generation(tmp_path, 1, "v1")
+    assert swap_store(store, first) is None
+    assert _read(store) == "v1"
+
+    second = _generation(tmp_path, 1, "v2")
+    assert swap_store(store, second) == os.path.realpath(first)
+    assert _read(store) == "v2"
+    # No temporary links are left next to the store.
+    assert sorted(os.listdir(tmp_path)) == [".generations", "doc_1"]
+
+
+def test_swap_store_moves_a_plain_directory_aside(tmp_path):
+    store = tmp_path / "doc_2"
+    store.mkdir()
+    (store / "index.faiss").write_text("legacy")
+    previous = swap_store(str(store), _generation(tmp_path, 2, "new"))
+    assert previous == str(store) + ".old"
+    assert _read(previous) == "legacy"
+    assert _read(str(store)) == "new"
+
+
+def test_remove_store_deletes_the_link_and_its_generation(tmp_path):
+    store = str(tmp_path / "doc_3")
+    generation = _generation(tmp_path, 3, "v1")
+    swap_store(store, generation)
+    remove_store(store)
+    assert not os.path.lexists(store)
+    assert not os.path.exists(generation)
+
+
+def test_find_orphans(tmp_path):
+    live = str(tmp_path / "doc_1")
+    swap_store(live, _generation(tmp_path, 1, "live"))
+    stale = _generation(tmp_path, 1, "replaced")
+    in_flight = _generation(tmp_path, 4, "building")
+    deleted = tmp_path / "doc_9"
+    deleted.mkdir()
+    (tmp_path / "doc_1.old").mkdir()
+    (tmp_path / "shards").mkdir()
+
+    orphans = {entry["path"] for entry in find_orphans(str(tmp_path), {1}, keep_generations={os.path.realpath(in_flight)})}
+    assert orphans == {str(deleted), str(tmp_path / "doc_1.old"), stale}
+    assert find_orphans(str(tmp_path / "missing"), {1}) == []
@@ -0,0 +1,97 @@
+import pytest
+
+from backend.sharded_store import ShardedVectorStore, vector_id
+
+
+class FakeEmbeddings:
+    """Maps a text to a 4-d vector from its length, so searches are deterministic."""
+
+    def embed_query(self, text):
+        return [float(len(text))] * 4
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=4, max_resident_shards=2)
+    yield store
+    store.close()
+
+
+def _ntotal(store, document_id, owner_id):
+    with store._shard(store.shard_for(document_id, owner_id)) as shard:
+        return shard.index.ntotal
+
+
+def test_add_search_and_filter_by_owner(store):
+    ids = store.add_texts(1, 10, ["a", "bbbb", "cccccccc"], metadatas=[{"page": 1}, {"page": 2}, {"page": 3}])
+    store.add_texts(2, 11, ["bbbb"])
+    assert ids == [vector_id(1, 0), vector_id(1, 1), vector_id(1, 2)]
+
+    hits = store.similarity_search("bbbb", k=2, owners={1: 10})
+    assert hits[0].page_content == "bbbb"
+    assert hits[0].metadata == {"page": 2, "document_id": 1}
+    assert all(hit.metadata["document_id"] == 1 for hit in hits)
+
+    both = store.similarity_search("bbbb", k=2, owners={1: 10, 2: 11})
+    assert {hit.metadata["document_id"] for hit in both} == {1, 2}
+    assert store.get_by_ids([vector_id(1, 1), vector_id(2, 0)], {1: 10})[1] is None
+
+
+def test_writes_survive_a_reopen(tmp_path):
+    first = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=4)
+    first.add_texts(1, 10, ["one", "three"])
+    first.flush(1, 10)
+    first.close()
+
+    reopened = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=4)
+    assert [content for _, content, _ in reopened.get_chunk_records(1, 10)] == ["one", "three"]
+    assert reopened.similarity_search("three", k=1, owners={1: 10})[0].page_content == "three"
+    reopened.close()
+
+
+def test_two_writers_on_one_directory_keep_each_others_vectors(tmp_path):
+    a = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=1)
+    b = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=1)
+    a.add_texts(1, None, ["from a"])
+    b.add_texts(2, None, ["from b!"])
+    a.flush(1, None)
+    b.flush(2, None)
+    a.close()
+    b.close()
+
+    reader = ShardedVectorStore(str(tmp_path), FakeEmbeddings(), num_shards=1)
+    assert _ntotal(reader, 1, None) == 2
+    reader.close()
+
+
+def test_remove_document_hides_it_now_and_compaction_drops_its_vectors(store):
+    store.add_texts(1, 10, ["a", "bb"])
+    store.add_texts(5, 10, ["ccc"])  # same owner, so the same shard
+    assert _ntotal(store, 1, 10) == 3
+
+    store.remove_document(1, 10)
+    assert not store.has_document(1, 10)
+    assert [hit.page_content for hit in store.similarity_search("a", k=3, owners={1: 10, 5: 10})] == ["ccc"]
+    assert _ntotal(store, 1, 10) == 3
+
+    store.compact()
+    assert _ntotal(store, 1, 10) == 1
+    assert store.has_document(5, 10)
+
+
+def test_reusing_a_tombstoned_document_id_drops_the_old_vectors(store):
+    store.add_texts(1, 10, ["old", "older"])
+    store.remove_document(1, 10)
+    store.add_texts(1, 10, ["new"])
+    assert _ntotal(store, 1, 10) == 1
+    assert [content for _, content, _ in store.get_chunk_records(1, 10)] == ["new"]
+
+
+def test_remove_ids_deletes_single_chunks(store):
+    ids = store.add_texts(3, 7, ["x", "yy", "zzz"])
+    store.remove_ids(3, 7, [ids[1]])
+    assert [content for _, content, _ in store.get_chunk_records(3, 7)] == ["x", "zzz"]
+    assert _ntotal(store, 3, 7) == 2
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from backend import models
+from backend.spaced_repetition import INITIAL_EASINESS, MIN_EASINESS, schedule
+
+NOW = datetime(2026, 1, 1, 9, 0)
+
+
+def _review() -> models.FlashcardReview:
+    return models.FlashcardReview()
+
+
+def test_passing_grades_step_through_1_6_then_easiness_times_interval():
+    review = _review()
+    schedule(review, 5, NOW)
+    assert (review.repetitions, review.interval_days) == (1, 1)
+    assert review.due_at == NOW + timedelta(days=1)
+    schedule(review, 5, NOW)
+    assert (review.repetitions, review.interval_days) == (2, 6)
+    easiness = review.easiness
+    schedule(review, 5, NOW)
+    assert review.repetitions == 3
+    assert review.interval_days == round(6 * easiness)
+    assert review.last_reviewed_at == NOW
+
+
+def test_easiness_moves_with_the_grade():
+    perfect, hard = _review(), _review()
+    schedule(perfect, 5, NOW)
+    schedule(hard, 3, NOW)
+    assert perfect.easiness == INITIAL_EASINESS + 0.1
+    assert hard.easiness < INITIAL_EASINESS
+
+
+def test_lapse_restarts_the_card_and_counts():
+    review = _review()
+    for _ in range(3):
+        schedule(review, 4, NOW)
+    schedule(review, 1, NOW)
+    assert (review.repetitions, review.interval_days, review.lapses) == (0, 1, 1)
+    assert review.due_at == NOW + timedelta(days=1)
+    schedule(review, 4, NOW)
+    assert (review.repetitions, review.interval_days) == (1, 1)
+
+
+def test_easiness_never_falls_below_the_floor():
+    review = _review()
+    for _ in range(10):
+        schedule(review, 0, NOW)
+    assert review.easiness == MIN_EASINESS
+    assert review.lapses == 10
@@ -0,0 +1,124 @@
+# text_store.py
+"""
+Content-addressed store for the text extracted at ingestion.
+
+The uploaded file is deleted once it is indexed. Its extracted text is kept
+instead, so the document can be re-chunked or re-embedded later without the
+source. Each text is stored once per SHA-256 of its content as:
+
+    <TEXT_STORE_DIRECTORY>/<hash[:2]>/<hash>.txt.gz      pages joined by "\\n"
+    <TEXT_STORE_DIRECTORY>/<hash[:2]>/<hash>.pages.json  [[page_number, start_offset], ...]
+
+The join is the same one IncrementalChunker uses, so re-chunking the stored
+text reproduces what ingestion would have produced. Identical uploads share
+one copy.
+"""
+import gzip
+import hashlib
+import json
+import os
+import uuid
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+TEXT_STORE_DIRECTORY = os.getenv("TEXT_STORE_DIRECTORY", "./text_store")
+
+
+def _paths(content_hash: str) -> Tuple[str, str]:
+    base = os.path.join(TEXT_STORE_DIRECTORY, content_hash[:2], content_hash)
+    return base + ".txt.gz", base + ".pages.json"
+
+
+def exists(content_hash: Optional[str]) -> bool:
+    return bool(content_hash) and os.path.exists(_paths(content_hash)[0])
+
+
+class TextRecorder:
+    """Tees a page stream to a compressed temp file while ingestion consumes it."""
+
+    def __init__(self):
+        os.makedirs(TEXT_STORE_DIRECTORY, exist_ok=True)
+        self._tmp_path = os.path.join(TEXT_STORE_DIRECTORY, f".tmp-{uuid.uuid4().hex}.txt.gz")
+        self._file = gzip.open(self._tmp_path, "wt", encoding="utf-8", newline="", compresslevel=6)
+        self._hash = hashlib.sha256()
+        self._offset = 0
+        self.pages: List[List] = []
+
+    def _write(self, text: str):
+        self._file.write(text)
+        self._hash.update(text.encode("utf-8"))
+        self._offset += len(text)
+
+    def add_page(self, page_number: Optional[int], text: str):
+        if self.pages:
+            self._write("\n")
+        self.pages.append([page_number, self._offset])
+        self._write(text)
+
+    async def record(self, pages: AsyncIterator[Tuple[Optional[int], str]]) -> AsyncIterator[Tuple[Optional[int], str]]:
+        async for page_number, text in pages:
+            self.add_page(page_number, text)
+            yield page_number, text
+
+    @property
+    def content_hash(self) -> str:
+        """Hash of the text recorded so far; final once the page stream is exhausted."""
+        return self._hash.hexdigest()
+
+    def commit(self) -> str:
+        """Moves the text to its content address and returns the hash."""
+        self._file.close()
+        content_hash = self.content_hash
+        text_path, pages_path = _paths(content_hash)
+        if os.path.exists(text_path):
+            os.remove(self._tmp_path)  # already stored by an identical upload
+            return content_hash
+        os.makedirs(os.path.dirname(text_path), exist_ok=True)
+        # Unique like _tmp_path, so identical uploads committing at once never share a temp file.
+        pages_tmp = f"{pages_path}.{uuid.uuid4().hex}.tmp"
+        with open(pages_tmp, "w") as fh:
+            json.dump(self.pages, fh, separators=(",", ":"))
+        os.replace(pages_tmp, pages_path)
+        # The text file is moved last; its presence means the entry is complete.
+        os.replace(self._tmp_path, text_path)
+        return content_hash
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def remove(content_hash: str):
+    for path in _paths(content_hash):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def iter_pages(content_hash: str) -> Iterator[Tuple[Optional[int], str]]:
+    """Yields (page_number, text) from the store, one page in memory at a time."""
+    text_path, pages_path = _paths(content_hash)
+    with open(pages_path) as fh:
+        pages = json.load(fh)
+    with gzip.open(text_path, "rt", encoding="utf-8", newline="") as fh:
+        for i, (page_number, start) in enumerate(pages):
+            if i + 1 < len(pages):
+                # Read up to the next page, then drop the "\n" that joined them.
+                yield page_number, fh.read(pages[i + 1][1] - start)[:-1]
+            else:
+                yield page_number, fh.read()
+
+
+async def aiter_pages(content_hash: str) -> AsyncIterator[Tuple[Optional[int], str]]:
+    for page in iter_pages(content_hash):
+        yield page
+
+
+def stats() -> dict:
+    """Entry count and on-disk size of the store."""
+    entries, size = 0, 0
+    for root, _, files in os.walk(TEXT_STORE_DIRECTORY):
+        for name in files:
+            if name.endswith(".txt.gz"):
+                entries += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return {"entries": entries, "bytes": size}
@@ -9,32 +9,32 @@ function QuizModal({ quizData, token, activeDocument, onClose, onQuizSubmit }) {
 
     if (!quizData || !quizData.questions) return null;
 
-    const handleAnswer = (qIndex, option) => {
+    const handleAnswer = (qIndex, oIndex) => {
         if (submitted) return;
-        setUserAnswers(prev => ({ ...prev, [qIndex]: option }));
+        setUserAnswers(prev => ({ ...prev, [qIndex]: oIndex }));
     };
 
     const handleSubmit = async () => {
         setIsSubmitting(true);
-        let correctCount = 0;
-        const submissionAnswers = quizData.questions.map((q, qIndex) => {
-            const selected = userAnswers[qIndex] || "No answer";
-            const isCorrect = selected === q.correct_answer;
-            if(isCorrect) correctCount++;
-            return { question_text: q.question, selected_answer: selected, correct_answer: q.correct_answer, is_correct: isCorrect };
-        });
-        
-        const finalScore = (correctCount / quizData.questions.length) * 100;
-        setScore(finalScore);
+        // Only the chosen option indexes are sent; the server grades the quiz.
+        const submissionAnswers = quizData.questions.map((q, qIndex) => ({
+            question_id: q.id,
+            option_index: userAnswers[qIndex] ?? null,
+        }));
 
-        await fetch(`${API_URL}/submit-quiz`, {
+        const response = await fetch(`${API_URL}/submit-quiz`, {
             method: 'POST',
             headers: { 'Authorization': `Bearer ${token}`, 'Content-Type': 'application/json' },
-            body: JSON.stringify({ document_id: activeDocument.id, score: finalScore, answers: submissionAnswers })
+            body: JSON.stringify({ quiz_id: quizData.quiz_id, answers: submissionAnswers })
         });
-        
-        setSubmitted(true);
         setIsSubmitting(false);
+        if (!response.ok) {
+            alert("Failed to submit quiz.");
+            return;
+        }
+        const result = await response.json();
+        setScore(result.score);
+        setSubmitted(true);
         if(onQuizSubmit) onQuizSubmit();
     };
 
@@ -62,9 +62,9 @@ function QuizModal({ quizData, token, activeDocument, onClose, onQuizSubmit }) {
                                 {q.options.map((option, oIndex) => (
                                     <button 
                                         key={oIndex} 
-                                        onClick={() => handleAnswer(qIndex, option)} 
+                                        onClick={() => handleAnswer(qIndex, oIndex)} 
                                         className={`w-full text-left p-3 rounded-lg border-2 transition-all duration-200
-                                            ${userAnswers[qIndex] === option 
+                                            ${userAnswers[qIndex] === oIndex 
                                                 ? 'border-indigo-500 bg-indigo-50 ring-2 ring-indigo-200' 
                                                 : 'border-slate-300 bg-white hover:bg-slate-50 hover:border-slate-400'}`
                                         }